@@ -0,0 +1,282 @@
+"""Benchmark of the download profiles against a local stand-in server.
+
+Starts an HTTPS server on localhost that serves the fixture pages (gzip or
+Brotli encoded, as the client asks) and adds a simulated network round trip
+to every response, plus two more to the first response of each connection
+(TCP and TLS handshakes). Each profile of ``supply_chain.download`` then
+crawls the same pages in its own process at the same request rate, and the
+run reports per-request latency, crawler CPU time per request, connections
+opened and bytes received. No request leaves the machine.
+
+Run from the project directory (where scrapy.cfg lives):
+
+    python -m benchmarks.download
+    python -m benchmarks.download --requests 400 --rate 20 --rtt-ms 40 --profiles default,http2
+
+The ``http2`` profile needs ``h2`` on the client and Twisted's HTTP/2 server
+support (``pip install priority``) for the stand-in server.
+"""
+
+import argparse
+import datetime
+import gzip
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def load_pages(fixtures_dir: str) -> list[bytes]:
+    with open(os.path.join(fixtures_dir, 'manifest.json'), 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    pages = []
+    for case in manifest:
+        with open(os.path.join(fixtures_dir, case['file']), 'rb') as f:
+            pages.append(f.read())
+    return pages
+
+
+def write_certificate(directory: str) -> tuple[str, str]:
+    """Write a self-signed certificate for localhost, return the key and certificate paths"""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'localhost')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (x509.CertificateBuilder()
+                   .subject_name(name).issuer_name(name)
+                   .public_key(key.public_key())
+                   .serial_number(x509.random_serial_number())
+                   .not_valid_before(now - datetime.timedelta(days=1))
+                   .not_valid_after(now + datetime.timedelta(days=1))
+                   .add_extension(x509.SubjectAlternativeName([x509.DNSName('localhost')]), critical=False)
+                   .sign(key, hashes.SHA256()))
+    key_path, certificate_path = os.path.join(directory, 'key.pem'), os.path.join(directory, 'cert.pem')
+    with open(key_path, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    with open(certificate_path, 'wb') as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    return key_path, certificate_path
+
+
+def serve(fixtures_dir: str, rtt: float, idle_timeout: float, key_path: str, certificate_path: str) -> None:
+    """Run the stand-in server until stdin closes; print its port first"""
+    from twisted.internet import reactor, ssl, stdio, task
+    from twisted.protocols.basic import LineReceiver
+    from twisted.web import resource as web_resource, server
+
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+
+    # Encoded once, so the server's own CPU stays out of the way
+    bodies = {}
+    for index, page in enumerate(load_pages(fixtures_dir)):
+        bodies[index, b'identity'] = page
+        bodies[index, b'gzip'] = gzip.compress(page, 6)
+        if brotli is not None:
+            bodies[index, b'br'] = brotli.compress(page, quality=5)
+    page_count = len(bodies) // (3 if brotli is not None else 2)
+    counters = {'connections': 0, 'requests': 0}
+    seen = set()
+
+    class Page(web_resource.Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            if request.path == b'/stats':
+                return json.dumps(counters).encode()
+            counters['requests'] += 1
+            # HTTP/2 streams share the connection of their channel
+            connection = getattr(request.channel, '_conn', request.channel)
+            delay = rtt
+            if id(connection) not in seen:
+                seen.add(id(connection))
+                counters['connections'] += 1
+                delay += 2 * rtt
+
+            accepted = [encoding.strip().split(b';')[0] for encoding in
+                        (request.getHeader(b'accept-encoding') or b'').split(b',')]
+            encoding = next((e for e in (b'br', b'gzip') if e in accepted and (0, e) in bodies), b'identity')
+            index = int(request.path.rsplit(b'/', 1)[-1] or 0) % page_count
+            request.setHeader(b'content-type', b'text/html; charset=utf-8')
+            if encoding != b'identity':
+                request.setHeader(b'content-encoding', encoding)
+
+            def respond():
+                request.write(bodies[index, encoding])
+                request.finish()
+
+            call = task.deferLater(reactor, delay, respond)
+            request.notifyFinish().addErrback(lambda _: call.cancel())
+            return server.NOT_DONE_YET
+
+    class Control(LineReceiver):
+        delimiter = b'\n'
+
+        def connectionLost(self, reason):
+            reactor.stop()
+
+    with open(key_path, 'rb') as f:
+        key = f.read()
+    with open(certificate_path, 'rb') as f:
+        certificate = ssl.PrivateCertificate.loadPEM(f.read() + key)
+    options = ssl.CertificateOptions(privateKey=certificate.privateKey.original,
+                                     certificate=certificate.original,
+                                     acceptableProtocols=[b'h2', b'http/1.1'])
+    site = server.Site(Page(), timeout=idle_timeout)
+    port = reactor.listenSSL(0, site, options, interface='127.0.0.1')
+    print(port.getHost().port, flush=True)
+    stdio.StandardIO(Control())
+    reactor.run()
+
+
+def crawl(profile: str, url: str, requests: int, rate: float, concurrency: int, output: str) -> None:
+    """Crawl ``requests`` pages with a download profile and write the measurements to ``output``"""
+    import scrapy
+    from scrapy import signals
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+
+    latencies, sizes = [], []
+    cpu = {}
+
+    def cpu_seconds() -> float:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+
+    class DownloadBenchmarkSpider(scrapy.Spider):
+        name = 'download_benchmark'
+
+        async def start(self):
+            for index in range(requests):
+                yield scrapy.Request(f'{url}/p/{index}', dont_filter=True)
+
+        def parse(self, response):
+            latencies.append(response.meta['download_latency'])
+            sizes.append(len(response.body))
+
+    settings = get_project_settings()
+    settings.setdict({
+        'DOWNLOAD_PROFILE': profile,
+        'DOWNLOAD_DELAY': 1 / rate,
+        'RANDOMIZE_DOWNLOAD_DELAY': False,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': concurrency,
+        'AUTOTHROTTLE_ENABLED': False,
+        'HTTPCACHE_ENABLED': False,
+        'RETRY_ENABLED': False,
+        'ITEM_PIPELINES': {},
+        'METRICS_ENABLED': False,
+        'RATE_BUDGET_PER_SEC': 0,
+        'LOG_LEVEL': 'WARNING',
+    }, priority='cmdline')
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(DownloadBenchmarkSpider)
+
+    def opened(spider):
+        cpu['start'], cpu['wall'] = cpu_seconds(), time.perf_counter()
+
+    def closed(spider):
+        cpu['seconds'], cpu['wall'] = cpu_seconds() - cpu['start'], time.perf_counter() - cpu['wall']
+
+    crawler.signals.connect(opened, signal=signals.spider_opened)
+    crawler.signals.connect(closed, signal=signals.spider_closed)
+    process.crawl(crawler)
+    process.start()
+
+    latencies.sort()
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'responses': len(latencies),
+            'errors': crawler.stats.get_value('log_count/ERROR', 0),
+            'wall_s': cpu['wall'],
+            'latency_p50_ms': latencies[len(latencies) // 2] * 1000 if latencies else None,
+            'latency_p95_ms': latencies[int(len(latencies) * 0.95)] * 1000 if latencies else None,
+            'cpu_ms_per_request': cpu['seconds'] * 1000 / max(len(latencies), 1),
+            'received_kib_per_request': crawler.stats.get_value('downloader/response_bytes', 0) / 1024
+                                        / max(len(latencies), 1),
+            'decoded_kib_per_request': sum(sizes) / 1024 / max(len(sizes), 1),
+        }, f)
+
+
+def server_stats(url: str) -> dict:
+    import ssl
+    import urllib.request
+
+    context = ssl.create_default_context()
+    context.check_hostname, context.verify_mode = False, ssl.CERT_NONE
+    with urllib.request.urlopen(f'{url}/stats', context=context) as response:
+        return json.load(response)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--profiles', default='default,http2', help="comma-separated download profiles")
+    parser.add_argument('--requests', type=int, default=200, help="pages requested per profile")
+    parser.add_argument('--rate', type=float, default=10, help="requests per second (DOWNLOAD_DELAY = 1 / rate)")
+    parser.add_argument('--concurrency', type=int, default=4, help="CONCURRENT_REQUESTS_PER_DOMAIN")
+    parser.add_argument('--rtt-ms', type=float, default=30, help="simulated network round trip")
+    parser.add_argument('--idle-timeout', type=float, default=15, help="server keep-alive timeout, in seconds")
+    parser.add_argument('--fixtures', default=FIXTURES_DIR, help="directory holding manifest.json and the pages")
+    # Internal: the server and each crawl run in their own process
+    parser.add_argument('--serve', nargs=2, metavar=('KEY', 'CERT'), help=argparse.SUPPRESS)
+    parser.add_argument('--crawl', nargs=3, metavar=('PROFILE', 'URL', 'OUTPUT'), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        serve(args.fixtures, args.rtt_ms / 1000, args.idle_timeout, *args.serve)
+        return 0
+    if args.crawl:
+        profile, url, output = args.crawl
+        crawl(profile, url, args.requests, args.rate, args.concurrency, output)
+        return 0
+
+    from twisted.web.http import H2_ENABLED
+
+    profiles = args.profiles.split(',')
+    if 'http2' in profiles and not H2_ENABLED:
+        print("Skipping http2: the stand-in server needs Twisted's HTTP/2 support (pip install priority)")
+        profiles.remove('http2')
+
+    common = ['--fixtures', args.fixtures, '--rtt-ms', str(args.rtt_ms)]
+    print(f"{args.requests} requests per profile at {args.rate:g}/s, {args.concurrency} per domain, "
+          f"simulated RTT {args.rtt_ms:g} ms")
+    print(f"{'profile':<10}{'p50 ms':>9}{'p95 ms':>9}{'cpu ms/req':>12}{'conns':>7}{'KiB/req':>9}{'errors':>8}")
+    with tempfile.TemporaryDirectory() as directory:
+        key_path, certificate_path = write_certificate(directory)
+        for profile in profiles:
+            # A fresh server per profile, so connection counts and keep-alive state start from zero
+            server_process = subprocess.Popen(
+                [sys.executable, '-m', 'benchmarks.download', '--serve', key_path, certificate_path,
+                 '--idle-timeout', str(args.idle_timeout), *common],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+            try:
+                url = f'https://localhost:{server_process.stdout.readline().strip()}'
+                output = os.path.join(directory, f'{profile}.json')
+                subprocess.run([sys.executable, '-m', 'benchmarks.download', '--crawl', profile, url, output,
+                                '--requests', str(args.requests), '--rate', str(args.rate),
+                                '--concurrency', str(args.concurrency), *common], check=True)
+                with open(output, 'r', encoding='utf-8') as f:
+                    result = json.load(f)
+                connections = server_stats(url)['connections']
+            finally:
+                server_process.stdin.close()
+                server_process.wait()
+            print(f"{profile:<10}{result['latency_p50_ms']:>9.1f}{result['latency_p95_ms']:>9.1f}"
+                  f"{result['cpu_ms_per_request']:>12.2f}{connections:>7}"
+                  f"{result['received_kib_per_request']:>9.1f}{result['errors']:>8}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,168 @@
+"""End-to-end load test of the spiders against the local mock site.
+
+Starts ``benchmarks.mocksite`` and runs get_categories, get_products and
+get_reviews (``-a mode=all``) against it one after the other, each in its
+own process, in a scratch directory. The crawls use the project settings
+(pipelines, checkpoints, storage, metrics) with ``TRUSTPILOT_BASE_URL``
+pointed at the mock site, no download delay, AutoThrottle or HTTP cache,
+and report for each stage pages/sec, items/sec, CPU time and peak memory.
+No request leaves the machine.
+
+Run from the project directory (where scrapy.cfg lives):
+
+    python -m benchmarks.load
+    python -m benchmarks.load --categories 30 --latency-ms 120 --error-rate 0.02 --concurrency 32
+    python -m benchmarks.load --spiders get_all --output load.json -s STORAGE_FLUSH_ITEMS=1000
+
+Site options are those of ``benchmarks.mocksite``.
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from benchmarks.mocksite import add_site_arguments, site_arguments
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SPIDERS = ('get_categories', 'get_products', 'get_reviews')
+
+
+def crawl(spider_name: str, settings: dict, spider_args: dict, output: str) -> None:
+    """Run one spider with the project settings and ``settings``, write its measurements to ``output``"""
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+
+    project_settings = get_project_settings()
+    project_settings.setdict(settings, priority='cmdline')
+    process = CrawlerProcess(project_settings)
+    crawler = process.create_crawler(spider_name)
+    process.crawl(crawler, **spider_args)
+    process.start()
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    stats = crawler.stats.get_stats()
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'seconds': stats.get('elapsed_time_seconds', 0),
+            'pages': stats.get('response_received_count', 0),
+            'items': stats.get('item_scraped_count', 0),
+            'dropped': stats.get('item_dropped_count', 0),
+            'retries': stats.get('retry/count', 0),
+            'errors': stats.get('log_count/ERROR', 0),
+            'finish_reason': stats.get('finish_reason'),
+            'cpu_seconds': usage.ru_utime + usage.ru_stime,
+            # Kilobytes on Linux
+            'peak_rss_mib': usage.ru_maxrss / 1024,
+        }, f)
+
+
+def site_stats(url: str) -> dict:
+    with urllib.request.urlopen(f'{url}/stats') as response:
+        return json.load(response)
+
+
+def parse_setting(value: str) -> tuple[str, str]:
+    name, sep, setting = value.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected NAME=VALUE, got {value!r}")
+    return name, setting
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--spiders', default=','.join(SPIDERS), help="comma-separated spiders run in order")
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help="CONCURRENT_REQUESTS and CONCURRENT_REQUESTS_PER_DOMAIN")
+    parser.add_argument('--delay', type=float, default=0, help="DOWNLOAD_DELAY")
+    parser.add_argument('--window', type=int,
+                        help="window of get_reviews and get_all, with the frontier off (-s FRONTIER_DIR=)")
+    parser.add_argument('--log-level', default='WARNING', help="LOG_LEVEL of the crawls")
+    parser.add_argument('--workdir', help="keep the crawl outputs in this directory (default: a temporary one)")
+    parser.add_argument('--output', help="also write the results to this JSON file")
+    parser.add_argument('-s', dest='settings', type=parse_setting, action='append', default=[], metavar='NAME=VALUE',
+                        help="extra setting of the crawls, like scrapy crawl -s")
+    add_site_arguments(parser)
+    # Internal: each crawl runs in its own process
+    parser.add_argument('--crawl', nargs=4, metavar=('SPIDER', 'SETTINGS', 'ARGS', 'OUTPUT'), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.crawl:
+        spider_name, settings, spider_args, output = args.crawl
+        crawl(spider_name, json.loads(settings), json.loads(spider_args), output)
+        return 0
+
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        workdir = args.workdir
+    else:
+        temporary = tempfile.TemporaryDirectory(prefix='load-')
+        workdir = temporary.name
+    # The crawls run in the scratch directory, away from scrapy.cfg and the real outputs
+    env = dict(os.environ, SCRAPY_SETTINGS_MODULE='supply_chain.settings',
+               PYTHONPATH=os.pathsep.join(filter(None, [PROJECT_DIR, os.environ.get('PYTHONPATH')])))
+
+    site_process = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.mocksite', '--port', '0', '--until-stdin-closes', *site_arguments(args)],
+        cwd=PROJECT_DIR, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    results = {}
+    try:
+        url = site_process.stdout.readline().strip()
+        settings = {
+            'TRUSTPILOT_BASE_URL': url,
+            'CONCURRENT_REQUESTS': args.concurrency,
+            'CONCURRENT_REQUESTS_PER_DOMAIN': args.concurrency,
+            'DOWNLOAD_DELAY': args.delay,
+            'AUTOTHROTTLE_ENABLED': False,
+            'HTTPCACHE_ENABLED': False,
+            'LOG_LEVEL': args.log_level,
+            **dict(args.settings),
+        }
+        print(f"Mock site {url}: {args.categories} categories x {args.listing_pages} listing pages x "
+              f"{args.products_per_page} products, up to {args.review_pages} review pages of "
+              f"{args.reviews_per_page} reviews, latency {args.latency_ms:g}+/-{args.jitter_ms:g} ms, "
+              f"error rate {args.error_rate:g}; concurrency {args.concurrency}, outputs in {workdir}")
+
+        for spider_name in args.spiders.split(','):
+            spider_args = {'mode': 'all'} if spider_name == 'get_reviews' else {}
+            if spider_name in ('get_reviews', 'get_all') and args.window is not None:
+                spider_args['window'] = args.window
+            output = os.path.join(workdir, f'.load-{spider_name}.json')
+            started = time.perf_counter()
+            subprocess.run([sys.executable, '-m', 'benchmarks.load', '--crawl', spider_name, json.dumps(settings),
+                            json.dumps(spider_args), output], cwd=workdir, env=env, check=True)
+            with open(output, 'r', encoding='utf-8') as f:
+                results[spider_name] = json.load(f)
+            results[spider_name]['process_seconds'] = time.perf_counter() - started
+            os.remove(output)
+        served = site_stats(url)
+    finally:
+        site_process.stdin.close()
+        site_process.wait()
+
+    print(f"{'spider':<16}{'pages':>8}{'items':>8}{'crawl s':>9}{'pages/s':>9}{'items/s':>9}"
+          f"{'cpu s':>8}{'peak MiB':>10}{'retries':>9}{'errors':>8}")
+    for spider_name, result in results.items():
+        seconds = max(result['seconds'], 1e-9)
+        print(f"{spider_name:<16}{result['pages']:>8}{result['items']:>8}{result['seconds']:>9.1f}"
+              f"{result['pages'] / seconds:>9.1f}{result['items'] / seconds:>9.1f}{result['cpu_seconds']:>8.1f}"
+              f"{result['peak_rss_mib']:>10.0f}{result['retries']:>9}{result['errors']:>8}")
+    print(f"Mock site: {served['requests']} requests, {served['errors']} errors injected, "
+          f"{served['not_found']} not found, {served['bytes'] / 1048576:.1f} MiB sent")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'arguments': {k: v for k, v in vars(args).items() if k != 'crawl'},
+                       'site': served, 'spiders': results}, f, indent=2)
+    if not args.workdir:
+        temporary.cleanup()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,232 @@
+"""Local Trustpilot-like site for load tests.
+
+Serves the categories index, category listings and product review pages
+rendered by ``benchmarks.pages`` (the markup the spiders' selectors expect),
+so whole crawls can run without sending a request to fr.trustpilot.com:
+
+- ``/categories``: ``--categories`` categories
+- ``/categories/<slug>?page=N``: ``--listing-pages`` pages of
+  ``--products-per-page`` products per category
+- ``/review/<slug>?page=N``: 1 to ``--review-pages`` pages (depending on the
+  product) of ``--reviews-per-page`` reviews
+- ``/sitemap.xml``: sitemap index of ``/sitemaps/reviews-<n>.xml.gz``, gzipped
+  sitemaps of ``--sitemap-urls`` review pages each: every listed product,
+  then ``--unlisted`` products that no listing shows
+- ``/stats``: requests served, injected errors and bytes sent, as JSON
+
+Every response waits ``--latency-ms`` (+/- ``--jitter-ms``), and a share
+``--error-rate`` of the requests gets a ``--error-status`` response instead
+of the page (with ``Retry-After: --retry-after`` when given). During a
+``--storm START DURATION`` (seconds after the first request) every request
+gets the error, like a site throttling the crawl. Pages are gzipped when the
+client accepts it. Content only depends on ``--seed``, so every run serves
+the same bytes.
+
+Start it and point the spiders to it with ``TRUSTPILOT_BASE_URL``:
+
+    python -m benchmarks.mocksite --port 8800 --latency-ms 80 --error-rate 0.01
+    scrapy crawl get_categories -s TRUSTPILOT_BASE_URL=http://127.0.0.1:8800 -s DOWNLOAD_DELAY=0
+
+``python -m benchmarks.load`` starts it and runs the spiders against it.
+"""
+
+import argparse
+import gzip
+import json
+import math
+import random
+import re
+import sys
+import zlib
+from itertools import islice
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from benchmarks import pages
+
+
+class MockSite:
+    """Pages of a synthetic site of a given shape"""
+
+    def __init__(self, categories: int = 10, listing_pages: int = 5, products_per_page: int = 20,
+                 review_pages: int = 3, reviews_per_page: int = 20, seed: int = 0, sitemap_urls: int = 50000,
+                 unlisted: int = 0):
+        self.listing_pages = listing_pages
+        self.products_per_page = products_per_page
+        self.review_pages = review_pages
+        self.reviews_per_page = reviews_per_page
+        self.seed = seed
+        self.sitemap_urls = sitemap_urls
+        self.unlisted = unlisted
+        self.categories = pages.synthetic_categories(categories, seed)
+        self.category_names = {category['slug']: category['name'] for category in self.categories}
+
+    def product_pages(self, product_slug: str) -> int:
+        """Number of review pages of a product, from 1 to ``review_pages``"""
+        return 1 + zlib.crc32(product_slug.encode()) % self.review_pages
+
+    def product_slugs(self):
+        """Yield every product of the site: those of the listings, then the unlisted ones"""
+        for category in self.categories:
+            for page in range(1, self.listing_pages + 1):
+                yield from pages.synthetic_products(category['slug'], page, self.products_per_page)
+        for index in range(self.unlisted):
+            yield f"www.unlisted-{index}.fr"
+
+    def sitemap(self, url: str, base_url: str) -> bytes | None:
+        """Return the sitemap file at ``url``, None when there is none"""
+        path = urlsplit(url).path
+        products = len(self.categories) * self.listing_pages * self.products_per_page + self.unlisted
+        files = max(1, math.ceil(products / self.sitemap_urls))
+        if path == '/sitemap.xml':
+            return pages.sitemap_index(f"{base_url}/sitemaps/reviews-{number}.xml.gz"
+                                       for number in range(1, files + 1)).encode('utf-8')
+        match = re.fullmatch(r'/sitemaps/reviews-(\d+)\.xml\.gz', path)
+        if match is None or not 1 <= int(match.group(1)) <= files:
+            return None
+        start = (int(match.group(1)) - 1) * self.sitemap_urls
+        slugs = islice(self.product_slugs(), start, start + self.sitemap_urls)
+        return gzip.compress(pages.urlset(f"{base_url}/review/{slug}" for slug in slugs).encode('utf-8'), 6)
+
+    def render(self, url: str) -> str | None:
+        """Return the page at ``url`` (path and query), None when there is none"""
+        parts = urlsplit(url)
+        try:
+            page = int(parse_qs(parts.query).get('page', ['1'])[0])
+        except ValueError:
+            return None
+        path = unquote(parts.path).strip('/').split('/')
+
+        if path == ['categories']:
+            return pages.categories_page(self.categories)
+        if len(path) == 2 and path[0] == 'categories' and path[1] in self.category_names:
+            if not 1 <= page <= self.listing_pages:
+                return None
+            products = pages.synthetic_products(path[1], page, self.products_per_page)
+            return pages.listing_page(path[1], self.category_names[path[1]], products, page, self.listing_pages)
+        if len(path) == 2 and path[0] == 'review':
+            count = self.product_pages(path[1])
+            if not 1 <= page <= count:
+                return None
+            reviews = pages.synthetic_reviews(path[1], page, self.reviews_per_page, seed=self.seed)
+            return pages.review_page(path[1], reviews, page, count)
+        return None
+
+
+def serve(site: MockSite, port: int = 8800, latency: float = 0.05, jitter: float = 0.0, error_rate: float = 0.0,
+          error_status: int = 503, retry_after: int | None = None, storm: tuple[float, float] | None = None,
+          until_stdin_closes: bool = False) -> None:
+    """Serve ``site`` on localhost until interrupted; print its URL first"""
+    from twisted.internet import reactor, stdio, task
+    from twisted.protocols.basic import LineReceiver
+    from twisted.web import resource, server
+
+    rng = random.Random(site.seed)
+    counters = {'requests': 0, 'errors': 0, 'not_found': 0, 'bytes': 0}
+    started = []
+
+    class Page(resource.Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            if request.path == b'/stats':
+                return json.dumps(counters).encode()
+            counters['requests'] += 1
+            if not started:
+                started.append(reactor.seconds())
+            elapsed = reactor.seconds() - started[0]
+
+            if rng.random() < error_rate or (storm and storm[0] <= elapsed < storm[0] + storm[1]):
+                counters['errors'] += 1
+                request.setResponseCode(error_status)
+                if retry_after is not None:
+                    request.setHeader(b'retry-after', str(retry_after).encode())
+                body = b''
+            else:
+                uri = request.uri.decode('utf-8', 'replace')
+                sitemap = site.sitemap(uri, f"http://{(request.getHeader(b'host') or b'127.0.0.1').decode()}")
+                page = None if sitemap is not None else site.render(uri)
+                if sitemap is not None:
+                    body = sitemap
+                    request.setHeader(b'content-type', b'application/gzip' if uri.endswith('.gz') else b'application/xml')
+                elif page is None:
+                    counters['not_found'] += 1
+                    request.setResponseCode(404)
+                    body = b''
+                else:
+                    body = page.encode('utf-8')
+                    request.setHeader(b'content-type', b'text/html; charset=utf-8')
+                    if b'gzip' in (request.getHeader(b'accept-encoding') or b''):
+                        body = gzip.compress(body, 6)
+                        request.setHeader(b'content-encoding', b'gzip')
+            counters['bytes'] += len(body)
+
+            def respond():
+                request.write(body)
+                request.finish()
+
+            delay = max(0.0, latency + rng.uniform(-jitter, jitter))
+            call = task.deferLater(reactor, delay, respond)
+            request.notifyFinish().addErrback(lambda _: call.cancel())
+            return server.NOT_DONE_YET
+
+    class Control(LineReceiver):
+        delimiter = b'\n'
+
+        def connectionLost(self, reason):
+            reactor.stop()
+
+    listening = reactor.listenTCP(port, server.Site(Page()), interface='127.0.0.1')
+    print(f'http://127.0.0.1:{listening.getHost().port}', flush=True)
+    if until_stdin_closes:
+        stdio.StandardIO(Control())
+    reactor.run()
+
+
+def add_site_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the options of the site shape, latency and errors to ``parser``"""
+    parser.add_argument('--categories', type=int, default=10, help="number of categories")
+    parser.add_argument('--listing-pages', type=int, default=5, help="listing pages per category")
+    parser.add_argument('--products-per-page', type=int, default=20, help="products per listing page")
+    parser.add_argument('--review-pages', type=int, default=3, help="maximum review pages per product")
+    parser.add_argument('--reviews-per-page', type=int, default=20, help="reviews per review page")
+    parser.add_argument('--latency-ms', type=float, default=50, help="time taken by every response")
+    parser.add_argument('--jitter-ms', type=float, default=20, help="random variation of the latency")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests answered with an error")
+    parser.add_argument('--error-status', type=int, default=503, help="status of the error responses")
+    parser.add_argument('--retry-after', type=int, help="Retry-After header of the error responses, in seconds")
+    parser.add_argument('--storm', type=float, nargs=2, metavar=('START', 'DURATION'),
+                        help="answer every request with an error during this time, in seconds after the first request")
+    parser.add_argument('--sitemap-urls', type=int, default=50000, help="review pages per sitemap file")
+    parser.add_argument('--unlisted', type=int, default=0, help="products in the sitemaps but in no listing")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the generated content")
+
+
+def site_arguments(args: argparse.Namespace) -> list[str]:
+    """Command line options reproducing the site options of ``args``"""
+    return ['--categories', str(args.categories), '--listing-pages', str(args.listing_pages),
+            '--products-per-page', str(args.products_per_page), '--review-pages', str(args.review_pages),
+            '--reviews-per-page', str(args.reviews_per_page), '--latency-ms', str(args.latency_ms),
+            '--jitter-ms', str(args.jitter_ms), '--error-rate', str(args.error_rate),
+            '--error-status', str(args.error_status), '--seed', str(args.seed),
+            '--sitemap-urls', str(args.sitemap_urls), '--unlisted', str(args.unlisted),
+            *(['--retry-after', str(args.retry_after)] if args.retry_after is not None else []),
+            *(['--storm', *map(str, args.storm)] if args.storm else [])]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=8800, help="port to listen on (0 for any free port)")
+    add_site_arguments(parser)
+    # Internal: stop when the process that started the site closes our stdin
+    parser.add_argument('--until-stdin-closes', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    site = MockSite(args.categories, args.listing_pages, args.products_per_page, args.review_pages,
+                    args.reviews_per_page, args.seed, args.sitemap_urls, args.unlisted)
+    serve(site, args.port, args.latency_ms / 1000, args.jitter_ms / 1000, args.error_rate, args.error_status,
+          args.retry_after, args.storm, args.until_stdin_closes)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
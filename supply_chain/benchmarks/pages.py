@@ -0,0 +1,242 @@
+"""Synthetic Trustpilot-like pages.
+
+The markup mirrors what the spiders' selectors expect on fr.trustpilot.com
+(``categories`` container, ``categorylayout_leftSection``,
+``styles_reviewListContainer``, ``pagination-button-next`` and the
+``__NEXT_DATA__`` JSON blob), wrapped in enough surrounding noise to keep
+parsing costs realistic; ``sitemap_index`` and ``urlset`` render the XML
+sitemaps listing those pages. Content is generated from a seed so every run
+renders the same bytes.
+
+Regenerate the benchmark fixtures with:
+
+    python -m benchmarks.pages benchmarks/fixtures
+"""
+
+import gzip
+import html
+import json
+import os
+import random
+import sys
+from datetime import datetime, timedelta, timezone
+
+WORDS = (
+    "commande livraison produit qualité service client rapide colis reçu merci très bien "
+    "délai retour remboursement conforme prix site article taille parfait déçu problème "
+    "envoi emballage recommande satisfait attente réponse mail boutique vendeur suivi"
+).split()
+
+CATEGORY_NAMES = (
+    "Shopping & mode", "Animaux", "Banque & finance", "Beauté & bien-être", "Électronique",
+    "Maison & jardin", "Voyages & vacances", "Sports", "Alimentation & boissons", "Assurances",
+)
+
+PAGE_HEAD = '''<!DOCTYPE html><html lang="fr-FR"><head><meta charset="utf-8"/>
+<title>{title}</title><meta name="viewport" content="width=device-width"/>
+<link rel="stylesheet" href="/_next/static/css/app.css"/>
+<script src="/_next/static/chunks/main.js" defer=""></script></head>
+<body><div id="__next"><header class="styles_header__kEa1R"><nav class="styles_nav__Hd3Cb">
+<a href="/" class="link_internal__7XN06">Trustpilot</a><a href="/categories" class="link_internal__7XN06">Catégories</a>
+<a href="/blog" class="link_internal__7XN06">Blog</a></nav></header><main class="styles_main__Hk9zP">'''
+
+SITEMAP_HEAD = '<?xml version="1.0" encoding="UTF-8"?>\n'
+SITEMAP_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+PAGE_FOOT = '''</main><footer class="styles_footer__1oCqh"><ul>{links}</ul></footer></div>{script}</body></html>'''
+
+
+def _footer_links() -> str:
+    return ''.join(f'<li><a href="/page/{i}" class="link_footer__q8sZK">Lien {i}</a></li>' for i in range(30))
+
+
+def _sentence(rng: random.Random, low: int, high: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(low, high))).capitalize()
+
+
+def _pagination(base_path: str, page: int, pages: int) -> str:
+    links = []
+    if page > 1:
+        links.append(f'<a name="pagination-button-previous" href="{base_path}?page={page - 1}" class="pagination-link_previous__VXY3m">Précédent</a>')
+    else:
+        links.append('<a name="pagination-button-previous" aria-disabled="true" class="pagination-link_disabled__mnD0y">Précédent</a>')
+    for number in range(1, min(pages, 5) + 1):
+        links.append(f'<a name="pagination-button-{number}" href="{base_path}?page={number}" class="pagination-link_item__mkuN3">{number}</a>')
+    if pages > 5:
+        links.append(f'<a name="pagination-button-{pages}" href="{base_path}?page={pages}" class="pagination-link_item__mkuN3">{pages}</a>')
+    if page < pages:
+        links.append(f'<a name="pagination-button-next" href="{base_path}?page={page + 1}" class="pagination-link_next__SDNU4">Suivant</a>')
+    else:
+        links.append('<a name="pagination-button-next" aria-disabled="true" class="pagination-link_disabled__mnD0y">Suivant</a>')
+    return f'<nav class="pagination_pagination___F1qS" aria-label="Pagination">{"".join(links)}</nav>'
+
+
+def synthetic_categories(count: int, seed: int = 0) -> list[dict]:
+    rng = random.Random(seed)
+    categories = []
+    for index in range(count):
+        name = CATEGORY_NAMES[index % len(CATEGORY_NAMES)]
+        if index >= len(CATEGORY_NAMES):
+            name = f"{name} {index // len(CATEGORY_NAMES)}"
+        categories.append({'slug': f"{rng.choice(WORDS)}_{index}", 'name': name})
+    return categories
+
+
+def synthetic_products(category_slug: str, page: int, count: int) -> list[str]:
+    return [f"www.{category_slug.replace('_', '-')}-{page}-{index}.fr" for index in range(count)]
+
+
+def synthetic_reviews(product_slug: str, page: int, count: int, newest: datetime | None = None,
+                      seed: int = 0) -> list[dict]:
+    """Reviews of one page, most recent first, one day apart"""
+    rng = random.Random(f"{seed}-{product_slug}-{page}")
+    newest = newest or datetime(2025, 6, 1, tzinfo=timezone.utc)
+    reviews = []
+    for index in range(count):
+        published = newest - timedelta(days=(page - 1) * count + index, minutes=rng.randint(0, 600))
+        reviews.append({
+            'id': f"{rng.getrandbits(48):012x}",
+            'datetime': published.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            'rating': rng.randint(1, 5),
+            'title': _sentence(rng, 2, 7),
+            'paragraphs': [_sentence(rng, 6, 30) + '.' for _ in range(rng.randint(1, 3))],
+            'consumer': f"Client {rng.randint(1, 9999)}",
+        })
+    return reviews
+
+
+def categories_page(categories: list[dict]) -> str:
+    """Render the /categories index"""
+    cards = ''.join(
+        f'''<div class="styles_card__8pA3e"><h2 class="typography_heading-xs__osRhC">'''
+        f'''<a href="/categories/{c['slug']}" class="link_internal__7XN06 styles_headingLink__Vxkp3">{html.escape(c['name'])}</a></h2></div>'''
+        for c in categories
+    )
+    body = f'<div class="categories_categoriesDesktop__wXbTd"><h1>Catégories</h1>{cards}</div>'
+    return PAGE_HEAD.format(title="Catégories") + body + PAGE_FOOT.format(links=_footer_links(), script='')
+
+
+def listing_page(category_slug: str, category_name: str, products: list[str], page: int, pages: int) -> str:
+    """Render one page of a category listing"""
+    cards = ''.join(
+        f'''<div class="paper_paper__EGeEb card_card__yyGgu styles_card__WMwue"><a href="/review/{slug}" '''
+        f'''class="link_internal__7XN06 link_wrapper__ahpyq styles_linkWrapper___KcIq" name="business-unit-card">'''
+        f'''<div class="styles_businessUnitMain__PuwB7"><p class="typography_heading-xs__osRhC">{html.escape(slug)}</p>'''
+        f'''<div class="styles_rating__pY5Pk"><img alt="TrustScore 4 sur 5" src="/stars-4.svg"/>'''
+        f'''<p class="typography_body-m__k2UI7">TrustScore <span>4,2</span> | {(index + 1) * 37} avis</p></div></div></a></div>'''
+        for index, slug in enumerate(products)
+    )
+    body = (
+        f'<div class="categorylayout_leftSection__TSHrc"><h1>{html.escape(category_name)}</h1>'
+        f'<div class="styles_businessUnitCardsContainer__1ggaO">{cards}</div>'
+        f'{_pagination(f"/categories/{category_slug}", page, pages)}</div>'
+        f'<div class="categorylayout_rightSection__kGzU3"><a href="/categories">Toutes les catégories</a></div>'
+    )
+    return PAGE_HEAD.format(title=html.escape(category_name)) + body + PAGE_FOOT.format(links=_footer_links(), script='')
+
+
+def review_page(product_slug: str, reviews: list[dict], page: int, pages: int, next_data: bool = True) -> str:
+    """Render one page of a product's reviews, with the __NEXT_DATA__ blob when ``next_data``"""
+    articles = []
+    for review in reviews:
+        paragraphs = '<br/>'.join(html.escape(p) for p in review['paragraphs'])
+        articles.append(
+            f'''<div class="styles_cardWrapper__LcCPA"><article class="paper_paper__EGeEb card_card__yyGgu styles_reviewCard__9HxJJ" data-service-review-card-paper="true">'''
+            f'''<div class="styles_reviewCardInner__EwDq2"><aside class="styles_consumerInfoWrapper__KP3Ra">'''
+            f'''<a href="/users/{review['id']}" class="link_internal__7XN06"><span class="typography_heading-xxs__QKBS8">{html.escape(review['consumer'])}</span></a>'''
+            f'''<div class="styles_consumerExtraDetails__fxS4S"><span>FR</span><span>1 avis</span></div></aside>'''
+            f'''<section class="styles_reviewContentwrapper__zH_9M">'''
+            f'''<div class="styles_reviewHeader__iU9Px" data-service-review-rating="{review['rating']}">'''
+            f'''<div class="star-rating_starRating__4rrcf"><img alt="Noté {review['rating']} sur 5 étoiles" src="/stars-{review['rating']}.svg"/></div>'''
+            f'''<div class="styles_reviewCardInnerHeader__8Xqy8 typography_body-m__k2UI7"><time datetime="{review['datetime']}" class="">{review['datetime'][:10]}</time></div></div>'''
+            f'''<div class="styles_reviewContent__0Q2Tg" aria-hidden="false" data-review-content="true">'''
+            f'''<a href="/reviews/{review['id']}" class="link_internal__7XN06"><h2 class="typography_heading-s__f7029">{html.escape(review['title'])}</h2></a>'''
+            f'''<p class="typography_body-l__KUYFJ" data-service-review-text-typography="true">{paragraphs}</p></div>'''
+            f'''<p class="typography_body-m__k2UI7"><b>Date de l&#x27;expérience:</b> {review['datetime'][:10]}</p></section>'''
+            f'''<div class="styles_reviewActions__kGJ5S"><button>Utile</button><button>Partager</button></div></div></article></div>'''
+        )
+
+    script = ''
+    if next_data:
+        data = {'props': {'pageProps': {
+            'businessUnit': {'identifyingName': product_slug},
+            'reviews': [{
+                'id': review['id'],
+                'title': review['title'],
+                'text': '\n'.join(review['paragraphs']),
+                'rating': review['rating'],
+                'dates': {'publishedDate': review['datetime'], 'experiencedDate': review['datetime']},
+                'consumer': {'displayName': review['consumer']},
+            } for review in reviews],
+            'filters': {'pagination': {'currentPage': page, 'totalPages': pages}},
+        }}, 'page': '/review/[businessUnit]'}
+        script = f'<script id="__NEXT_DATA__" type="application/json">{json.dumps(data, ensure_ascii=False)}</script>'
+
+    body = (
+        f'<div class="styles_mainContent__nFxAv"><section class="styles_summary__gmy82"><h1>{html.escape(product_slug)}</h1></section>'
+        f'<section class="styles_reviewListContainer__2bg_p" aria-disabled="false">{"".join(articles)}'
+        f'{_pagination(f"/review/{product_slug}", page, pages)}</section></div>'
+    )
+    return PAGE_HEAD.format(title=html.escape(product_slug)) + body + PAGE_FOOT.format(links=_footer_links(), script=script)
+
+
+def sitemap_index(urls) -> str:
+    """Render a sitemap index of the sitemaps at ``urls``"""
+    entries = ''.join(f'<sitemap><loc>{html.escape(url)}</loc><lastmod>2025-06-01</lastmod></sitemap>\n' for url in urls)
+    return f'{SITEMAP_HEAD}<sitemapindex xmlns="{SITEMAP_NS}">\n{entries}</sitemapindex>\n'
+
+
+def urlset(urls) -> str:
+    """Render a sitemap of the pages at ``urls``"""
+    entries = ''.join(
+        f'<url><loc>{html.escape(url)}</loc><lastmod>2025-06-01</lastmod><changefreq>daily</changefreq></url>\n'
+        for url in urls
+    )
+    return f'{SITEMAP_HEAD}<urlset xmlns="{SITEMAP_NS}">\n{entries}</urlset>\n'
+
+
+def write_fixtures(directory: str) -> None:
+    """Write the benchmark fixtures and their manifest"""
+    os.makedirs(directory, exist_ok=True)
+    base_url = "https://fr.trustpilot.com"
+    categories = synthetic_categories(120)
+    category = {'slug': 'shopping_fashion', 'name': 'Shopping & mode'}
+    product_slug = 'www.example-boutique.fr'
+
+    pages = {
+        'categories.html': categories_page(categories),
+        'listing.html': listing_page(category['slug'], category['name'],
+                                     synthetic_products(category['slug'], 2, 20), page=2, pages=12),
+        'reviews.html': review_page(product_slug, synthetic_reviews(product_slug, 1, 20), page=1, pages=8),
+    }
+    for name, body in pages.items():
+        with open(os.path.join(directory, name), 'w', encoding='utf-8') as f:
+            f.write(body)
+
+    # Sitemaps of the categories above, the index pointing to its sitemap relatively so it can be read
+    # from this directory (SITEMAP_URLS=file://.../sitemap.xml)
+    product_urls = [f"{base_url}/review/{slug}" for c in categories for page in range(1, 3)
+                    for slug in synthetic_products(c['slug'], page, 20)]
+    with open(os.path.join(directory, 'sitemap.xml'), 'w', encoding='utf-8') as f:
+        f.write(sitemap_index(['sitemap-products-1.xml.gz']))
+    with open(os.path.join(directory, 'sitemap-products-1.xml.gz'), 'wb') as f:
+        f.write(gzip.compress(urlset([f"{base_url}/categories", *product_urls]).encode('utf-8'), mtime=0))
+
+    manifest = [
+        {'file': 'categories.html', 'url': f"{base_url}/categories",
+         'spider': 'get_categories', 'callback': 'parse_categories', 'cb_kwargs': {}},
+        {'file': 'listing.html', 'url': f"{base_url}/categories/{category['slug']}?page=2",
+         'spider': 'get_products', 'callback': 'get_products',
+         'cb_kwargs': {'category_slug': category['slug'], 'category_name': category['name']}},
+        {'file': 'reviews.html', 'url': f"{base_url}/review/{product_slug}",
+         'spider': 'get_reviews', 'callback': 'get_reviews',
+         'cb_kwargs': {'category_slug': category['slug'], 'category_name': category['name'], 'product_slug': product_slug}},
+        {'file': 'sitemap-products-1.xml.gz', 'url': f"{base_url}/sitemap-products-1.xml.gz",
+         'spider': 'get_products_sitemap', 'callback': 'parse_sitemap', 'cb_kwargs': {}},
+    ]
+    with open(os.path.join(directory, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    write_fixtures(sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), 'fixtures'))
@@ -0,0 +1,198 @@
+"""Offline benchmark of the spiders' parse callbacks.
+
+Replays the pages listed in ``fixtures/manifest.json`` (HTML pages and a
+gzipped sitemap) as ``HtmlResponse`` objects through the callbacks of the
+real spiders (their checkpoint updates dropped, so only parsing is timed),
+then writes the parsed reviews with the storage pipelines' batch writers (the
+work they do in the thread pool), and reports pages/sec, items/sec and memory
+per case: peak and retained KiB, and the number of blocks a page leaves
+allocated (tracemalloc block counts). No request leaves the machine.
+
+Run from the project directory (where scrapy.cfg lives):
+
+    python -m benchmarks.parsers
+    python -m benchmarks.parsers --save-baseline benchmarks/baseline.json
+    python -m benchmarks.parsers --baseline benchmarks/baseline.json --max-regression 0.2
+
+Pages saved from fr.trustpilot.com can be benchmarked too: drop them in a
+directory with a manifest in the same format and pass ``--fixtures``.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from scrapy.utils.reactor import install_reactor
+
+install_reactor("twisted.internet.asyncioreactor.AsyncioSelectorReactor")
+
+from scrapy import Request  # noqa: E402
+from scrapy.http import HtmlResponse  # noqa: E402
+from scrapy.spiderloader import SpiderLoader  # noqa: E402
+from scrapy.utils.project import get_project_settings  # noqa: E402
+from scrapy.utils.test import get_crawler  # noqa: E402
+
+from supply_chain.budget import PageBudget  # noqa: E402
+from supply_chain.catalog import ProductCatalog  # noqa: E402
+from supply_chain.checkpoints import CheckpointStore  # noqa: E402
+from supply_chain.pipelines import JsonLinesStoragePipeline, ReviewsCsvPipeline  # noqa: E402
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def load_cases(fixtures_dir: str) -> list[dict]:
+    with open(os.path.join(fixtures_dir, 'manifest.json'), 'r', encoding='utf-8') as f:
+        cases = json.load(f)
+    for case in cases:
+        with open(os.path.join(fixtures_dir, case['file']), 'rb') as f:
+            case['body'] = f.read()
+    return cases
+
+
+class ReadOnlyCheckpointStore(CheckpointStore):
+    """Checkpoint store dropping every update, so the cases time the callbacks without the SQLite writes"""
+
+    def _update(self, method, *args):
+        return None
+
+
+def make_spider(name: str, settings: dict, workdir: str):
+    spidercls = SpiderLoader.from_settings(get_project_settings()).load(name)
+    crawler = get_crawler(spidercls, settings)
+    spider = spidercls.from_crawler(crawler)
+    crawler.spider = spider
+    # Stores normally opened in start()
+    if hasattr(spider, 'checkpoints'):
+        spider.checkpoints = ReadOnlyCheckpointStore(os.path.join(workdir, 'checkpoints.sqlite3'))
+    if hasattr(spider, 'catalog'):
+        spider.catalog = ProductCatalog(os.path.join(workdir, 'catalog.sqlite3'))
+    if hasattr(spider, 'budget'):
+        spider.budget = PageBudget(max_pages=crawler.settings.getint('REVIEWS_MAX_PAGES', 5))
+    return spider
+
+
+def run_case(spider, case: dict) -> list:
+    request = Request(case['url'], cb_kwargs=case['cb_kwargs'])
+    response = HtmlResponse(url=case['url'], body=case['body'], encoding='utf-8', request=request)
+    output = getattr(spider, case['callback'])(response, **case['cb_kwargs'])
+    return [result for result in (output or []) if not isinstance(result, Request)]
+
+
+def measure(func, iterations: int) -> dict:
+    """Time ``func`` over ``iterations`` calls, then trace the memory and blocks of one more call"""
+    items = 0
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    for _ in range(iterations):
+        items += func()
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+
+    tracemalloc.start()
+    # Taken first: the snapshot is not counted in the memory traced around the call
+    snapshot = tracemalloc.take_snapshot()
+    before, _ = tracemalloc.get_traced_memory()
+    func()
+    after, peak = tracemalloc.get_traced_memory()
+    untraced = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    blocks = sum(stat.count_diff for stat in tracemalloc.take_snapshot().filter_traces(untraced).compare_to(
+        snapshot.filter_traces(untraced), 'filename'))
+    tracemalloc.stop()
+
+    return {
+        'pages_per_sec': iterations / wall,
+        'items_per_sec': items / wall,
+        'cpu_ms_per_page': cpu * 1000 / iterations,
+        'peak_kib': (peak - before) / 1024,
+        'retained_kib': max(after - before, 0) / 1024,
+        'retained_blocks': max(blocks, 0),
+    }
+
+
+def run(fixtures_dir: str, iterations: int) -> dict:
+    results = {}
+    settings = get_project_settings().copy_to_dict()
+    cases = load_cases(fixtures_dir)
+    cwd = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # Callbacks and pipelines write relative to the working directory
+        os.chdir(workdir)
+        try:
+            for case in cases:
+                spider = make_spider(case['spider'], settings, workdir)
+                results[case['callback']] = measure(lambda: len(run_case(spider, case)), iterations)
+
+                if case['spider'] != 'get_reviews':
+                    continue
+                items = run_case(spider, case)
+                pipelines = [cls.from_crawler(spider.crawler) for cls in (JsonLinesStoragePipeline, ReviewsCsvPipeline)]
+                targets = [(pipeline, pipeline.target(items[0])) for pipeline in pipelines]
+                for pipeline, key in targets:
+                    pipeline.open_target(key)
+
+                def store_page():
+                    for pipeline, key in targets:
+                        pipeline.write_batch(key, items)
+                    return len(items)
+
+                results['storage:reviews'] = measure(store_page, iterations)
+                for pipeline, key in targets:
+                    pipeline.close_target(key)
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+def report(results: dict, baseline: dict | None, max_regression: float) -> bool:
+    """Print the results table, return False when a case regressed past the threshold"""
+    ok = True
+    print(f"{'case':<18}{'pages/s':>10}{'items/s':>11}{'cpu ms/page':>13}{'peak KiB':>10}{'retained KiB':>14}{'retained blocks':>17}  vs baseline")
+    for name, result in results.items():
+        line = (f"{name:<18}{result['pages_per_sec']:>10.1f}{result['items_per_sec']:>11.1f}"
+                f"{result['cpu_ms_per_page']:>13.2f}{result['peak_kib']:>10.1f}{result['retained_kib']:>14.1f}"
+                f"{result['retained_blocks']:>17}")
+        if baseline and name in baseline:
+            change = result['pages_per_sec'] / baseline[name]['pages_per_sec'] - 1
+            line += f"  {change:+.1%}"
+            if change < -max_regression:
+                line += "  REGRESSION"
+                ok = False
+        print(line)
+    return ok
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--fixtures', default=FIXTURES_DIR, help="directory holding manifest.json and the pages")
+    parser.add_argument('--iterations', type=int, default=200, help="pages parsed per case")
+    parser.add_argument('--baseline', help="JSON results to compare against")
+    parser.add_argument('--save-baseline', help="write the results to this JSON file")
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help="fail when pages/sec drops by more than this fraction of the baseline")
+    args = parser.parse_args(argv)
+
+    # Keep per-page spider logging out of the measurements
+    logging.disable(logging.WARNING)
+
+    results = run(args.fixtures, args.iterations)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    ok = report(results, baseline, args.max_regression)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
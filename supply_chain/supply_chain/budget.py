@@ -0,0 +1,85 @@
+"""Review page budget of a crawl run.
+
+``get_reviews`` used to stop every product at page 5. ``PageBudget`` instead
+shares a total number of review pages (``REVIEWS_BUDGET``, or ``-a budget=N``)
+between products:
+
+- the first page of every product scheduled is reserved up front, so a tight
+  budget still reaches as many products as it can;
+- a next page is only requested if the current page was worth it. A page's
+  value is its number of new reviews, each weighted by its recency (halved
+  every ``REVIEWS_RECENCY_HALF_LIFE_DAYS``). The less budget is left, the more
+  a page must be worth compared to the average page seen so far. Large,
+  active products keep paginating while small or dormant ones stop early.
+
+``REVIEWS_MAX_PAGES`` (``-a max_pages=N``) still caps the pages of any product;
+0 disables the cap, as 0 for the budget means unlimited.
+"""
+
+from datetime import datetime, timezone
+
+
+class PageBudget:
+
+    def __init__(self, total: int = 0, max_pages: int = 0, half_life_days: float = 30):
+        self.total = max(0, int(total))
+        self.max_pages = max(0, int(max_pages))
+        self.half_life_days = half_life_days
+        self.spent = 0
+        self.reserved = 0
+        # Free pages when the crawl started, the reference for the budget pressure
+        self.initial_free = self.total
+        self.pages_valued = 0
+        self.mean_value = 0.0
+        self._now = datetime.now(timezone.utc)
+
+    @property
+    def free(self) -> int:
+        """Pages left for next pages, once the reserved first pages are set aside"""
+        return self.total - self.spent - self.reserved
+
+    def reserve(self, products: int) -> None:
+        """Set aside the first page of ``products`` products about to be scheduled"""
+        if self.total:
+            self.reserved += max(0, min(products, self.free))
+            self.initial_free = self.free
+
+    def start(self) -> bool:
+        """Take the first page of a product, return False once the budget is spent"""
+        if self.reserved:
+            self.reserved -= 1
+        elif self.total and self.free <= 0:
+            return False
+        self.spent += 1
+        return True
+
+    def page_value(self, review_datetimes: list[str]) -> float:
+        """Return the value of a page from the datetimes of its new reviews"""
+        value = 0.0
+        for review_datetime in review_datetimes:
+            try:
+                age_days = (self._now - datetime.fromisoformat(review_datetime)).total_seconds() / 86400
+            except (TypeError, ValueError):
+                age_days = 0
+            value += 0.5 ** (max(age_days, 0) / self.half_life_days)
+        return value
+
+    def next_page(self, page: int, value: float) -> bool:
+        """Decide whether the page after ``page`` deserves a request, given the value of ``page``"""
+        self.pages_valued += 1
+        self.mean_value += (value - self.mean_value) / self.pages_valued
+
+        if self.max_pages and page >= self.max_pages:
+            return False
+        if not self.total:
+            self.spent += 1
+            return True
+        if self.free <= 0:
+            return False
+
+        # No bar while the budget is untouched, the average page value once it is nearly spent
+        pressure = 1 - self.free / self.initial_free if self.initial_free else 1
+        if value < self.mean_value * pressure:
+            return False
+        self.spent += 1
+        return True
@@ -0,0 +1,238 @@
+"""Compact catalog of the products and categories found so far.
+
+The spiders used to load the whole product_links store (one nested dict per
+product, category strings repeated on every record) and category_links.json
+to pick what to crawl. The catalog (``CATALOG_PATH``) keeps them in SQLite
+instead:
+
+- ``categories``: one row per category, products point to its integer id
+- ``products``: slug, category id and the product link when it is not the
+  usual ``/review/<slug>``, in the order they were stored; products found in
+  a sitemap are in the empty category until a listing gives theirs
+- ``unlisted``: products found in the sitemaps but in no category listing
+
+``sync`` only reads the part of the product_links store appended since the
+previous sync (its byte offset is kept in ``meta``), so opening the catalog
+costs the same whatever the number of products. ``queue`` selects the
+products to crawl in SQL, joined with the checkpoint store, into a temporary
+table that ``queued`` reads in small batches: nothing is held in memory per
+product. Reads go through SQLite's memory map.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+
+from supply_chain.sharding import shard_of
+from supply_chain.storage import iter_lines, legacy_path, store_exists
+
+logger = logging.getLogger(__name__)
+
+ORDERS = {
+    'category': 'c.slug, p.id',
+    'file': 'p.id',
+    'random': 'random()',
+}
+
+
+class ProductCatalog:
+
+    def __init__(self, path: str = 'catalog.sqlite3', mmap_bytes: int = 256 * 1024 * 1024):
+        self.path = path
+        self.db = sqlite3.connect(path, isolation_level=None, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(f'PRAGMA mmap_size={int(mmap_bytes)}')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS categories (
+                id INTEGER PRIMARY KEY,
+                slug TEXT NOT NULL UNIQUE,
+                name TEXT NOT NULL,
+                link TEXT,
+                position INTEGER
+            )
+        ''')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS products (
+                id INTEGER PRIMARY KEY,
+                slug TEXT NOT NULL UNIQUE,
+                category_id INTEGER NOT NULL,
+                link TEXT
+            )
+        ''')
+        self.db.execute('CREATE TABLE IF NOT EXISTS unlisted (slug TEXT PRIMARY KEY) WITHOUT ROWID')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value) WITHOUT ROWID')
+        self.db.create_function('shard_of', 2, shard_of, deterministic=True)
+        self._category_ids: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return self.db.execute('SELECT count(*) FROM products').fetchone()[0]
+
+    def _meta(self, key: str, default=None):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key: str, value) -> None:
+        self.db.execute('''
+            INSERT INTO meta (key, value) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        ''', (key, value))
+
+    def _category_id(self, slug: str, name: str) -> int:
+        category_id = self._category_ids.get(slug)
+        if category_id is None:
+            self.db.execute('INSERT OR IGNORE INTO categories (slug, name) VALUES (?, ?)', (slug, name))
+            category_id = self.db.execute('SELECT id FROM categories WHERE slug = ?', (slug,)).fetchone()[0]
+            self._category_ids[slug] = category_id
+        return category_id
+
+    def _add_products(self, records) -> int:
+        added = 0
+        for record in records:
+            for slug, product in record.items():
+                link = product.get('product_link')
+                category_id = self._category_id(product.get('category_slug') or '', product.get('category_name') or '')
+                inserted = self.db.execute(
+                    'INSERT OR IGNORE INTO products (slug, category_id, link) VALUES (?, ?, ?)',
+                    (slug, category_id, None if link == f'/review/{slug}' else link)
+                ).rowcount
+                if not inserted and product.get('category_slug'):
+                    # Stored again by a listing once found in a sitemap: attach its category
+                    self.db.execute('UPDATE products SET category_id = ? WHERE slug = ? AND category_id = ?',
+                                    (category_id, slug, self._category_id('', '')))
+                added += inserted
+        return added
+
+    def sync(self, directory: str = '.') -> int:
+        """Add the products appended to the product_links store since the last sync, return their number"""
+        # IMMEDIATE: processes starting together (shards) sync one after the other
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            if store_exists('product_links', directory):
+                added = self._sync_store(directory)
+            else:
+                added = self._sync_legacy(directory)
+            self.db.execute('COMMIT')
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            self._category_ids.clear()
+            raise
+        return added
+
+    def _sync_store(self, directory: str) -> int:
+        offset = self._meta('products_offset', 0)
+        added = 0
+        for line, offset in iter_lines('product_links', directory, offset):
+            if not line.strip():
+                continue
+            try:
+                added += self._add_products([json.loads(line)])
+            except json.JSONDecodeError:
+                logger.warning("Skipping invalid JSON line in the product_links store of %s", directory)
+        self._set_meta('products_offset', offset)
+        return added
+
+    def _sync_legacy(self, directory: str) -> int:
+        path = legacy_path('product_links', directory)
+        if not os.path.exists(path) or self._meta('legacy_imported'):
+            return 0
+        with open(path, 'r', encoding='utf-8') as f:
+            added = self._add_products(json.load(f))
+        self._set_meta('legacy_imported', 1)
+        return added
+
+    def sync_categories(self, path: str = 'category_links.json') -> int:
+        """Load a category_links.json file when it changed since the last sync, return its number of categories"""
+        stat = os.stat(path)
+        version = f'{stat.st_size}:{stat.st_mtime_ns}'
+        if self._meta('categories_version') == version:
+            return 0
+        with open(path, 'r', encoding='utf-8') as f:
+            categories = json.load(f)
+
+        with self.db:
+            self.db.execute('BEGIN IMMEDIATE')
+            self.db.execute('UPDATE categories SET position = NULL')
+            for position, category in enumerate(categories):
+                self.db.execute('''
+                    INSERT INTO categories (slug, name, link, position) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(slug) DO UPDATE SET name = excluded.name, link = excluded.link,
+                                                    position = excluded.position
+                ''', (category['slug'], category['name'], category['link'], position))
+            self._set_meta('categories_version', version)
+        return len(categories)
+
+    def categories(self):
+        """Yield the categories of the last category_links.json synced, in its order"""
+        rows = self.db.execute('SELECT link, name, slug FROM categories WHERE position IS NOT NULL ORDER BY position')
+        for link, name, slug in rows:
+            yield {'link': link, 'name': name, 'slug': slug}
+
+    def known(self, slug: str) -> bool:
+        """True when a product is in the catalog or recorded as unlisted"""
+        return self.db.execute('''
+            SELECT EXISTS (SELECT 1 FROM products WHERE slug = ?) OR EXISTS (SELECT 1 FROM unlisted WHERE slug = ?)
+        ''', (slug, slug)).fetchone()[0] == 1
+
+    def uncategorized(self) -> set[str]:
+        """Return the products without a category that are not recorded as unlisted"""
+        return {slug for (slug,) in self.db.execute('''
+            SELECT p.slug FROM products p JOIN categories c ON c.id = p.category_id
+            WHERE c.slug = '' AND p.slug NOT IN (SELECT slug FROM unlisted)
+        ''')}
+
+    def add_unlisted(self, slugs) -> None:
+        """Record products that no category listing shows"""
+        with self.db:
+            self.db.execute('BEGIN')
+            self.db.executemany('INSERT OR IGNORE INTO unlisted (slug) VALUES (?)', ((slug,) for slug in slugs))
+
+    def clear_unlisted(self) -> None:
+        self.db.execute('DELETE FROM unlisted')
+
+    def queue(self, checkpoints_path: str, order: str = 'category', refresh: bool = False,
+              shard: int = 0, shards: int = 1) -> int:
+        """Select the products left to review into the queue read by ``queued``, return their number
+
+        Reviewed products are only selected with ``refresh``, from their first
+        page; the others start at their checkpointed next page.
+        """
+        self.db.execute('DROP TABLE IF EXISTS temp.queue')
+        self.db.execute('CREATE TEMP TABLE queue (position INTEGER PRIMARY KEY, product_id INTEGER, next_page INTEGER)')
+        self.db.execute('ATTACH DATABASE ? AS checkpoints', (checkpoints_path,))
+        try:
+            self.db.execute(f'''
+                INSERT INTO temp.queue (product_id, next_page)
+                SELECT p.id, CASE WHEN ck.done THEN 1 ELSE coalesce(ck.next_page, 1) END
+                FROM products p
+                JOIN categories c ON c.id = p.category_id
+                LEFT JOIN checkpoints.products ck ON ck.slug = p.slug
+                WHERE (? OR NOT coalesce(ck.done, 0)) AND (? <= 1 OR shard_of(p.slug, ?) = ?)
+                ORDER BY {ORDERS[order]}
+            ''', (refresh, shards, shards, shard))
+        finally:
+            self.db.execute('DETACH DATABASE checkpoints')
+        return self.db.execute('SELECT count(*) FROM temp.queue').fetchone()[0]
+
+    def queued(self, batch: int = 500):
+        """Yield ``(product record, next page)`` for every queued product, in the queue order"""
+        position = 0
+        while True:
+            rows = self.db.execute('''
+                SELECT q.position, p.slug, coalesce(p.link, '/review/' || p.slug), c.slug, c.name, q.next_page
+                FROM temp.queue q
+                JOIN products p ON p.id = q.product_id
+                JOIN categories c ON c.id = p.category_id
+                WHERE q.position > ?
+                ORDER BY q.position
+                LIMIT ?
+            ''', (position, batch)).fetchall()
+            if not rows:
+                return
+            for position, slug, link, category_slug, category_name, next_page in rows:
+                product = {'product_link': link, 'category_slug': category_slug, 'category_name': category_name}
+                yield {slug: product}, next_page
+
+    def close(self) -> None:
+        self.db.close()
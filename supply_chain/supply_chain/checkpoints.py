@@ -0,0 +1,434 @@
+"""Crash-safe crawl progress shared by the spiders.
+
+Progress is kept in a small SQLite database (``CHECKPOINT_PATH``) with one row
+per category and per product:
+
+- ``next_page``: first page that has not been parsed yet
+- ``done``: every page has been parsed
+
+and, in ``review_marks``, the most recent review ``datetime`` collected for
+each product, used to stop re-crawls as soon as pages only hold known reviews.
+
+Listing pages fetched in parallel finish out of order, so once the page count
+of a row is known (``set_page_count``) its pages are also recorded one by one
+(``mark_page``): ``next_page`` is then the lowest page not parsed yet, and the
+row is done when every page is.
+
+The items of a page are written in batches by the item pipelines, well after
+the page is parsed, so during a crawl the updates are held in memory
+(``hold``) and ``HeldState`` commits them, together with the dedupe index,
+only once every batch holding the items parsed before them is written. A
+crash never records progress whose items were lost: the next run parses the
+pages since the last commit again, the writers skipping the items they had
+already written (see supply_chain/dedupe.py), and resumes at ``next_page``
+instead of rescanning whole files.
+"""
+
+import csv
+import json
+import logging
+import os
+import sqlite3
+import time
+from urllib.parse import urlparse, parse_qs
+
+from twisted.internet import defer, task
+
+logger = logging.getLogger(__name__)
+
+TABLES = ('categories', 'products')
+
+
+def page_from_url(url: str) -> int | None:
+    """Return the ``page`` query parameter of a listing URL, None when absent"""
+    page_vals = parse_qs(urlparse(url).query).get('page')
+    if page_vals and page_vals[0].isdigit():
+        return int(page_vals[0])
+    return None
+
+
+def page_url(url: str, page: int) -> str:
+    """Return the URL of a given page of a listing, page 1 being the bare URL"""
+    return url if page <= 1 else f"{url}?page={page}"
+
+
+class CheckpointStore:
+
+    def __init__(self, path: str = 'checkpoints.sqlite3'):
+        self.path = path
+        self.db = sqlite3.connect(path, isolation_level=None, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        # Updates waiting for commit_held, None when they are committed immediately
+        self._held: list | None = None
+        for table in TABLES:
+            self.db.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table} (
+                    slug TEXT PRIMARY KEY,
+                    next_page INTEGER NOT NULL DEFAULT 1,
+                    done INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL
+                ) WITHOUT ROWID
+            ''')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS page_counts (
+                tbl TEXT NOT NULL,
+                slug TEXT NOT NULL,
+                pages INTEGER NOT NULL,
+                PRIMARY KEY (tbl, slug)
+            ) WITHOUT ROWID
+        ''')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS pages_done (
+                tbl TEXT NOT NULL,
+                slug TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                PRIMARY KEY (tbl, slug, page)
+            ) WITHOUT ROWID
+        ''')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS review_marks (
+                slug TEXT PRIMARY KEY,
+                latest TEXT NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        # One-time imports already done
+        self.db.execute('CREATE TABLE IF NOT EXISTS imports (name TEXT PRIMARY KEY) WITHOUT ROWID')
+
+    def progress(self, table: str) -> dict[str, tuple[int, bool]]:
+        """Return ``{slug: (next_page, done)}`` for every known row of a table"""
+        rows = self.db.execute(f'SELECT slug, next_page, done FROM {table}')
+        return {slug: (next_page, bool(done)) for slug, next_page, done in rows}
+
+    def slug_progress(self, table: str, slug: str) -> tuple[int, bool]:
+        """Return ``(next_page, done)`` of one row, ``(1, False)`` when it is unknown"""
+        row = self.db.execute(f'SELECT next_page, done FROM {table} WHERE slug = ?', (slug,)).fetchone()
+        return (row[0], bool(row[1])) if row else (1, False)
+
+    def done(self, table: str) -> set[str]:
+        return {slug for (slug,) in self.db.execute(f'SELECT slug FROM {table} WHERE done = 1')}
+
+    def hold(self) -> None:
+        """Keep the updates from now on in memory until ``commit_held``; reads do not see them"""
+        if self._held is None:
+            self._held = []
+
+    @property
+    def held(self) -> int:
+        """Number of updates waiting for ``commit_held``"""
+        return len(self._held) if self._held else 0
+
+    def commit_held(self, count: int | None = None) -> None:
+        """Apply the first ``count`` held updates (all of them by default) in one transaction"""
+        updates = self._held[:count] if self._held else []
+        if not updates:
+            return
+        del self._held[:count]
+        with self.db:
+            self.db.execute('BEGIN')
+            for method, args in updates:
+                method(*args)
+
+    def drop_held(self) -> None:
+        if self._held:
+            self._held.clear()
+
+    def _update(self, method, *args):
+        """Run an update in its own transaction, or hold it"""
+        if self._held is not None:
+            self._held.append((method, args))
+            return None
+        with self.db:
+            self.db.execute('BEGIN')
+            return method(*args)
+
+    def set_page(self, table: str, slug: str, next_page: int) -> None:
+        self._update(self._set_page, table, slug, next_page)
+
+    def _set_page(self, table: str, slug: str, next_page: int) -> None:
+        self.db.execute(f'''
+            INSERT INTO {table} (slug, next_page, done, updated_at) VALUES (?, ?, 0, ?)
+            ON CONFLICT(slug) DO UPDATE SET next_page = excluded.next_page, updated_at = excluded.updated_at
+        ''', (slug, next_page, time.time()))
+
+    def finish(self, table: str, slug: str) -> None:
+        self._update(self._finish, table, slug)
+
+    def _finish(self, table: str, slug: str) -> None:
+        self.db.execute(f'''
+            INSERT INTO {table} (slug, next_page, done, updated_at) VALUES (?, 1, 1, ?)
+            ON CONFLICT(slug) DO UPDATE SET done = 1, updated_at = excluded.updated_at
+        ''', (slug, time.time()))
+
+    def reset(self, table: str) -> None:
+        self.db.execute(f'DELETE FROM {table}')
+        self.db.execute('DELETE FROM page_counts WHERE tbl = ?', (table,))
+        self.db.execute('DELETE FROM pages_done WHERE tbl = ?', (table,))
+
+    def page_counts(self, table: str) -> dict[str, tuple[int, set[int]]]:
+        """Return ``{slug: (page count, parsed pages)}`` for the rows whose page count is known"""
+        counts = {slug: (pages, set()) for slug, pages in
+                  self.db.execute('SELECT slug, pages FROM page_counts WHERE tbl = ?', (table,))}
+        for slug, page in self.db.execute('SELECT slug, page FROM pages_done WHERE tbl = ?', (table,)):
+            if slug in counts:
+                counts[slug][1].add(page)
+        return counts
+
+    def set_page_count(self, table: str, slug: str, pages: int) -> None:
+        """Record the page count of a row; pages before its ``next_page`` count as parsed"""
+        self._update(self._set_page_count, table, slug, pages)
+
+    def _set_page_count(self, table: str, slug: str, pages: int) -> None:
+        row = self.db.execute(f'SELECT next_page FROM {table} WHERE slug = ?', (slug,)).fetchone()
+        self.db.execute('''
+            INSERT INTO page_counts (tbl, slug, pages) VALUES (?, ?, ?)
+            ON CONFLICT(tbl, slug) DO UPDATE SET pages = excluded.pages
+        ''', (table, slug, pages))
+        self.db.executemany(
+            'INSERT OR IGNORE INTO pages_done (tbl, slug, page) VALUES (?, ?, ?)',
+            [(table, slug, page) for page in range(1, row[0] if row else 1)]
+        )
+
+    def mark_page(self, table: str, slug: str, page: int) -> bool:
+        """Record a parsed page of a row with a known page count, return True once every page is parsed"""
+        if self._held is None:
+            return self._update(self._mark_page, table, slug, page)
+        self._held.append((self._mark_page, (table, slug, page)))
+        # The result it will have once committed: the held updates applied, then rolled back
+        self.db.execute('BEGIN')
+        try:
+            for method, args in self._held[:-1]:
+                method(*args)
+            return self._mark_page(table, slug, page)
+        finally:
+            self.db.execute('ROLLBACK')
+
+    def _mark_page(self, table: str, slug: str, page: int) -> bool:
+        self.db.execute('INSERT OR IGNORE INTO pages_done (tbl, slug, page) VALUES (?, ?, ?)', (table, slug, page))
+        parsed = {page for (page,) in self.db.execute(
+            'SELECT page FROM pages_done WHERE tbl = ? AND slug = ?', (table, slug))}
+        count = self.db.execute(
+            'SELECT pages FROM page_counts WHERE tbl = ? AND slug = ?', (table, slug)).fetchone()
+
+        next_page = 1
+        while next_page in parsed:
+            next_page += 1
+        if count is None or next_page <= count[0]:
+            self._set_page(table, slug, next_page)
+            return False
+
+        # Every page is parsed, the per-page rows are not needed anymore
+        self.db.execute('DELETE FROM page_counts WHERE tbl = ? AND slug = ?', (table, slug))
+        self.db.execute('DELETE FROM pages_done WHERE tbl = ? AND slug = ?', (table, slug))
+        self._finish(table, slug)
+        return True
+
+    def import_reviewed_slugs(self, path: str) -> int:
+        """Mark the products of a legacy product_reviewed_slugs.json as done, once"""
+        if not os.path.exists(path) or self.db.execute('SELECT 1 FROM products LIMIT 1').fetchone():
+            return 0
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                slugs = json.load(f)
+        except json.JSONDecodeError:
+            logger.error("Invalid JSON in %s; nothing imported", path)
+            return 0
+        if not isinstance(slugs, list):
+            logger.warning("Unexpected format in %s; expected a list", path)
+            return 0
+
+        now = time.time()
+        with self.db:
+            self.db.execute('BEGIN')
+            self.db.executemany(
+                'INSERT OR IGNORE INTO products (slug, next_page, done, updated_at) VALUES (?, 1, 1, ?)',
+                [(str(slug), now) for slug in slugs]
+            )
+        return len(slugs)
+
+    def review_marks(self) -> dict[str, str]:
+        """Return ``{product_slug: latest review datetime}``"""
+        return dict(self.db.execute('SELECT slug, latest FROM review_marks'))
+
+    def review_mark(self, slug: str) -> str | None:
+        """Return the latest review datetime of a product, None when it was never crawled"""
+        row = self.db.execute('SELECT latest FROM review_marks WHERE slug = ?', (slug,)).fetchone()
+        return row[0] if row else None
+
+    def set_review_mark(self, slug: str, latest: str) -> None:
+        self._update(self._set_review_mark, slug, latest)
+
+    def _set_review_mark(self, slug: str, latest: str) -> None:
+        # ISO 8601 datetimes in the same format compare like strings
+        self.db.execute('''
+            INSERT INTO review_marks (slug, latest) VALUES (?, ?)
+            ON CONFLICT(slug) DO UPDATE SET latest = max(latest, excluded.latest)
+        ''', (slug, latest))
+
+    def import_review_marks(self, path: str) -> int:
+        """Seed the review marks from an existing reviews.csv, once
+
+        Only on the first run: rows appended later by a crawl that crashed
+        before committing its progress are no reviews of finished pages.
+        """
+        if (self.db.execute("SELECT 1 FROM imports WHERE name = 'review_marks'").fetchone()
+                or self.db.execute('SELECT 1 FROM review_marks LIMIT 1').fetchone()):
+            return 0
+
+        marks: dict[str, str] = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8', newline='') as f:
+                for row in csv.DictReader(f):
+                    slug, review_datetime = row.get('product_slug'), row.get('datetime')
+                    if slug and review_datetime and review_datetime > marks.get(slug, ''):
+                        marks[slug] = review_datetime
+
+        with self.db:
+            self.db.execute('BEGIN')
+            self.db.executemany('INSERT OR IGNORE INTO review_marks (slug, latest) VALUES (?, ?)', marks.items())
+            self.db.execute("INSERT OR IGNORE INTO imports (name) VALUES ('review_marks')")
+        return len(marks)
+
+    def close(self) -> None:
+        self.commit_held()
+        self.db.close()
+
+
+class HeldState:
+    """Commits the held updates of a crawl once the items parsed before them are written
+
+    Stores put on hold (``hold``: the checkpoint store, the dedupe index) keep
+    their updates in memory, and the item pipelines writing in batches
+    register as writers (``BatchedWriterPipeline``). Every ``interval``
+    seconds the number of held updates is noted with the responses being
+    parsed, whose callbacks made them. Once these responses are done every
+    item they yielded sits in a writer batch: the batches the writers have
+    yet to write are noted, and the updates are committed once they are
+    written. Batches still not full after ``CHECKPOINT_MAX_DELAY`` seconds are
+    written early. After a failed write nothing is committed anymore. The
+    last updates are committed when the last writer is closed.
+
+    The positions the writers had reached when the counts were noted are
+    committed with them by the ``marks`` store (the dedupe index): every row
+    before them was yielded before, so its key is committed too.
+    """
+
+    interval = 1.0
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.max_delay = crawler.settings.getfloat('CHECKPOINT_MAX_DELAY', 60)
+        self.stores: list = []
+        self.marks_store = None
+        self.writers: list = []
+        self.failed = False
+        self.commits = 0
+        # Held update counts, then the responses being parsed or the writer batches they wait for
+        self._counts: dict | None = None
+        self._marks: dict = {}
+        self._parsing: set | None = None
+        self._batches: dict | None = None
+        self._batches_at = 0.0
+        self._closed_writers = 0
+        self._finished = False
+        self._waiting: list[defer.Deferred] = []
+        self._loop = task.LoopingCall(self._tick)
+
+    def hold(self, store, first: bool = False, marks: bool = False) -> None:
+        """Hold the updates of a store; ``first`` stores are committed before the others
+
+        A ``marks`` store also commits the positions of the writers with its updates.
+        """
+        store.hold()
+        if marks:
+            self.marks_store = store
+        if first:
+            self.stores.insert(0, store)
+        else:
+            self.stores.append(store)
+        if not self._loop.running:
+            self._loop.start(self.interval, now=False)
+
+    def _tick(self) -> None:
+        engine = self.crawler.engine
+        slot = engine.scraper.slot if engine is not None else None
+        if self.failed or slot is None:
+            return
+        if self._counts is None:
+            if any(store.held for store in self.stores):
+                self._counts = {store: store.held for store in self.stores}
+                self._marks = self._writer_marks()
+                self._parsing = set(slot.active)
+        if self._parsing is not None:
+            if not self._parsing.isdisjoint(slot.active):
+                return
+            self._parsing = None
+            self._batches = {writer: writer.unwritten() for writer in self.writers}
+            self._batches_at = time.monotonic()
+        if self._batches is not None:
+            if not all(writer.is_written(self._batches.get(writer, {})) for writer in self.writers):
+                if time.monotonic() - self._batches_at >= self.max_delay:
+                    for writer in self.writers:
+                        writer.write_early(self._batches.get(writer, {}))
+                return
+            self._commit(self._counts, self._marks)
+            self._counts = self._batches = None
+
+    def _writer_marks(self) -> dict:
+        return {name: mark for writer in self.writers for name, mark in writer.marks().items()}
+
+    def _commit(self, counts: dict | None, marks: dict) -> None:
+        """Commit the first ``counts`` held updates of each store, all of them when None"""
+        for store in self.stores:
+            count = None if counts is None else counts.get(store, 0)
+            if store is self.marks_store:
+                store.commit_held(count, marks)
+            else:
+                store.commit_held(count)
+        self.commits += 1
+
+    def write_failed(self) -> None:
+        if not self.failed:
+            logger.error("A batch of items could not be written: the crawl progress is not committed anymore, "
+                         "the pages parsed since the last commit are crawled again next run")
+        self.failed = True
+
+    def writer_closed(self) -> None:
+        """Commit every held update once the last writer is closed, all its batches written"""
+        self._closed_writers += 1
+        if self._closed_writers >= len(self.writers):
+            self._finish()
+
+    def close(self) -> defer.Deferred:
+        """Return a deferred fired once the last updates are committed (or dropped after a failed write)"""
+        d = defer.Deferred()
+        self._waiting.append(d)
+        if not self.writers:
+            self._finish()
+        elif self._finished:
+            d.callback(None)
+        return d
+
+    def _finish(self) -> None:
+        if self._finished:
+            return
+        self._finished = True
+        if self._loop.running:
+            self._loop.stop()
+        if self.failed:
+            for store in self.stores:
+                store.drop_held()
+        else:
+            self._commit(None, self._writer_marks())
+        self.crawler.stats.set_value('checkpoints/commits', self.commits)
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(None)
+
+
+def get_held_state(crawler) -> HeldState:
+    """Return the held state of a crawler, shared by the spider and the item pipelines"""
+    state = getattr(crawler, 'held_state', None)
+    if state is None:
+        state = crawler.held_state = HeldState(crawler)
+    return state
@@ -0,0 +1,167 @@
+"""Persistent index of the products and reviews already stored.
+
+Keys are 16-byte BLAKE2b digests kept in a SQLite table (``DEDUPE_PATH``), so
+membership checks are a single primary-key lookup whatever the dataset size,
+and the index is shared across runs and spiders.
+
+- products are keyed by ``product_slug``; products found without their
+  category (in a sitemap) have keys of their own, so that they are stored
+  again once a listing gives their category
+- reviews are keyed by ``product_slug``, ``datetime`` and a hash of ``title``
+
+During a crawl, new keys are committed once their items are written (see
+``HeldState``), together with the position every writer had reached when
+they were noted (``marks``). A crash between the two leaves rows written
+but not indexed: on the next run each writer looks up the keys of its rows
+past its mark (``missing``) and skips those items instead of storing them
+twice.
+"""
+
+import json
+
+import csv
+import hashlib
+import os
+import sqlite3
+
+from supply_chain.storage import iter_records
+
+PRODUCT = 'product'
+UNCATEGORIZED_PRODUCT = 'uncategorized-product'
+REVIEW = 'review'
+
+
+def _digest(value: str) -> bytes:
+    return hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+
+
+def product_key(product_slug: str, categorized: bool = True) -> bytes:
+    return _digest(f'{PRODUCT if categorized else UNCATEGORIZED_PRODUCT}\0{product_slug}')
+
+
+def review_key(product_slug: str, review_datetime: str | None, title: str | None) -> bytes:
+    title_hash = hashlib.blake2b((title or '').strip().encode('utf-8'), digest_size=8).hexdigest()
+    return _digest(f'{REVIEW}\0{product_slug}\0{review_datetime or ""}\0{title_hash}')
+
+
+class DedupeIndex:
+
+    def __init__(self, path: str = 'dedupe.sqlite3', commit_every: int = 500):
+        self.path = path
+        self.commit_every = commit_every
+        self._uncommitted = 0
+        # Keys waiting for commit_held, None when they are added to the table straight away
+        self._held: dict[bytes, None] | None = None
+        self.db = sqlite3.connect(path, isolation_level=None, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS seen (key BLOB PRIMARY KEY) WITHOUT ROWID')
+        self.db.execute('CREATE TABLE IF NOT EXISTS marks (name TEXT PRIMARY KEY, mark TEXT NOT NULL) WITHOUT ROWID')
+
+    def __contains__(self, key: bytes) -> bool:
+        return self.db.execute('SELECT 1 FROM seen WHERE key = ?', (key,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self.db.execute('SELECT count(*) FROM seen').fetchone()[0]
+
+    def add(self, key: bytes) -> bool:
+        """Add a key, return False when it was already in the index"""
+        if self._held is not None:
+            if key in self._held or key in self:
+                return False
+            self._held[key] = None
+            return True
+        if not self.db.in_transaction:
+            self.db.execute('BEGIN')
+        added = self.db.execute('INSERT OR IGNORE INTO seen (key) VALUES (?)', (key,)).rowcount == 1
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_every:
+            self.commit()
+        return added
+
+    def missing(self, keys) -> set[bytes]:
+        """Return the keys that are not in the table"""
+        return {key for key in keys if key not in self}
+
+    def marks(self) -> dict:
+        """Return the position of every writer at the last commit of held keys, ``{name: mark}``"""
+        return {name: json.loads(mark) for name, mark in self.db.execute('SELECT name, mark FROM marks')}
+
+    def seed_products(self, products) -> int:
+        """Add the slugs of product records (``{slug: {...}}``) to the index"""
+        count = 0
+        for product in products:
+            for slug, record in product.items():
+                count += self.add(product_key(slug, bool(record.get('category_slug'))))
+        self.commit()
+        return count
+
+    def seed_reviews_csv(self, path: str) -> int:
+        """Add the reviews of a reviews.csv file to the index"""
+        if not os.path.exists(path):
+            return 0
+        count = 0
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            for row in csv.DictReader(f):
+                count += self.add(review_key(row.get('product_slug') or '', row.get('datetime'), row.get('title')))
+        self.commit()
+        return count
+
+    def seed(self, storage_dir: str = '.', reviews_csv_path: str = 'reviews.csv') -> tuple[int, int]:
+        """Index the products and reviews stored before the index existed, return both counts"""
+        try:
+            products = self.seed_products(iter_records('product_links', storage_dir))
+        except FileNotFoundError:
+            products = 0
+        return products, self.seed_reviews_csv(reviews_csv_path)
+
+    def copy_to(self, path: str) -> None:
+        """Write a consistent copy of the index to ``path``"""
+        self.commit()
+        target = sqlite3.connect(path)
+        with target:
+            self.db.backup(target)
+        target.close()
+
+    def hold(self) -> None:
+        """Keep the keys added from now on in memory until ``commit_held`` (see ``HeldState``)"""
+        self.commit()
+        if self._held is None:
+            self._held = {}
+
+    @property
+    def held(self) -> int:
+        return len(self._held) if self._held else 0
+
+    def commit_held(self, count: int | None = None, marks: dict | None = None) -> None:
+        """Add the first ``count`` held keys (all of them by default) to the table
+
+        ``marks`` are the writer positions before which every row has its key
+        among these (see ``marks``), recorded in the same transaction.
+        """
+        keys = list(self._held)[:count] if self._held else []
+        if not keys and not marks:
+            return
+        with self.db:
+            self.db.execute('BEGIN')
+            self.db.executemany('INSERT OR IGNORE INTO seen (key) VALUES (?)', [(key,) for key in keys])
+            self.db.executemany('''
+                INSERT INTO marks (name, mark) VALUES (?, ?)
+                ON CONFLICT(name) DO UPDATE SET mark = excluded.mark
+            ''', [(name, json.dumps(mark)) for name, mark in (marks or {}).items()])
+        for key in keys:
+            del self._held[key]
+
+    def drop_held(self) -> None:
+        if self._held:
+            self._held.clear()
+
+    def commit(self) -> None:
+        if self.db.in_transaction:
+            self.db.execute('COMMIT')
+        self._uncommitted = 0
+
+    def close(self) -> None:
+        self.commit_held()
+        self.commit()
+        self.db.close()
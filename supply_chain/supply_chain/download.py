@@ -0,0 +1,56 @@
+"""Download profiles for a crawl that only talks to one origin.
+
+Every request goes to ``fr.trustpilot.com``, so the cost of a request is
+mostly what happens around it: connection and TLS setup, header bytes and
+body size. ``DownloadProfile`` (an add-on, see ``ADDONS``) applies one set of
+download settings picked with ``DOWNLOAD_PROFILE``:
+
+- ``default``: Scrapy's own download settings, untouched: HTTP/1.1 over
+  persistent connections, at most ``CONCURRENT_REQUESTS_PER_DOMAIN`` of them,
+  and cached DNS resolutions
+- ``http2``: https requests are multiplexed over a single HTTP/2 connection
+  per origin (needs the ``h2`` package, ``default`` is used when it is
+  missing)
+
+Every profile decodes gzip and deflate responses, and Brotli ones when the
+``brotli`` package is installed (Scrapy then advertises ``br`` in
+``Accept-Encoding``). Settings given on the command line still win over the
+profile. ``python -m benchmarks.download`` compares the profiles against a
+local server.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+HTTP2_HANDLER = 'scrapy.core.downloader.handlers.http2.H2DownloadHandler'
+
+PROFILES = {
+    'default': {},
+    'http2': {
+        'DOWNLOAD_HANDLERS': {'https': HTTP2_HANDLER},
+    },
+}
+
+
+class DownloadProfile:
+    """Apply the download settings of ``DOWNLOAD_PROFILE``"""
+
+    def update_settings(self, settings):
+        name = settings.get('DOWNLOAD_PROFILE', 'default')
+        if name not in PROFILES:
+            raise ValueError(f"Unknown DOWNLOAD_PROFILE {name!r}, expected one of {', '.join(PROFILES)}")
+        if name == 'http2':
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("The h2 package is not installed; using the default download profile")
+                name = 'default'
+
+        for key, value in PROFILES[name].items():
+            if isinstance(value, dict):
+                # Keep the handlers of other schemes, and those set on the command line
+                settings[key].update(value, priority='addon')
+            else:
+                settings.set(key, value, priority='addon')
+        logger.info("Download profile: %s", name)
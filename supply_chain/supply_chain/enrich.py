@@ -0,0 +1,252 @@
+"""Batch enrichment of the collected reviews.
+
+Reads the rows appended to reviews.csv since the previous run, in chunks of
+``--chunk-mb`` processed with pandas (in a process pool with ``--workers``),
+and writes under ``ENRICH_DIR``:
+
+- ``reviews/part-<offset>.parquet``: the reviews with their text and title
+  normalized (NFKC, collapsed whitespace, emoji moved to an ``emojis``
+  column), ``text_chars`` and ``text_tokens`` counts, a detected
+  ``language`` (stopword vote, ``und`` when undecided), a typed datetime and
+  rating
+- ``product_ratings.csv`` and ``category_ratings.csv``: number of reviews per
+  rating (1 to 5), count and mean rating of every product and category
+
+``state.json`` keeps the byte offset reached in reviews.csv and the rating
+counts, so each run only reads the new rows; a row still being written by a
+crawl is left for the next run.
+
+Usage from the project directory (where scrapy.cfg lives):
+
+    python -m supply_chain.enrich --workers 4
+    python -m supply_chain.enrich --rebuild
+"""
+
+import argparse
+import concurrent.futures
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+
+import pandas as pd
+from scrapy.utils.project import get_project_settings
+
+from supply_chain.search import complete_rows
+
+logger = logging.getLogger(__name__)
+
+RATINGS = (1, 2, 3, 4, 5)
+
+EMOJI = r'[\U0001F000-\U0001FAFF\u2300-\u23FF\u2600-\u27BF\u2B00-\u2BFF\uFE0F\u200D]'
+WORD = r'[^\W\d_]+'
+
+# Frequent words of each language; words listed for several languages do not vote
+STOPWORDS = {
+    'fr': 'le la les de des du un une est et en a y se non je il elle nous vous pas pour avec sur dans très '
+          'mais qui que ce cette mon ma mes au aux été avoir bien plus commande reçu merci qualité livraison '
+          'rapide produit prix bon conforme',
+    'en': 'the and is was to of it for with my this that you they have not but very are had order '
+          'received thanks would fast delivery good great quality',
+    'de': 'der die das und ist nicht ich mit sie ein eine auf für sehr aber auch wurde bestellung '
+          'habe nach noch',
+    'es': 'el la los las de en que y es muy pero por con para una lo del se mi pedido gracias fue está',
+    'it': 'il la di che è per con non una sono gli della molto ma ho ordine grazie anche',
+    'nl': 'de het een en is niet ik met voor op zijn maar ook heel bestelling goed wel',
+    'pt': 'o a os as de que em e é não um uma com para muito mas foi pedido obrigado meu',
+}
+
+
+def _stopword_languages() -> dict[str, str]:
+    languages: dict[str, str | None] = {}
+    for language, words in STOPWORDS.items():
+        for word in words.split():
+            languages[word] = language if word not in languages else None
+    return {word: language for word, language in languages.items() if language}
+
+
+WORD_LANGUAGES = _stopword_languages()
+
+
+def row_boundaries(path: str, start: int, chunk_bytes: int) -> list[int]:
+    """Return chunk boundaries from ``start``, a row start, to the end of the last complete row
+
+    Rows are read from ``start`` on: whether a \r\n ends a row or sits in a
+    quoted field depends on every quote before it.
+    """
+    boundaries = [start]
+    end = start
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remainder = b''
+        while True:
+            block = f.read(min(chunk_bytes, 1024 * 1024))
+            if not block:
+                break
+            block = remainder + block
+            rows = complete_rows(block)
+            end += rows
+            remainder = block[rows:]
+            if end - boundaries[-1] >= chunk_bytes:
+                boundaries.append(end)
+    # A partial last row is still being written by a crawl
+    if end > boundaries[-1]:
+        boundaries.append(end)
+    return boundaries
+
+
+def read_header(path: str) -> tuple[list[str], int]:
+    """Return the column names of a CSV file and the offset of its first row"""
+    with open(path, 'rb') as f:
+        line = f.readline()
+    return line.decode('utf-8').strip().split(','), len(line)
+
+
+def detect_languages(text):
+    """Return the language of each text by majority of its stopwords, ``und`` when none is found"""
+    words = text.str.lower().str.findall(WORD).explode()
+    languages = words.map(WORD_LANGUAGES).dropna()
+    if languages.empty:
+        return pd.Series('und', index=text.index)
+    votes = languages.groupby(level=0).value_counts()
+    return votes.groupby(level=0).idxmax().str[1].reindex(text.index).fillna('und')
+
+
+def normalize(text):
+    """NFKC-normalize texts, move emoji out and collapse whitespace; return (texts, emojis)"""
+    text = text.fillna('').str.normalize('NFKC')
+    emojis = text.str.findall(EMOJI).str.join('').str.replace(r'[\uFE0F\u200D]', '', regex=True)
+    text = text.str.replace(EMOJI, ' ', regex=True).str.replace(r'\s+', ' ', regex=True).str.strip()
+    return text, emojis
+
+
+def enrich_chunk(path: str, start: int, end: int, names: list[str]):
+    """Read the rows of reviews.csv between two byte offsets and return them enriched"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    frame = pd.read_csv(io.BytesIO(data), header=None, names=names, dtype=object, keep_default_na=False)
+
+    frame['datetime'] = pd.to_datetime(frame['datetime'], utc=True, errors='coerce')
+    frame['service_rating'] = pd.to_numeric(frame['service_rating'], errors='coerce').astype('Int8')
+    frame['title'], _ = normalize(frame['title'])
+    frame['text'], frame['emojis'] = normalize(frame['text'])
+    frame['text_chars'] = frame['text'].str.len().astype('int32')
+    frame['text_tokens'] = frame['text'].str.count(WORD).astype('int32')
+    frame['language'] = detect_languages(frame['title'] + ' ' + frame['text'])
+    return frame
+
+
+def rating_counts(frame):
+    """Return the number of reviews per rating of each (category, product) of a chunk"""
+    counts = (frame.dropna(subset=['service_rating'])
+              .astype({'category_slug': str, 'product_slug': str})
+              .groupby(['category_slug', 'product_slug', 'service_rating'], observed=True)
+              .size().unstack(fill_value=0))
+    return counts.reindex(columns=list(RATINGS), fill_value=0)
+
+
+def histograms(counts, by: str):
+    """Return the rating histogram, count and mean rating grouped by ``by``"""
+    grouped = counts.groupby(level=by).sum()
+    total = grouped.sum(axis=1)
+    grouped.columns = [f'rating_{rating}' for rating in grouped.columns]
+    grouped['count'] = total
+    grouped['mean_rating'] = (sum(grouped[f'rating_{r}'] * r for r in RATINGS) / total).round(3)
+    return grouped.sort_values('count', ascending=False)
+
+
+class Enricher:
+
+    def __init__(self, source: str, directory: str = 'enriched'):
+        self.source = source
+        self.directory = directory
+        self.state_path = os.path.join(directory, 'state.json')
+        self.parts_dir = os.path.join(directory, 'reviews')
+
+    def load_state(self) -> dict:
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'offset': 0, 'rows': 0, 'ratings': []}
+
+    def save_state(self, state: dict) -> None:
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def rebuild(self) -> None:
+        """Forget previous runs, the next one reads reviews.csv from the start"""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def run(self, workers: int = 1, chunk_bytes: int = 16 * 1024 * 1024) -> int:
+        """Enrich the rows appended since the last run, return their number"""
+        if not os.path.exists(self.source):
+            raise FileNotFoundError(self.source)
+        state = self.load_state()
+        names, first_row = read_header(self.source)
+        if state['offset'] > os.path.getsize(self.source):
+            logger.warning("%s is smaller than at the last run; enriching it again from the start", self.source)
+            self.rebuild()
+            state = self.load_state()
+
+        boundaries = row_boundaries(self.source, max(state['offset'], first_row), chunk_bytes)
+        chunks = list(zip(boundaries, boundaries[1:]))
+        if not chunks:
+            logger.info("No new reviews in %s", self.source)
+            return 0
+
+        os.makedirs(self.parts_dir, exist_ok=True)
+        counts = (pd.DataFrame(state['ratings'], columns=['category_slug', 'product_slug', *RATINGS])
+                  .set_index(['category_slug', 'product_slug']))
+        executor = concurrent.futures.ProcessPoolExecutor(workers) if workers > 1 else None
+        rows = 0
+        try:
+            args = ([self.source] * len(chunks), [s for s, _ in chunks], [e for _, e in chunks], [names] * len(chunks))
+            results = executor.map(enrich_chunk, *args) if executor else map(enrich_chunk, *args)
+            for (start, end), frame in zip(chunks, results):
+                # Parts are named after their offset, so a run interrupted here rewrites the same file
+                frame.to_parquet(os.path.join(self.parts_dir, f'part-{start:012d}.parquet'), index=False)
+                counts = counts.add(rating_counts(frame), fill_value=0).astype('int64')
+                rows += len(frame)
+                state['offset'], state['rows'] = end, state['rows'] + len(frame)
+                state['ratings'] = counts.reset_index().values.tolist()
+                self.save_state(state)
+                logger.info("Enriched %s reviews (%s MiB of %s)", len(frame), round((end - start) / 1048576, 1),
+                            self.source)
+        finally:
+            if executor:
+                executor.shutdown()
+
+        histograms(counts, 'product_slug').to_csv(os.path.join(self.directory, 'product_ratings.csv'))
+        histograms(counts, 'category_slug').to_csv(os.path.join(self.directory, 'category_ratings.csv'))
+        return rows
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workers', type=int, default=1, help="processes enriching chunks in parallel")
+    parser.add_argument('--chunk-mb', type=float, default=16, help="size of the chunks of reviews.csv, in MiB")
+    parser.add_argument('--rebuild', action='store_true', help="enrich every review again")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(name)s] %(levelname)s: %(message)s')
+
+    settings = get_project_settings()
+    enricher = Enricher(settings.get('REVIEWS_CSV_PATH', 'reviews.csv'), settings.get('ENRICH_DIR', 'enriched'))
+    if args.rebuild:
+        enricher.rebuild()
+    try:
+        rows = enricher.run(max(1, args.workers), int(args.chunk_mb * 1024 * 1024))
+    except FileNotFoundError as e:
+        sys.exit(f"Could not find {e}")
+    print(f"Enriched {rows} new reviews into {enricher.directory}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""Review extraction for product pages.
+
+The XPath expressions are compiled once at import time and evaluated directly
+on the lxml tree behind the response, one expression per field, without
+building intermediate SelectorLists. When the review markup cannot be found,
+the reviews are read from the ``__NEXT_DATA__`` JSON blob embedded in the page.
+
+Each review is returned as ``{'datetime', 'service_rating', 'title', 'text'}``
+with the same values the HTML gives: ``service_rating`` as a string and
+``text`` as the list of paragraph fragments.
+
+``last_page`` reads the page count of a paginated listing the same way, from
+the numbered pagination links or the blob's ``totalPages``.
+"""
+
+import json
+import logging
+import re
+
+from lxml import etree
+
+from supply_chain.checkpoints import page_from_url
+
+logger = logging.getLogger(__name__)
+
+REVIEW_LIST = etree.XPath('//section[starts-with(@class, "styles_reviewListContainer")]')
+ARTICLES = etree.XPath('.//article')
+DATETIME = etree.XPath('.//div[starts-with(@class, "styles_reviewCardInnerHeader")]//time/@datetime', smart_strings=False)
+RATING = etree.XPath('.//div[starts-with(@class, "styles_reviewHeader")]/@data-service-review-rating', smart_strings=False)
+TITLE = etree.XPath('.//div[starts-with(@class, "styles_reviewContent")]//h2/text()', smart_strings=False)
+TEXT = etree.XPath('.//div[starts-with(@class, "styles_reviewContent")]//p/text()', smart_strings=False)
+NEXT_DATA = etree.XPath('//script[@id="__NEXT_DATA__"]/text()', smart_strings=False)
+PAGINATION_HREFS = etree.XPath('//a[starts-with(@name, "pagination-button-")]/@href', smart_strings=False)
+TOTAL_PAGES = re.compile(r'"totalPages"\s*:\s*(\d+)')
+
+
+def _first(values: list):
+    return values[0] if values else None
+
+
+def reviews_from_html(root) -> list[dict] | None:
+    """Extract the reviews of the review list container, None when it is missing"""
+    containers = REVIEW_LIST(root)
+    if not containers:
+        return None
+    if len(containers) > 1:
+        logger.error("Found multiple reviews containers - expected only one")
+
+    return [
+        {
+            'datetime': _first(DATETIME(article)),
+            'service_rating': _first(RATING(article)),
+            'title': _first(TITLE(article)),
+            'text': TEXT(article),
+        }
+        for article in ARTICLES(containers[0])
+    ]
+
+
+def reviews_from_next_data(root) -> list[dict] | None:
+    """Extract the reviews of the __NEXT_DATA__ blob, None when it is missing"""
+    blob = NEXT_DATA(root)
+    if not blob:
+        return None
+    try:
+        reviews = json.loads(blob[0])['props']['pageProps']['reviews']
+    except (json.JSONDecodeError, KeyError, TypeError):
+        logger.warning("Could not read reviews from the __NEXT_DATA__ blob")
+        return None
+
+    return [
+        {
+            'datetime': (review.get('dates') or {}).get('publishedDate'),
+            'service_rating': str(review['rating']) if review.get('rating') is not None else None,
+            'title': review.get('title'),
+            # The HTML splits paragraphs on <br/>, the blob on newlines
+            'text': [line for line in (review.get('text') or '').split('\n') if line],
+        }
+        for review in reviews
+    ]
+
+
+def extract_reviews(response) -> list[dict] | None:
+    """Return the reviews of a product page, None when neither source is found"""
+    root = response.selector.root
+    reviews = reviews_from_html(root)
+    if reviews is None:
+        reviews = reviews_from_next_data(root)
+    return reviews
+
+
+def last_page(response) -> int | None:
+    """Return the number of pages of a paginated listing, None when the page does not tell"""
+    root = response.selector.root
+    pages = [page for page in map(page_from_url, PAGINATION_HREFS(root)) if page]
+    if pages:
+        return max(pages)
+    blob = NEXT_DATA(root)
+    match = TOTAL_PAGES.search(blob[0]) if blob else None
+    return int(match.group(1)) if match else None
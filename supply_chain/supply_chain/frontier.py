@@ -0,0 +1,263 @@
+"""Disk-backed request frontier of the spiders.
+
+Requests waiting for a download normally live in Scrapy's memory queues,
+with their ``cb_kwargs``, so memory grows with the frontier: every listing
+page of a fanned-out category, every product waiting for its reviews. With a
+frontier directory (``FRONTIER_DIR``, Scrapy's ``JOBDIR`` under
+``<FRONTIER_DIR>/<spider name>``) they are kept on disk instead:
+
+- ``StagePriorityQueue`` keeps one queue per crawl stage (the request
+  callback: listing pages, review pages...) and takes requests from the
+  stages in turn, ``FRONTIER_STAGE_WEIGHTS`` requests of a stage per turn, so
+  one stage cannot starve another. Within a stage requests come by priority,
+  then in the order they were queued (``RequestDiskQueue`` files, one per
+  priority, holding requests pickled without their default attributes)
+- ``DiskDupeFilter`` keeps the fingerprints of the requests seen in SQLite
+  instead of a set in memory
+- ``product_priority`` gives review requests a few priority levels: pages of
+  products already started first, then products never crawled, then
+  refreshes of crawled ones
+
+An interrupted crawl (Ctrl-C, or a closespider limit) leaves its queues in
+the frontier directory and the next run of the same spider resumes from them
+without selecting its products or categories again (``resuming``); a crawl
+that finishes clears them.
+"""
+
+import json
+import logging
+import os
+import pickle
+import shutil
+import sqlite3
+
+from queuelib import FifoDiskQueue
+from scrapy import Request, signals
+from scrapy.dupefilters import RFPDupeFilter
+from scrapy.pqueues import ScrapyPriorityQueue
+from scrapy.utils.job import job_dir
+from scrapy.utils.request import request_from_dict
+
+logger = logging.getLogger(__name__)
+
+# Written in the frontier directory of a spider once its crawl has finished
+FINISHED_MARKER = 'finished'
+
+# Priorities of review requests within their stage
+STARTED_PRIORITY = 2
+NEW_PRIORITY = 1
+STALE_PRIORITY = 0
+
+# Attributes of a bare request, left out of the queued ones
+REQUEST_DEFAULTS = Request('https://localhost').to_dict()
+
+
+def product_priority(started: bool, stale: bool) -> int:
+    """Priority of a review page: started products first, then new ones, then refreshes"""
+    if started:
+        return STARTED_PRIORITY
+    return STALE_PRIORITY if stale else NEW_PRIORITY
+
+
+def resuming(spider) -> bool:
+    """True when the spider's frontier holds the requests of an interrupted run that had queued all its seeds"""
+    jobdir = job_dir(spider.settings)
+    if not jobdir or not getattr(spider, 'state', {}).get('seeded'):
+        return False
+    try:
+        with open(os.path.join(jobdir, 'requests.queue', 'active.json'), 'r', encoding='utf-8') as f:
+            return bool(json.load(f))
+    except (FileNotFoundError, ValueError):
+        return False
+
+
+def mark_seeded(spider, seeded: bool = True) -> None:
+    """Record in the spider state whether every seed request of the run is in the frontier"""
+    if hasattr(spider, 'state'):
+        spider.state['seeded'] = seeded
+
+
+class Frontier:
+    """Keep the scheduler queues of the spider in ``FRONTIER_DIR``/<spider name>
+
+    Sets ``JOBDIR`` unless it is set already, and starts from empty queues
+    when the previous crawl in that directory finished.
+    """
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.directory = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def update_settings(self, settings):
+        base = settings.get('FRONTIER_DIR')
+        if not base or settings.get('JOBDIR'):
+            return
+        self.directory = os.path.join(base, self.crawler.spidercls.name)
+        if os.path.exists(os.path.join(self.directory, FINISHED_MARKER)):
+            shutil.rmtree(self.directory)
+        settings.set('JOBDIR', self.directory, priority='addon')
+        self.crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    def spider_closed(self, spider, reason):
+        if reason == 'finished':
+            with open(os.path.join(self.directory, FINISHED_MARKER), 'w', encoding='utf-8'):
+                pass
+        else:
+            logger.info("Crawl %s; %s resumes from the frontier %s", reason, spider.name, self.directory)
+
+
+class StagePriorityQueue:
+    """Scheduler priority queue with one ``ScrapyPriorityQueue`` per stage, popped in weighted turns
+
+    The stage of a request is ``request.meta['stage']``, or the name of its
+    callback. Stages missing from ``FRONTIER_STAGE_WEIGHTS`` weigh 1.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler, downstream_queue_cls, key, startprios=None, *, start_queue_cls=None):
+        return cls(crawler, downstream_queue_cls, key, startprios, start_queue_cls=start_queue_cls)
+
+    def __init__(self, crawler, downstream_queue_cls, key, startprios=None, *, start_queue_cls=None):
+        self.crawler = crawler
+        self.downstream_queue_cls = downstream_queue_cls
+        self.start_queue_cls = start_queue_cls
+        self.key = key
+        self.weights = {stage: max(1, int(weight))
+                        for stage, weight in crawler.settings.getdict('FRONTIER_STAGE_WEIGHTS').items()}
+        self.queues: dict[str, ScrapyPriorityQueue] = {}
+        # Smooth weighted round-robin: the stage with the most credit goes next
+        self.credits: dict[str, int] = {}
+        for stage, priorities in (startprios or {}).items():
+            self.queues[stage] = self._queue(stage, priorities)
+
+    def _queue(self, stage: str, startprios=()) -> ScrapyPriorityQueue:
+        return ScrapyPriorityQueue(self.crawler, self.downstream_queue_cls,
+                                   os.path.join(self.key, stage) if self.key else '', startprios,
+                                   start_queue_cls=self.start_queue_cls)
+
+    @staticmethod
+    def stage(request) -> str:
+        return request.meta.get('stage') or getattr(request.callback, '__name__', None) or 'parse'
+
+    def push(self, request) -> None:
+        stage = self.stage(request)
+        if stage not in self.queues:
+            self.queues[stage] = self._queue(stage)
+        self.queues[stage].push(request)
+
+    def pop(self):
+        stages = [stage for stage, queue in self.queues.items() if len(queue)]
+        if not stages:
+            return None
+        for stage in stages:
+            self.credits[stage] = self.credits.get(stage, 0) + self.weights.get(stage, 1)
+        stage = max(stages, key=self.credits.__getitem__)
+        self.credits[stage] -= sum(self.weights.get(s, 1) for s in stages)
+        return self.queues[stage].pop()
+
+    def close(self) -> dict[str, list[int]]:
+        """Close the queues, return the priorities left in each stage (the state of the next run)"""
+        active = {}
+        for stage, queue in self.queues.items():
+            priorities = queue.close()
+            if priorities:
+                active[stage] = priorities
+        return active
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+
+class RequestDiskQueue(FifoDiskQueue):
+    """FIFO of requests in files (``SCHEDULER_DISK_QUEUE``), pickled without their default attributes
+
+    Scrapy's own disk queues find the name of each callback by listing every
+    method of the spider, which costs more than writing the request; the
+    callbacks of the spiders are bound methods that carry their name.
+    """
+
+    def __init__(self, crawler, key: str):
+        self.spider = crawler.spider
+        super().__init__(key)
+
+    @classmethod
+    def from_crawler(cls, crawler, key: str, *args, **kwargs):
+        return cls(crawler, key)
+
+    def _method_name(self, method):
+        """Name of a spider method, None when ``method`` is not one"""
+        name = getattr(method, '__name__', None)
+        if name and getattr(method, '__self__', None) is self.spider and getattr(self.spider, name, None) == method:
+            return name
+        return None
+
+    def _to_dict(self, request) -> dict:
+        callback, errback = self._method_name(request.callback), self._method_name(request.errback)
+        if type(request) is not Request or (request.callback and not callback) or (request.errback and not errback):
+            return request.to_dict(spider=self.spider)
+        data = {'url': request.url, 'callback': callback, 'errback': errback}
+        for attribute in request.attributes:
+            if attribute in data:
+                continue
+            value = dict(request.headers) if attribute == 'headers' else getattr(request, attribute)
+            if value != REQUEST_DEFAULTS[attribute]:
+                data[attribute] = value
+        return data
+
+    def push(self, request) -> None:
+        try:
+            data = pickle.dumps(self._to_dict(request), protocol=4)
+        except (pickle.PicklingError, AttributeError, TypeError) as e:
+            # The scheduler keeps requests that cannot be serialized in memory
+            raise ValueError(str(e)) from e
+        super().push(data)
+
+    def pop(self):
+        data = super().pop()
+        if data is None:
+            return None
+        return request_from_dict(pickle.loads(data), spider=self.spider)
+
+
+class DiskDupeFilter(RFPDupeFilter):
+    """Duplicate request filter keeping its fingerprints in ``JOBDIR``/requests.seen.sqlite3
+
+    Without ``JOBDIR`` it is Scrapy's filter, with the fingerprints in memory.
+    Fingerprints are committed every ``commit_every`` new requests and when
+    the crawl closes, like the queues they go with.
+    """
+
+    commit_every = 1000
+
+    def __init__(self, path: str | None = None, debug: bool = False, *, fingerprinter=None):
+        super().__init__(None, debug, fingerprinter=fingerprinter)
+        self.db = None
+        self.uncommitted = 0
+        if path:
+            self.db = sqlite3.connect(os.path.join(path, 'requests.seen.sqlite3'))
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS seen (fingerprint BLOB PRIMARY KEY) WITHOUT ROWID')
+            self.db.commit()
+
+    def request_seen(self, request) -> bool:
+        if self.db is None:
+            return super().request_seen(request)
+        fingerprint = self.fingerprinter.fingerprint(request)
+        if self.db.execute('INSERT OR IGNORE INTO seen VALUES (?)', (fingerprint,)).rowcount == 0:
+            return True
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.db.commit()
+            self.uncommitted = 0
+        return False
+
+    def close(self, reason: str) -> None:
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+        super().close(reason)
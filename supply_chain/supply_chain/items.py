@@ -2,11 +2,44 @@
 #
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/items.html
+#
+# Items are slotted dataclasses: no per-instance __dict__, and Scrapy handles
+# them through itemadapter like any other item type.
+
+from dataclasses import dataclass
+
+
+@dataclass(slots=True)
+class CategoryItem:
+    link: str
+    name: str
+    slug: str
+
+
+@dataclass(slots=True)
+class ProductItem:
+    product_slug: str
+    product_link: str
+    category_slug: str
+    category_name: str
 
-import scrapy
+    def to_record(self) -> dict:
+        """Return the product in the product_links format: ``{slug: {...}}``"""
+        return {
+            self.product_slug: {
+                'product_link': self.product_link,
+                'category_slug': self.category_slug,
+                'category_name': self.category_name,
+            }
+        }
 
 
-class SupplyChainItem(scrapy.Item):
-    # define the fields for your item here like:
-    # name = scrapy.Field()
-    pass
+@dataclass(slots=True)
+class ReviewItem:
+    datetime: str | None
+    service_rating: str | None
+    title: str | None
+    text: list[str]
+    category_slug: str
+    category_name: str
+    product_slug: str
@@ -0,0 +1,272 @@
+"""Crawl performance metrics: histograms, periodic summaries and a Prometheus endpoint.
+
+Components record observations in the crawler's ``Metrics`` registry
+(``get_metrics(crawler)``):
+
+- ``download_latency_seconds``: time to the response headers, per spider callback
+  (SupplyChainDownloaderMiddleware; cache hits are not downloads and are skipped)
+- ``callback_cpu_seconds`` and ``items_per_page``: CPU spent in each callback and
+  items it returned for one response (SupplyChainSpiderMiddleware)
+- ``storage_write_seconds`` and ``storage_batch_bytes``: time and bytes of each
+  batch written by the storage pipelines
+- ``scheduler_queue_depth`` and ``downloads_in_flight``: sampled every
+  ``METRICS_SAMPLE_INTERVAL`` seconds (MetricsExtension)
+
+``MetricsExtension`` logs a summary every ``METRICS_LOG_INTERVAL`` seconds and
+when the spider closes, then copies count/sum/p50/p95 of every histogram to
+the stats. With ``METRICS_PORT`` set it serves the histograms and the numeric
+stats at ``http://METRICS_HOST:METRICS_PORT/metrics`` in the Prometheus text
+format. Percentiles are estimated from the histogram buckets.
+"""
+
+import bisect
+import logging
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+from twisted.web import resource, server
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'supply_chain'
+
+# Bucket upper bounds and help text of each histogram
+HISTOGRAMS = {
+    'download_latency_seconds': (
+        (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60),
+        "Time from sending a request to receiving the response headers",
+    ),
+    'callback_cpu_seconds': (
+        (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+        "CPU time spent by a spider callback on one response",
+    ),
+    'items_per_page': (
+        (0, 1, 5, 10, 20, 50, 100, 500),
+        "Items returned by a spider callback for one response",
+    ),
+    'storage_write_seconds': (
+        (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+        "Time to write one batch of items, in the writer thread",
+    ),
+    'storage_batch_bytes': (
+        (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216),
+        "Bytes written for one batch of items",
+    ),
+    'scheduler_queue_depth': (
+        (0, 10, 100, 1000, 10000, 100000),
+        "Requests waiting in the scheduler, sampled",
+    ),
+    'downloads_in_flight': (
+        (0, 1, 2, 4, 8, 16, 32),
+        "Requests in the downloader, middlewares included, sampled",
+    ),
+}
+
+
+class Histogram:
+    """Fixed-bucket histogram (cumulative on export, like Prometheus)"""
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        # One counter per bound, plus the +Inf bucket
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float | None:
+        """Return the upper bound of the bucket holding the ``q`` quantile"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    """Histograms of one crawl, keyed by name and an optional label"""
+
+    def __init__(self):
+        self.histograms: dict[tuple[str, str | None], Histogram] = {}
+
+    def observe(self, name: str, value: float, label: str | None = None) -> None:
+        histogram = self.histograms.get((name, label))
+        if histogram is None:
+            histogram = self.histograms[name, label] = Histogram(HISTOGRAMS[name][0])
+        histogram.observe(value)
+
+    def get(self, name: str, label: str | None = None) -> Histogram | None:
+        return self.histograms.get((name, label))
+
+    def merged(self, name: str) -> Histogram | None:
+        """Return the histogram of ``name`` over all its labels"""
+        series = [h for (n, _), h in self.histograms.items() if n == name]
+        if not series:
+            return None
+        total = Histogram(series[0].bounds)
+        for histogram in series:
+            total.counts = [a + b for a, b in zip(total.counts, histogram.counts)]
+            total.count += histogram.count
+            total.sum += histogram.sum
+        return total
+
+    def prometheus_text(self, stats: dict | None = None) -> str:
+        """Return the histograms, and numeric stats as gauges, in the Prometheus text format"""
+        lines = []
+        for name, (_, help_text) in HISTOGRAMS.items():
+            series = sorted((label or '', h) for (n, label), h in self.histograms.items() if n == name)
+            if not series:
+                continue
+            metric = f'{PREFIX}_{name}'
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} histogram')
+            for label, histogram in series:
+                labels = f'label="{_escape(label)}",' if label else ''
+                cumulative = 0
+                for bound, count in zip(histogram.bounds + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{{labels}le="{bound}"}} {cumulative}')
+                labels = f'{{label="{_escape(label)}"}}' if label else ''
+                lines.append(f'{metric}_sum{labels} {histogram.sum:.6f}')
+                lines.append(f'{metric}_count{labels} {histogram.count}')
+
+        if stats:
+            lines.append(f'# HELP {PREFIX}_stat Numeric values of the Scrapy stats collector')
+            lines.append(f'# TYPE {PREFIX}_stat gauge')
+            for key, value in sorted(stats.items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f'{PREFIX}_stat{{key="{_escape(key)}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def get_metrics(crawler) -> Metrics:
+    """Return the metrics registry of a crawler, shared by all its components"""
+    metrics = getattr(crawler, 'metrics', None)
+    if metrics is None:
+        metrics = crawler.metrics = Metrics()
+    return metrics
+
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, metrics: Metrics, stats):
+        super().__init__()
+        self.metrics = metrics
+        self.stats = stats
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+        return self.metrics.prometheus_text(self.stats.get_stats()).encode('utf-8')
+
+
+class MetricsExtension:
+    """Sample the crawl queues, log metric summaries and serve them to Prometheus"""
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('METRICS_ENABLED', True):
+            raise NotConfigured
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.metrics = get_metrics(crawler)
+        self.sample_interval = settings.getfloat('METRICS_SAMPLE_INTERVAL', 5)
+        self.log_interval = settings.getfloat('METRICS_LOG_INTERVAL', 60)
+        self.port = settings.getint('METRICS_PORT', 0)
+        self.host = settings.get('METRICS_HOST', '127.0.0.1')
+        self.tasks: list[task.LoopingCall] = []
+        self.listener = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        ext = cls(crawler)
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        return ext
+
+    def queue_sizes(self) -> tuple[int, int]:
+        """Return the requests waiting in the scheduler and those in the downloader"""
+        engine = self.crawler.engine
+        # The scheduler is only reachable through the engine slot, as in scrapy.utils.engine
+        scheduler = getattr(getattr(engine, '_slot', None), 'scheduler', None)
+        try:
+            queued = len(scheduler)
+        except TypeError:
+            queued = 0
+        return queued, len(engine.downloader.active)
+
+    def spider_opened(self, spider):
+        for interval, func in ((self.sample_interval, self.sample), (self.log_interval, self.log_summary)):
+            if interval > 0:
+                loop = task.LoopingCall(func, spider)
+                loop.start(interval, now=False)
+                self.tasks.append(loop)
+
+        if self.port:
+            from twisted.internet import reactor
+
+            site = server.Site(MetricsResource(self.metrics, self.stats))
+            self.listener = reactor.listenTCP(self.port, site, interface=self.host)
+            spider.logger.info("Serving metrics on http://%s:%s/metrics", self.host, self.listener.getHost().port)
+
+    def sample(self, spider):
+        queued, in_flight = self.queue_sizes()
+        self.metrics.observe('scheduler_queue_depth', queued)
+        self.metrics.observe('downloads_in_flight', in_flight)
+
+    def log_summary(self, spider):
+        parts = []
+        latency = self.metrics.merged('download_latency_seconds')
+        if latency and latency.count:
+            parts.append(f"download p50 {_ms(latency.quantile(0.5))} p95 {_ms(latency.quantile(0.95))}")
+        for (name, label), histogram in sorted(self.metrics.histograms.items(), key=lambda kv: (kv[0][0], kv[0][1] or '')):
+            if name == 'callback_cpu_seconds':
+                items = self.metrics.get('items_per_page', label)
+                parts.append(f"{label} {histogram.count} pages, cpu p50 {_ms(histogram.quantile(0.5))} "
+                             f"p95 {_ms(histogram.quantile(0.95))}, {items.sum / items.count if items else 0:.1f} items/page")
+        written = self.metrics.merged('storage_write_seconds')
+        if written and written.count:
+            size = self.metrics.merged('storage_batch_bytes')
+            parts.append(f"storage {written.count} batches, {(size.sum if size else 0) / 1048576:.1f} MiB, "
+                         f"p95 {_ms(written.quantile(0.95))}")
+        parts.append("queue %s, in flight %s" % self.queue_sizes())
+        spider.logger.info("Metrics: %s", " | ".join(parts))
+
+    def spider_closed(self, spider):
+        for loop in self.tasks:
+            if loop.running:
+                loop.stop()
+        if self.listener is not None:
+            self.listener.stopListening()
+        self.log_summary(spider)
+
+        for (name, label), histogram in self.metrics.histograms.items():
+            key = f'metrics/{name}' + (f'/{label}' if label else '')
+            self.stats.set_value(f'{key}/count', histogram.count, spider=spider)
+            self.stats.set_value(f'{key}/sum', round(histogram.sum, 6), spider=spider)
+            if histogram.count:
+                self.stats.set_value(f'{key}/p50', histogram.quantile(0.5), spider=spider)
+                self.stats.set_value(f'{key}/p95', histogram.quantile(0.95), spider=spider)
+
+
+def _ms(seconds: float | None) -> str:
+    if seconds is None:
+        return '-'
+    if seconds == float('inf'):
+        return 'inf'
+    return f'{seconds * 1000:.1f}ms'
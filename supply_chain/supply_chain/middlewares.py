@@ -3,45 +3,73 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
-from scrapy import signals
+import random
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
 
-# useful for handling different item types with a single interface
-from itemadapter import ItemAdapter
+from scrapy import Request, signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.utils.httpobj import urlparse_cached
+from twisted.internet import task
+
+from supply_chain.metrics import get_metrics
+from supply_chain.sharding import RateBudget
 
 
 class SupplyChainSpiderMiddleware:
-    # Not all methods need to be defined. If a method is not defined,
-    # scrapy acts as if the spider middleware does not modify the
-    # passed objects.
+    """Record the CPU time and item count of every callback in the crawl metrics
+
+    Only the time spent producing results is counted, not the time the
+    engine and other middlewares spend between two results.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
 
     @classmethod
     def from_crawler(cls, crawler):
         # This method is used by Scrapy to create your spiders.
-        s = cls()
+        s = cls(get_metrics(crawler))
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
         return s
 
-    def process_spider_input(self, response, spider):
-        # Called for each response that goes through the spider
-        # middleware and into the spider.
-
-        # Should return None or raise an exception.
-        return None
-
     def process_spider_output(self, response, result, spider):
         # Called with the results returned from the Spider, after
         # it has processed the response.
-
-        # Must return an iterable of Request, or item objects.
+        callback = callback_name(response.request)
+        cpu = 0.0
+        items = 0
+        start = time.process_time()
         for i in result:
+            cpu += time.process_time() - start
+            if not isinstance(i, Request):
+                items += 1
             yield i
+            start = time.process_time()
+        cpu += time.process_time() - start
+        self._observe(callback, cpu, items)
 
-    def process_spider_exception(self, response, exception, spider):
-        # Called when a spider or process_spider_input() method
-        # (from other spider middleware) raises an exception.
+    async def process_spider_output_async(self, response, result, spider):
+        # The same for the results of async callbacks and async middlewares,
+        # which Scrapy would otherwise turn into a blocking iterable.
+        # Time spent awaiting counts the CPU of whatever ran meanwhile.
+        callback = callback_name(response.request)
+        cpu = 0.0
+        items = 0
+        start = time.process_time()
+        async for i in result:
+            cpu += time.process_time() - start
+            if not isinstance(i, Request):
+                items += 1
+            yield i
+            start = time.process_time()
+        cpu += time.process_time() - start
+        self._observe(callback, cpu, items)
 
-        # Should return either None or an iterable of Request or item objects.
-        pass
+    def _observe(self, callback: str, cpu: float, items: int) -> None:
+        self.metrics.observe('callback_cpu_seconds', cpu, callback)
+        self.metrics.observe('items_per_page', items, callback)
 
     async def process_start(self, start):
         # Called with an async iterator over the spider start() method or the
@@ -54,47 +82,216 @@ class SupplyChainSpiderMiddleware:
 
 
 class SupplyChainDownloaderMiddleware:
-    # Not all methods need to be defined. If a method is not defined,
-    # scrapy acts as if the downloader middleware does not modify the
-    # passed objects.
+    """Record the download latency of every response in the crawl metrics
+
+    Latency is Scrapy's ``download_latency`` (request sent to response
+    headers); responses served by the HTTP cache are not counted.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
 
     @classmethod
     def from_crawler(cls, crawler):
         # This method is used by Scrapy to create your spiders.
-        s = cls()
+        s = cls(get_metrics(crawler))
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
         return s
 
-    def process_request(self, request, spider):
-        # Called for each request that goes through the downloader
-        # middleware.
-
-        # Must either:
-        # - return None: continue processing this request
-        # - or return a Response object
-        # - or return a Request object
-        # - or raise IgnoreRequest: process_exception() methods of
-        #   installed downloader middleware will be called
+    def process_response(self, request, response, spider):
+        # Called with the response returned from the downloader.
+        latency = request.meta.get('download_latency')
+        if latency is not None and 'cached' not in response.flags:
+            self.metrics.observe('download_latency_seconds', latency, callback_name(request))
+        return response
+
+    def spider_opened(self, spider):
+        spider.logger.info("Spider opened: %s" % spider.name)
+
+
+class ThrottleBackoffMiddleware(SupplyChainDownloaderMiddleware):
+    """Back off from a domain that throttles the crawl, on top of the latency metrics
+
+    A response is throttled when its status is 429 or 403, when it is a 503
+    with ``Retry-After``, or when it is a challenge page (a body holding one
+    of ``BACKOFF_CHALLENGE_MARKERS``). Its request is put back in the
+    scheduler instead of reaching the spider, and every request to the
+    domain is held until the backoff delay has passed: ``Retry-After`` when
+    the server gives it, otherwise ``BACKOFF_BASE_DELAY`` doubled with each
+    throttled response in a row, with jitter, up to ``BACKOFF_MAX_DELAY``.
+    When at least ``BACKOFF_PAUSE_RATIO`` of the last ``BACKOFF_WINDOW``
+    responses of a domain were throttled, the engine stops sending requests
+    for the delay (circuit breaker). A request throttled more than
+    ``BACKOFF_MAX_TIMES`` times fails with ``IgnoreRequest``, so its errback
+    runs; the first good response ends the backoff.
+
+    Placed after the HTTP cache, so challenge pages are never cached and
+    cached pages are not held, and before Scrapy's retry middleware, which
+    would retry a 429 at once.
+    """
+
+    def __init__(self, metrics, crawler):
+        super().__init__(metrics)
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.enabled = settings.getbool('BACKOFF_ENABLED', True)
+        self.base_delay = settings.getfloat('BACKOFF_BASE_DELAY', 5)
+        self.max_delay = settings.getfloat('BACKOFF_MAX_DELAY', 600)
+        self.max_times = settings.getint('BACKOFF_MAX_TIMES', 5)
+        self.window = settings.getint('BACKOFF_WINDOW', 20)
+        self.pause_ratio = settings.getfloat('BACKOFF_PAUSE_RATIO', 0.5)
+        self.markers = [marker.encode() for marker in settings.getlist('BACKOFF_CHALLENGE_MARKERS')]
+        # Per domain: throttled responses in a row, end of the backoff, recent outcomes (True when throttled)
+        self._streaks: dict[str, int] = {}
+        self._until: dict[str, float] = {}
+        self._recent: dict[str, deque] = {}
+        self._resume_call = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = cls(get_metrics(crawler), crawler)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def throttle_reason(self, response) -> str | None:
+        """Return why a response is a throttling response (its status or ``challenge``), None when it is not"""
+        if response.status in (429, 403) or (response.status == 503 and b'Retry-After' in response.headers):
+            return str(response.status)
+        if (response.headers.get(b'cf-mitigated') == b'challenge'
+                or any(marker in response.body for marker in self.markers)):
+            return 'challenge'
         return None
 
+    def backoff_delay(self, domain: str, response) -> float:
+        """Return how long to wait before the next request to ``domain``"""
+        retry_after = retry_after_seconds(response.headers.get(b'Retry-After'))
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        delay = min(self.max_delay, self.base_delay * 2 ** (self._streaks[domain] - 1))
+        # Half fixed, half random: processes and requests throttled together do not come back together
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def process_request(self, request, spider):
+        if not self.enabled:
+            return None
+        from twisted.internet import reactor
+
+        wait = self._until.get(urlparse_cached(request).hostname or '', 0) - time.monotonic()
+        if wait <= 0:
+            return None
+        self.stats.inc_value('backoff/delayed', spider=spider)
+        self.stats.inc_value('backoff/wait_ms', int(wait * 1000), spider=spider)
+        return task.deferLater(reactor, wait, lambda: None)
+
     def process_response(self, request, response, spider):
-        # Called with the response returned from the downloader.
+        response = super().process_response(request, response, spider)
+        if not self.enabled:
+            return response
 
-        # Must either;
-        # - return a Response object
-        # - return a Request object
-        # - or raise IgnoreRequest
-        return response
+        domain = urlparse_cached(request).hostname or ''
+        recent = self._recent.setdefault(domain, deque(maxlen=self.window))
+        reason = self.throttle_reason(response)
+        recent.append(reason is not None)
+        if reason is None:
+            if self._streaks.pop(domain, 0):
+                spider.logger.info("%s answers again, backoff ended", domain)
+            return response
 
-    def process_exception(self, request, exception, spider):
-        # Called when a download handler or a process_request()
-        # (from other downloader middleware) raises an exception.
+        self._streaks[domain] = self._streaks.get(domain, 0) + 1
+        delay = self.backoff_delay(domain, response)
+        self._until[domain] = max(self._until.get(domain, 0), time.monotonic() + delay)
+        self.stats.inc_value(f'backoff/throttled/{reason}', spider=spider)
+        spider.logger.warning("Throttled by %s (%s, %s in a row), backing off for %.1fs: %s",
+                              domain, reason, self._streaks[domain], delay, request.url)
 
-        # Must either:
-        # - return None: continue processing this exception
-        # - return a Response object: stops process_exception() chain
-        # - return a Request object: stops process_exception() chain
-        pass
+        if len(recent) >= self.window // 2 and sum(recent) >= self.pause_ratio * len(recent):
+            self.pause(domain, delay, spider)
 
-    def spider_opened(self, spider):
-        spider.logger.info("Spider opened: %s" % spider.name)
+        times = request.meta.get('backoff_times', 0) + 1
+        if times > self.max_times:
+            self.stats.inc_value('backoff/gave_up', spider=spider)
+            raise IgnoreRequest(f"Still throttled after {self.max_times} retries: {request.url}")
+        self.stats.inc_value('backoff/requeued', spider=spider)
+        retry = request.replace(dont_filter=True)
+        retry.meta['backoff_times'] = times
+        return retry
+
+    def pause(self, domain: str, delay: float, spider) -> None:
+        """Stop sending requests for ``delay`` seconds"""
+        from twisted.internet import reactor
+
+        # Start counting again after the pause
+        self._recent[domain].clear()
+        if self._resume_call is not None and self._resume_call.active():
+            self._resume_call.reset(max(delay, self._resume_call.getTime() - reactor.seconds()))
+            return
+        spider.logger.warning("Most responses from %s are throttled, pausing the crawl for %.1fs", domain, delay)
+        self.stats.inc_value('backoff/pauses', spider=spider)
+        self.crawler.engine.pause()
+        self._resume_call = reactor.callLater(delay, self.resume, spider)
+
+    def resume(self, spider) -> None:
+        spider.logger.info("Resuming the crawl")
+        self.crawler.engine.unpause()
+
+    def spider_closed(self, spider):
+        if self._resume_call is not None and self._resume_call.active():
+            self._resume_call.cancel()
+
+
+def retry_after_seconds(value: bytes | None) -> float | None:
+    """Parse a ``Retry-After`` header (seconds or HTTP date) into seconds from now"""
+    if not value:
+        return None
+    value = value.decode('latin-1').strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def callback_name(request) -> str:
+    """Return the name of the callback a request is sent to (``parse`` by default)"""
+    callback = request.callback if request is not None else None
+    return getattr(callback, '__name__', None) or 'parse'
+
+
+class SharedRateLimitMiddleware:
+    """Hold each download until its slot in the request budget shared by all crawl processes
+
+    Enabled by ``RATE_BUDGET_PER_SEC`` (requests per second per domain, across
+    every process using ``RATE_BUDGET_PATH``). Placed after the HTTP cache so
+    cached pages do not use the budget.
+    """
+
+    def __init__(self, budget: RateBudget, stats):
+        self.budget = budget
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        rate = crawler.settings.getfloat('RATE_BUDGET_PER_SEC', 0)
+        if rate <= 0:
+            raise NotConfigured
+        budget = RateBudget(crawler.settings.get('RATE_BUDGET_PATH', 'ratelimit.sqlite3'), rate)
+        s = cls(budget, crawler.stats)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_request(self, request, spider):
+        from twisted.internet import reactor
+
+        delay = self.budget.reserve(urlparse_cached(request).hostname or '')
+        if delay <= 0:
+            return None
+        self.stats.inc_value('rate_budget/delayed', spider=spider)
+        self.stats.inc_value('rate_budget/wait_ms', int(delay * 1000), spider=spider)
+        # The request waits before entering its downloader slot, counted meanwhile in CONCURRENT_REQUESTS only
+        return task.deferLater(reactor, delay, lambda: None)
+
+    def spider_closed(self, spider):
+        self.budget.close()
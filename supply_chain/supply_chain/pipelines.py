@@ -3,11 +3,576 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 
+import base64
+import csv
+import glob
+import io
+import json
+import os
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
 
 # useful for handling different item types with a single interface
 from itemadapter import ItemAdapter
+from scrapy.exceptions import DropItem, NotConfigured
+from scrapy.utils.log import failure_to_exc_info
+from twisted.internet import defer, threads
 
+from supply_chain.checkpoints import get_held_state
+from supply_chain.dedupe import DedupeIndex, product_key, review_key
+from supply_chain.items import CategoryItem, ProductItem, ReviewItem
+from supply_chain.metrics import get_metrics
+from supply_chain.search import ReviewIndex, parse_rating
+from supply_chain.storage import (JsonLinesStore, export_json, import_json, iter_lines, legacy_path, store_exists,
+                                  stream_size)
+
+
+def join_text(text) -> str:
+    """Convert a list of paragraphs to a single string"""
+    if isinstance(text, list):
+        return ' '.join([t.strip() for t in text if t is not None]).strip()
+    return text
+
+
+def item_key(item) -> bytes | None:
+    """Return the dedupe key of a product or review, None for other items"""
+    if isinstance(item, ProductItem):
+        return product_key(item.product_slug, bool(item.category_slug))
+    if isinstance(item, ReviewItem):
+        return review_key(item.product_slug, item.datetime, item.title)
+    return None
+
+
+def record_key(name: str, record: dict) -> bytes:
+    """Return the dedupe key of a record of the product_links or reviews store"""
+    if name == 'product_links':
+        slug, product = next(iter(record.items()))
+        return product_key(slug, bool(product.get('category_slug')))
+    return review_key(record.get('product_slug') or '', record.get('datetime'), record.get('title'))
+
+
+class DedupePipeline:
+    """Drop products and reviews already present in the persistent dedupe index
+
+    New keys are held until the writers have stored their items (see ``HeldState``).
+    """
+
+    def __init__(self, settings, stats):
+        self.path = settings.get('DEDUPE_PATH', 'dedupe.sqlite3')
+        self.storage_dir = settings.get('STORAGE_DIR', '.')
+        self.reviews_csv_path = settings.get('REVIEWS_CSV_PATH', 'reviews.csv')
+        self.stats = stats
+        self.index = None
+        self.held_state = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = cls(crawler.settings, crawler.stats)
+        pipeline.held_state = get_held_state(crawler)
+        return pipeline
+
+    def _open_index(self, spider):
+        self.index = DedupeIndex(self.path)
+        if not len(self.index):
+            # First run: index what was collected before the index existed
+            products, reviews = self.index.seed(self.storage_dir, self.reviews_csv_path)
+            spider.logger.info("Seeded dedupe index with %s products and %s reviews", products, reviews)
+        # Committed before the checkpoints: a crash in between repeats pages, it never skips their items
+        self.held_state.hold(self.index, first=True, marks=True)
 
-class SupplyChainPipeline:
     def process_item(self, item, spider):
+        key = item_key(item)
+        if key is None:
+            return item
+        kind = 'product_links' if isinstance(item, ProductItem) else 'reviews'
+
+        if self.index is None:
+            self._open_index(spider)
+        if not self.index.add(key):
+            self.stats.inc_value(f'dedupe/{kind}/dropped', spider=spider)
+            raise DropItem(f"Duplicate {kind} item")
         return item
+
+    def close_spider(self, spider):
+        def close_index(_):
+            if self.index is not None:
+                self.index.close()
+
+        return self.held_state.close().addCallback(close_index)
+
+
+class BatchedWriterPipeline:
+    """Base for pipelines writing items in batches outside the reactor thread
+
+    ``process_item`` only appends the item to the batch of its target (a file,
+    a store...). Full batches are handed to Twisted's thread pool, where
+    ``write_batch`` serializes and writes them; batches of the same target
+    are written one at a time, in order. The item completing a batch waits
+    for its write, which keeps memory bounded when the disk is slower than
+    the crawl.
+
+    Subclasses implement ``target``, and ``open_target``, ``write_batch`` and
+    ``close_target`` which all run in the thread pool. ``write_batch`` may
+    return the number of bytes written; it is recorded with the write time
+    in the crawl metrics.
+
+    Batches are numbered per target, so that ``HeldState`` commits the crawl
+    progress only once the batches holding its items are written. Pipelines
+    that only write when closed set ``holds_progress`` to False.
+
+    Writers implementing ``position`` (where the next row of a target goes)
+    and ``written_keys`` (the dedupe keys of its rows past a position) have
+    their position committed with the dedupe index. When a target is opened,
+    its rows past that position whose keys were never committed were written
+    by a crawl that crashed before the commit: their items are skipped when
+    the crawl yields them again.
+    """
+
+    holds_progress = True
+
+    def __init__(self, settings, stats):
+        self.batch_items = settings.getint('STORAGE_FLUSH_ITEMS', 200)
+        self.dedupe_path = settings.get('DEDUPE_PATH', 'dedupe.sqlite3')
+        self.stats = stats
+        self.metrics = None
+        self.held_state = None
+        self._batches: dict = {}
+        self._locks: dict = {}
+        self._opened: set = set()
+        # Number of batches handed to the writer threads and of batches written, per target
+        self._queued: dict = {}
+        self._written: dict = {}
+        # Position reached by the last batch written, per target
+        self._positions: dict = {}
+        # Keys of the items written before a crash, per target, and the number of items skipped for them
+        self._skip: dict = {}
+        self.skipped = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = cls(crawler.settings, crawler.stats)
+        pipeline.metrics = get_metrics(crawler)
+        pipeline.held_state = get_held_state(crawler)
+        if pipeline.holds_progress:
+            pipeline.held_state.writers.append(pipeline)
+        return pipeline
+
+    def target(self, item):
+        """Return the key of the target an item is written to, None to skip it"""
+        raise NotImplementedError
+
+    def open_target(self, key):
+        pass
+
+    def write_batch(self, key, items: list):
+        raise NotImplementedError
+
+    def close_target(self, key):
+        pass
+
+    def position(self, key):
+        """Return the position the next row of a target is written at (JSON), None when not tracked"""
+        return None
+
+    def written_keys(self, key, position):
+        """Yield the dedupe keys of the rows of a target past a position returned by ``position``"""
+        return ()
+
+    def marks(self) -> dict:
+        """Return the position of every target written so far, named for the dedupe index"""
+        return {f'{type(self).__name__}:{key}': position for key, position in self._positions.items()}
+
+    def _unindexed(self, key) -> set:
+        """Return the keys of the rows of a target written past its mark and never committed"""
+        if not os.path.exists(self.dedupe_path):
+            return set()
+        index = DedupeIndex(self.dedupe_path)
+        try:
+            # Without a mark (a crash before the first commit, or written by an older version) every row is looked up
+            mark = index.marks().get(f'{type(self).__name__}:{key}', 0)
+            return index.missing(self.written_keys(key, mark))
+        finally:
+            index.close()
+
+    def process_item(self, item, spider):
+        key = self.target(item)
+        if key is None:
+            return item
+
+        batch = self._batches.setdefault(key, [])
+        batch.append(item)
+        if len(batch) >= self.batch_items:
+            return self._flush(key).addCallback(lambda _: item)
+        return item
+
+    def unwritten(self) -> dict:
+        """Return ``{target: batch number}`` of the last batch holding items of each target"""
+        return {key: self._queued.get(key, 0) + (1 if self._batches.get(key) else 0)
+                for key in set(self._batches) | set(self._queued)}
+
+    def is_written(self, batches: dict) -> bool:
+        """Whether the batches returned by ``unwritten`` are written"""
+        return all(self._written.get(key, 0) >= number for key, number in batches.items())
+
+    def write_early(self, batches: dict) -> None:
+        """Hand the batches returned by ``unwritten`` to the writer threads, full or not"""
+        for key, number in batches.items():
+            if self._queued.get(key, 0) < number:
+                # A failure stops the commits of the held state
+                self._flush(key).addErrback(lambda _: None)
+
+    def _flush(self, key, close: bool = False):
+        batch = self._batches.pop(key, [])
+        number = self._queued[key] = self._queued.get(key, 0) + 1
+        lock = self._locks.setdefault(key, defer.DeferredLock())
+        d = lock.run(threads.deferToThread, self._write, key, batch, close)
+        return d.addCallbacks(self._record_write, self._write_failed, callbackArgs=(key, number))
+
+    def _write(self, key, batch: list, close: bool):
+        """Write a batch in the thread pool, return its duration and size (or None when empty)"""
+        if key not in self._opened:
+            self.open_target(key)
+            self._opened.add(key)
+            self._skip[key] = self._unindexed(key)
+        skip = self._skip[key]
+        if skip:
+            kept = []
+            for item in batch:
+                if item_key(item) in skip:
+                    skip.discard(item_key(item))
+                    self.skipped += 1
+                else:
+                    kept.append(item)
+            batch = kept
+        result = None
+        if batch:
+            start = time.perf_counter()
+            written = self.write_batch(key, batch)
+            result = time.perf_counter() - start, written
+        position = self.position(key)
+        if close:
+            self.close_target(key)
+        return result, position
+
+    def _write_failed(self, failure):
+        self.held_state.write_failed()
+        return failure
+
+    def _record_write(self, result, key, number):
+        # Back in the reactor thread, where the metrics are updated
+        result, position = result
+        self._written[key] = number
+        if position is not None:
+            self._positions[key] = position
+        if result is not None and self.metrics is not None:
+            elapsed, written = result
+            label = f'{type(self).__name__}:{key}'
+            self.metrics.observe('storage_write_seconds', elapsed, label)
+            if written is not None:
+                self.metrics.observe('storage_batch_bytes', written, label)
+
+    def close_spider(self, spider):
+        keys = list(set(self._batches) | set(self._locks))
+        d = defer.DeferredList([self._flush(key, close=True) for key in keys], consumeErrors=True)
+
+        def closed(result):
+            failed = 0
+            for key, (success, value) in zip(keys, result):
+                if not success:
+                    failed += 1
+                    spider.logger.error("%s could not write its last batch of %s", type(self).__name__, key,
+                                        exc_info=failure_to_exc_info(value))
+            if failed:
+                self.stats.inc_value(f'storage/failed_flushes/{type(self).__name__}', failed, spider=spider)
+            if self.skipped:
+                spider.logger.info("%s skipped %s items written before the last crawl was interrupted",
+                                   type(self).__name__, self.skipped)
+                self.stats.set_value(f'storage/skipped_written/{type(self).__name__}', self.skipped, spider=spider)
+            if self.holds_progress:
+                self.held_state.writer_closed()
+            return result
+
+        return d.addCallback(closed)
+
+
+class JsonLinesStoragePipeline(BatchedWriterPipeline):
+    """Append products and reviews to the product_links and reviews JSON Lines stores"""
+
+    store_names = {ProductItem: 'product_links', ReviewItem: 'reviews'}
+
+    def __init__(self, settings, stats):
+        super().__init__(settings, stats)
+        self.directory = settings.get('STORAGE_DIR', '.')
+        self.rotate_bytes = settings.getint('STORAGE_ROTATE_BYTES', 64 * 1024 * 1024)
+        self.export = settings.getbool('STORAGE_EXPORT_JSON', False)
+        self.stores: dict[str, JsonLinesStore] = {}
+
+    def target(self, item):
+        return self.store_names.get(type(item))
+
+    def open_target(self, name):
+        # One-time migration of the legacy JSON array into the new store
+        if not store_exists(name, self.directory) and os.path.exists(legacy_path(name, self.directory)):
+            import_json(name, self.directory)
+        # Batches are flushed explicitly, never by the store's own buffer
+        self.stores[name] = JsonLinesStore(name, self.directory, flush_items=self.batch_items + 1,
+                                           rotate_bytes=self.rotate_bytes)
+
+    def write_batch(self, name, items):
+        store = self.stores[name]
+        before = store.bytes_written
+        for item in items:
+            store.append(item.to_record() if isinstance(item, ProductItem) else ItemAdapter(item).asdict())
+        store.flush()
+        return store.bytes_written - before
+
+    def position(self, name):
+        return stream_size(name, self.directory)
+
+    def written_keys(self, name, position):
+        if position > stream_size(name, self.directory):
+            # Not the store the position was taken in
+            return
+        for line, _ in iter_lines(name, self.directory, position):
+            try:
+                yield record_key(name, json.loads(line))
+            except (json.JSONDecodeError, AttributeError, StopIteration):
+                continue
+
+    def close_target(self, name):
+        self.stores[name].close()
+        if self.export:
+            export_json(name, self.directory)
+
+    def close_spider(self, spider):
+        d = super().close_spider(spider)
+
+        def log_stores(_):
+            for name, store in self.stores.items():
+                self.stats.inc_value('storage/bytes_written', store.bytes_written, spider=spider)
+                if self.export:
+                    spider.logger.info("Exported %s to %s", name, legacy_path(name, self.directory))
+
+        return d.addCallback(log_stores)
+
+
+class CategoryLinksPipeline(BatchedWriterPipeline):
+    """Replace category_links.json with the categories found by the crawl"""
+
+    # Written when closed; no crawl progress depends on it
+    holds_progress = False
+
+    def __init__(self, settings, stats):
+        super().__init__(settings, stats)
+        self.path = settings.get('CATEGORY_LINKS_PATH', 'category_links.json')
+        self.categories: list[dict] = []
+
+    def target(self, item):
+        return 'category_links' if isinstance(item, CategoryItem) else None
+
+    def write_batch(self, key, items):
+        self.categories.extend(ItemAdapter(item).asdict() for item in items)
+
+    def close_target(self, key):
+        # Written once, atomically, so a failed crawl keeps the previous list
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.categories, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class ReviewsCsvPipeline(BatchedWriterPipeline):
+    """Append reviews to reviews.csv, joining the paragraphs of ``text``"""
+
+    fieldnames = ['datetime', 'service_rating', 'title', 'text', 'category_slug', 'category_name', 'product_slug']
+
+    def __init__(self, settings, stats):
+        super().__init__(settings, stats)
+        self.path = settings.get('REVIEWS_CSV_PATH', 'reviews.csv')
+        self.file = None
+        self.writer = None
+
+    def target(self, item):
+        return 'reviews' if isinstance(item, ReviewItem) else None
+
+    def open_target(self, key):
+        # Check if the file is empty to decide header writing
+        file_empty = (not os.path.exists(self.path)) or (os.path.getsize(self.path) == 0)
+        self.file = open(self.path, 'a', encoding='utf-8', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=self.fieldnames, extrasaction='ignore')
+        if file_empty:
+            self.writer.writeheader()
+
+    def write_batch(self, key, items):
+        before = self.file.tell()
+        for item in items:
+            row = ItemAdapter(item).asdict()
+            row['text'] = join_text(row.get('text'))
+            self.writer.writerow(row)
+        self.file.flush()
+        return self.file.tell() - before
+
+    def position(self, key):
+        return self.file.tell()
+
+    def written_keys(self, key, position):
+        if position > os.path.getsize(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            names = f.readline().decode('utf-8').strip().split(',')
+            f.seek(max(position, f.tell()))
+            tail = f.read().decode('utf-8', 'replace')
+        for row in csv.DictReader(io.StringIO(tail, newline=''), fieldnames=names):
+            yield review_key(row.get('product_slug') or '', row.get('datetime'), row.get('title'))
+
+    def close_target(self, key):
+        self.file.close()
+
+
+class ParquetReviewsPipeline(BatchedWriterPipeline):
+    """Write reviews to Parquet files partitioned by category and crawl date
+
+    Files land in ``PARQUET_DIR/category_slug=<slug>/crawl_date=<YYYY-MM-DD>/``
+    (Hive layout, readable with ``pandas.read_parquet(PARQUET_DIR, filters=...)``),
+    one file per partition every ``PARQUET_BATCH_ITEMS`` reviews. Requires pyarrow.
+    The dedupe keys of its rows are kept in the metadata of each file
+    (``review_keys``), so a crawl resumed after a crash skips them.
+    """
+
+    def __init__(self, settings, stats):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise NotConfigured("pyarrow is not installed")
+        super().__init__(settings, stats)
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.schema = pyarrow.schema([
+            ('datetime', pyarrow.timestamp('ms', tz='UTC')),
+            ('service_rating', pyarrow.int8()),
+            ('title', pyarrow.string()),
+            ('text', pyarrow.string()),
+            ('category_name', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+            ('product_slug', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+        ])
+
+        self.directory = settings.get('PARQUET_DIR', 'reviews_parquet')
+        self.batch_items = settings.getint('PARQUET_BATCH_ITEMS', 5000)
+        self._file_seq = 0
+        self.invalid_ratings = 0
+
+    def target(self, item):
+        return 'reviews' if isinstance(item, ReviewItem) else None
+
+    def write_batch(self, key, items):
+        crawl_date = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+        partitions: dict[str, list[dict]] = defaultdict(list)
+        keys: dict[str, list[bytes]] = defaultdict(list)
+        for item in items:
+            keys[item.category_slug or 'unknown'].append(item_key(item))
+            partitions[item.category_slug or 'unknown'].append({
+                'datetime': datetime.fromisoformat(item.datetime) if item.datetime else None,
+                'service_rating': self._rating(item.service_rating),
+                'title': item.title,
+                'text': join_text(item.text),
+                'category_name': item.category_name,
+                'product_slug': item.product_slug,
+            })
+
+        written = 0
+        for category_slug, rows in partitions.items():
+            directory = os.path.join(self.directory, f'category_slug={category_slug}', f'crawl_date={crawl_date}')
+            os.makedirs(directory, exist_ok=True)
+
+            self._file_seq += 1
+            name = f'part-{int(time.time() * 1000)}-{os.getpid()}-{self._file_seq:05d}.parquet'
+            # Readers skip dot files, so a half-written file is never picked up
+            tmp_path = os.path.join(directory, f'.{name}.tmp')
+            table = self.pa.Table.from_pylist(rows, schema=self.schema).replace_schema_metadata({
+                'review_keys': base64.b64encode(b''.join(keys[category_slug])).decode('ascii'),
+            })
+            self.pq.write_table(table, tmp_path, compression='zstd')
+            written += os.path.getsize(tmp_path)
+            os.replace(tmp_path, os.path.join(directory, name))
+        return written
+
+    def position(self, key):
+        # Files are named after the time they are written at
+        return int(time.time() * 1000)
+
+    def written_keys(self, key, position):
+        for path in glob.glob(os.path.join(glob.escape(self.directory), '*', '*', 'part-*.parquet')):
+            if int(os.path.basename(path).split('-')[1]) < position:
+                continue
+            keys = base64.b64decode((self.pq.read_schema(path).metadata or {}).get(b'review_keys', b''))
+            for start in range(0, len(keys), 16):
+                yield keys[start:start + 16]
+
+    def _rating(self, value):
+        """Return a rating as an integer, None when it is missing or not a rating from 1 to 5"""
+        if not value:
+            return None
+        rating = parse_rating(value)
+        if rating is None:
+            # Stored as null rather than failing the whole batch
+            self.invalid_ratings += 1
+        return rating
+
+    def close_spider(self, spider):
+        d = super().close_spider(spider)
+
+        def log_ratings(_):
+            if self.invalid_ratings:
+                spider.logger.warning("%s reviews had an invalid rating, stored as null", self.invalid_ratings)
+                self.stats.set_value('parquet/invalid_ratings', self.invalid_ratings, spider=spider)
+
+        return d.addCallback(log_ratings)
+
+
+class ReviewIndexPipeline(BatchedWriterPipeline):
+    """Add reviews to the full-text and faceted review index (see supply_chain/search.py)
+
+    When the index is opened it first catches up with the rows appended to
+    reviews.csv since its last update, so it also holds the reviews merged
+    from shards or collected while the pipeline was disabled.
+    """
+
+    def __init__(self, settings, stats):
+        super().__init__(settings, stats)
+        self.path = settings.get('REVIEW_INDEX_PATH', 'reviews_index.sqlite3')
+        self.reviews_csv_path = settings.get('REVIEWS_CSV_PATH', 'reviews.csv')
+        self.index = None
+        self.synced = 0
+        self.added = 0
+
+    def target(self, item):
+        return 'reviews' if isinstance(item, ReviewItem) else None
+
+    def open_target(self, key):
+        self.index = ReviewIndex(self.path)
+        self.synced = self.index.sync_csv(self.reviews_csv_path)
+
+    def write_batch(self, key, items):
+        rows = []
+        for item in items:
+            row = ItemAdapter(item).asdict()
+            row['text'] = join_text(row.get('text'))
+            rows.append(row)
+        self.added += self.index.add(rows)
+
+    def close_target(self, key):
+        self.index.close()
+
+    def close_spider(self, spider):
+        d = super().close_spider(spider)
+
+        def log_index(_):
+            self.stats.set_value('review_index/synced_from_csv', self.synced, spider=spider)
+            self.stats.set_value('review_index/added', self.added, spider=spider)
+            if self.index is not None and self.index.invalid_ratings:
+                spider.logger.warning("%s reviews had an invalid rating, indexed without it", self.index.invalid_ratings)
+                self.stats.set_value('review_index/invalid_ratings', self.index.invalid_ratings, spider=spider)
+
+        return d.addCallback(log_index)
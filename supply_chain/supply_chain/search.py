@@ -0,0 +1,369 @@
+"""Full-text and faceted index of the collected reviews.
+
+Looking reviews up in reviews.csv means reading and parsing the whole file.
+The review index (``REVIEW_INDEX_PATH``) keeps them in SQLite instead:
+
+- ``reviews``: one row per review (keyed like the dedupe index, so a review
+  is never indexed twice), with integer product and category ids
+- ``reviews_fts``: an FTS5 inverted index of the NFKC-normalized title and
+  text (case and accents folded), reading its content from ``reviews``
+- B-tree indexes on product, category and rating: the postings of each
+  facet value, sorted by review datetime
+
+``ReviewIndexPipeline`` adds the reviews of every crawl as they are scraped,
+and each run first catches up with the rows appended to reviews.csv since
+the last one (e.g. merged shards), so the cost of an update only depends
+on the new reviews.
+
+Usage from the project directory (where scrapy.cfg lives):
+
+    python -m supply_chain.search update
+    python -m supply_chain.search query livraison rapide --category shopping_fashion --rating 1 --rating 2
+    python -m supply_chain.search query --product www.example.fr --facets
+"""
+
+import argparse
+import csv
+import io
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import time
+import unicodedata
+
+from scrapy.utils.project import get_project_settings
+
+from supply_chain.dedupe import review_key
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ('datetime', 'service_rating', 'title', 'text', 'category_slug', 'category_name', 'product_slug')
+# csv.DictWriter ends rows with \r\n, which quoted fields may hold as well
+ROW_END = b'\r\n'
+QUERY_TOKEN = re.compile(r'\w+\*?')
+
+
+def normalize(text: str | None) -> str:
+    """NFKC-normalize a text and collapse its whitespace"""
+    return ' '.join(unicodedata.normalize('NFKC', text or '').split())
+
+
+def complete_rows(data: bytes) -> int:
+    """Return the length of the complete CSV rows at the start of ``data``, which starts a row
+
+    A \r\n ends a row only outside quotes, that is after an even number of
+    ``"`` since the start (an escaped quote counts twice).
+    """
+    end = quotes = previous = 0
+    position = data.find(ROW_END)
+    while position != -1:
+        quotes += data.count(b'"', previous, position)
+        if quotes % 2 == 0:
+            end = position + len(ROW_END)
+        previous = position
+        position = data.find(ROW_END, position + len(ROW_END))
+    return end
+
+
+def parse_rating(value) -> int | None:
+    """Return a service rating as an integer, None when it is not a rating from 1 to 5"""
+    try:
+        rating = int(value)
+    except (TypeError, ValueError):
+        return None
+    return rating if 1 <= rating <= 5 else None
+
+
+def match_expression(words: str) -> str:
+    """Return the FTS5 query matching reviews holding every word (``word*`` for a prefix)"""
+    tokens = QUERY_TOKEN.findall(normalize(words))
+    return ' '.join(f'"{token.rstrip("*")}"' + ('*' if token.endswith('*') else '') for token in tokens)
+
+
+class ReviewIndex:
+
+    def __init__(self, path: str = 'reviews_index.sqlite3'):
+        self.path = path
+        # Pipelines use the index from Twisted's thread pool, one batch at a time
+        self.db = sqlite3.connect(path, isolation_level=None, timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS categories (id INTEGER PRIMARY KEY, slug TEXT NOT NULL UNIQUE, name TEXT);
+            CREATE TABLE IF NOT EXISTS products (id INTEGER PRIMARY KEY, slug TEXT NOT NULL UNIQUE);
+            CREATE TABLE IF NOT EXISTS reviews (
+                id INTEGER PRIMARY KEY,
+                key BLOB NOT NULL UNIQUE,
+                datetime TEXT,
+                service_rating INTEGER,
+                title TEXT,
+                text TEXT,
+                category_id INTEGER NOT NULL,
+                product_id INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS reviews_product ON reviews (product_id, datetime);
+            CREATE INDEX IF NOT EXISTS reviews_category ON reviews (category_id, datetime);
+            CREATE INDEX IF NOT EXISTS reviews_rating ON reviews (service_rating, datetime);
+            CREATE VIRTUAL TABLE IF NOT EXISTS reviews_fts USING fts5(
+                title, text, content='reviews', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+            );
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value) WITHOUT ROWID;
+        ''')
+        self._ids: dict[tuple[str, str], int] = {}
+        # Ratings indexed as null because they were not ratings
+        self.invalid_ratings = 0
+
+    def __len__(self) -> int:
+        return self.db.execute('SELECT count(*) FROM reviews').fetchone()[0]
+
+    def _meta(self, key: str, default=None):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key: str, value) -> None:
+        self.db.execute('''
+            INSERT INTO meta (key, value) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        ''', (key, value))
+
+    def _id(self, table: str, slug: str, name: str | None = None) -> int:
+        row_id = self._ids.get((table, slug))
+        if row_id is None:
+            if table == 'categories':
+                self.db.execute('INSERT OR IGNORE INTO categories (slug, name) VALUES (?, ?)', (slug, name))
+            else:
+                self.db.execute('INSERT OR IGNORE INTO products (slug) VALUES (?)', (slug,))
+            row_id = self.db.execute(f'SELECT id FROM {table} WHERE slug = ?', (slug,)).fetchone()[0]
+            self._ids[table, slug] = row_id
+        return row_id
+
+    def _add(self, review: dict) -> bool:
+        product_slug = review.get('product_slug') or ''
+        rating = review.get('service_rating')
+        if rating not in (None, ''):
+            rating = parse_rating(rating)
+            # Indexed without its rating rather than failing the whole batch
+            self.invalid_ratings += rating is None
+        title, text = normalize(review.get('title')), normalize(review.get('text'))
+        cursor = self.db.execute('''
+            INSERT OR IGNORE INTO reviews (key, datetime, service_rating, title, text, category_id, product_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            review_key(product_slug, review.get('datetime'), review.get('title')),
+            review.get('datetime') or None,
+            rating or None,
+            title,
+            text,
+            self._id('categories', review.get('category_slug') or '', review.get('category_name')),
+            self._id('products', product_slug),
+        ))
+        if cursor.rowcount != 1:
+            return False
+        self.db.execute('INSERT INTO reviews_fts (rowid, title, text) VALUES (?, ?, ?)',
+                        (cursor.lastrowid, title, text))
+        return True
+
+    def add(self, reviews) -> int:
+        """Index review rows (dicts with the reviews.csv fields) in one transaction, return the number added"""
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            added = sum(self._add(review) for review in reviews)
+            self.db.execute('COMMIT')
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            self._ids.clear()
+            raise
+        return added
+
+    def sync_csv(self, path: str = 'reviews.csv', block_bytes: int = 16 * 1024 * 1024) -> int:
+        """Index the rows appended to a reviews.csv file since the last sync, return the number added"""
+        if not os.path.exists(path):
+            return 0
+        # Shards append to their own reviews.csv, so the offset reached is kept per file
+        offset_key = f'csv_offset:{os.path.abspath(path)}'
+        offset = self._meta(offset_key, 0)
+        if offset > os.path.getsize(path):
+            logger.info("%s is smaller than at the last sync; reading it again from the start", path)
+            offset = 0
+
+        added = 0
+        with open(path, 'rb') as f:
+            header = f.readline()
+            names = header.decode('utf-8').strip().split(',')
+            offset = max(offset, len(header))
+            f.seek(offset)
+            remainder = b''
+            while True:
+                block = f.read(block_bytes)
+                if not block:
+                    break
+                block = remainder + block
+                # A partial last row is completed by the next block, or still being written by a crawl
+                end = complete_rows(block)
+                if not end:
+                    remainder = block
+                    continue
+                block, remainder = block[:end], block[end:]
+                rows = csv.DictReader(io.StringIO(block.decode('utf-8'), newline=''), fieldnames=names)
+                added += self.add(rows)
+                offset += len(block)
+                self._set_meta(offset_key, offset)
+        return added
+
+    def _filters(self, words: str | None, product: str | None, category: str | None, ratings, since: str | None,
+                 relevance: bool = False):
+        joins = ['JOIN products p ON p.id = r.product_id', 'JOIN categories c ON c.id = r.category_id']
+        where, params = [], []
+        if words:
+            # A product has few reviews: check them against the words one by one rather than reading every
+            # match (BM25 scores all the matches anyway)
+            join = 'CROSS JOIN' if product and not relevance else 'JOIN'
+            joins.insert(0, f'{join} reviews_fts ON reviews_fts.rowid = r.id')
+            where.append('reviews_fts MATCH ?')
+            params.append(match_expression(words))
+        if product:
+            where.append('r.product_id = (SELECT id FROM products WHERE slug = ?)')
+            params.append(product)
+        if category:
+            where.append('r.category_id = (SELECT id FROM categories WHERE slug = ?)')
+            params.append(category)
+        if ratings:
+            # An invalid rating matches no review
+            ratings = [parse_rating(rating) for rating in ratings]
+            where.append(f'r.service_rating IN ({", ".join("?" * len(ratings))})')
+            params.extend(ratings)
+        if since:
+            where.append('r.datetime > ?')
+            params.append(since)
+        return ' '.join(joins), ' AND '.join(where) or '1', params
+
+    def search(self, words: str | None = None, product: str | None = None, category: str | None = None,
+               ratings=None, since: str | None = None, limit: int = 20, offset: int = 0,
+               relevance: bool = False) -> list[dict]:
+        """Return the reviews matching every given filter
+
+        ``words`` must all appear in the title or text (``word*`` matches a
+        prefix). Results come newest first: by publication date, or in
+        reverse indexing order when ``words`` are looked up without a
+        product, which reads the postings only up to ``limit`` matches.
+        ``relevance`` ranks them by BM25 instead, which scores every match.
+        """
+        if words is not None and not match_expression(words):
+            return []
+        joins, where, params = self._filters(words, product, category, ratings, since, relevance)
+        if words and relevance:
+            order = 'reviews_fts.rank'
+        elif words and not product:
+            order = 'reviews_fts.rowid DESC'
+        else:
+            order = 'r.datetime DESC'
+        rows = self.db.execute(f'''
+            SELECT r.datetime, r.service_rating, r.title, r.text, c.slug, c.name, p.slug
+            FROM reviews r {joins}
+            WHERE {where}
+            ORDER BY {order}
+            LIMIT ? OFFSET ?
+        ''', (*params, limit, offset))
+        return [dict(zip(FIELDS, row)) for row in rows]
+
+    def count(self, words: str | None = None, product: str | None = None, category: str | None = None,
+              ratings=None, since: str | None = None) -> int:
+        if words is not None and not match_expression(words):
+            return 0
+        if words and not (product or category or ratings or since):
+            return self.db.execute('SELECT count(*) FROM reviews_fts WHERE reviews_fts MATCH ?',
+                                   (match_expression(words),)).fetchone()[0]
+        joins, where, params = self._filters(words, product, category, ratings, since)
+        return self.db.execute(f'SELECT count(*) FROM reviews r {joins} WHERE {where}', params).fetchone()[0]
+
+    def facets(self, words: str | None = None, product: str | None = None, category: str | None = None,
+               ratings=None, since: str | None = None, limit: int = 10) -> dict:
+        """Return the number of matching reviews per rating, and of the ``limit`` first categories and products"""
+        if words is not None and not match_expression(words):
+            return {'service_rating': {}, 'category_slug': {}, 'product_slug': {}}
+        joins, where, params = self._filters(words, product, category, ratings, since)
+        facets = {}
+        for name, column, top in (('service_rating', 'r.service_rating', None), ('category_slug', 'c.slug', limit),
+                                  ('product_slug', 'p.slug', limit)):
+            rows = self.db.execute(f'''
+                SELECT {column}, count(*) AS n FROM reviews r {joins}
+                WHERE {where}
+                GROUP BY {column}
+                ORDER BY {'n DESC' if top else column}
+                LIMIT ?
+            ''', (*params, top or -1))
+            facets[name] = dict(rows.fetchall())
+        return facets
+
+    def rebuild(self) -> None:
+        """Drop every review, the next sync reads reviews.csv from the start"""
+        self.db.executescript('''
+            BEGIN;
+            DELETE FROM reviews;
+            DELETE FROM products;
+            DELETE FROM categories;
+            DELETE FROM meta;
+            INSERT INTO reviews_fts (reviews_fts) VALUES ('delete-all');
+            COMMIT;
+        ''')
+        self._ids.clear()
+
+    def optimize(self) -> None:
+        """Merge the segments of the full-text index, for the fastest queries after a large update"""
+        self.db.execute("INSERT INTO reviews_fts (reviews_fts) VALUES ('optimize')")
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    update_parser = commands.add_parser('update', help="index the reviews appended to reviews.csv")
+    update_parser.add_argument('--rebuild', action='store_true', help="index every review again")
+    update_parser.add_argument('--optimize', action='store_true', help="merge the full-text index afterwards")
+    query_parser = commands.add_parser('query', help="print the matching reviews as JSON lines")
+    query_parser.add_argument('words', nargs='*', help="words that must appear in the title or text")
+    query_parser.add_argument('--product', help="product slug")
+    query_parser.add_argument('--category', help="category slug")
+    query_parser.add_argument('--rating', type=int, action='append', help="service rating, repeat for several")
+    query_parser.add_argument('--since', help="only reviews published after this ISO datetime")
+    query_parser.add_argument('--limit', type=int, default=20)
+    query_parser.add_argument('--relevance', action='store_true', help="rank by relevance to the words")
+    query_parser.add_argument('--facets', action='store_true', help="print the counts per facet instead")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(name)s] %(levelname)s: %(message)s')
+    settings = get_project_settings()
+    index = ReviewIndex(settings.get('REVIEW_INDEX_PATH', 'reviews_index.sqlite3'))
+    try:
+        if args.command == 'update':
+            if args.rebuild:
+                index.rebuild()
+            start = time.perf_counter()
+            added = index.sync_csv(settings.get('REVIEWS_CSV_PATH', 'reviews.csv'))
+            if args.optimize:
+                index.optimize()
+            print(f"Indexed {added} new reviews in {time.perf_counter() - start:.1f}s, {len(index)} in {index.path}")
+            return 0
+
+        filters = dict(words=' '.join(args.words) or None, product=args.product, category=args.category,
+                       ratings=args.rating, since=args.since)
+        start = time.perf_counter()
+        if args.facets:
+            result = {'count': index.count(**filters), **index.facets(**filters, limit=args.limit)}
+            print(json.dumps(result, ensure_ascii=False, indent=2))
+        else:
+            for review in index.search(**filters, limit=args.limit, relevance=args.relevance):
+                print(json.dumps(review, ensure_ascii=False))
+        logger.info("Query answered in %.2f ms", (time.perf_counter() - start) * 1000)
+    finally:
+        index.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
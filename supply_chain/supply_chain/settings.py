@@ -12,7 +12,10 @@ BOT_NAME = "supply_chain"
 SPIDER_MODULES = ["supply_chain.spiders"]
 NEWSPIDER_MODULE = "supply_chain.spiders"
 
-ADDONS = {}
+ADDONS = {
+    "supply_chain.download.DownloadProfile": 0,
+    "supply_chain.frontier.Frontier": 0,
+}
 
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
@@ -21,11 +24,21 @@ USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.
 # Obey robots.txt rules
 ROBOTSTXT_OBEY = False
 
+# Site crawled by every spider; load tests point it to a local mock site (benchmarks/mocksite.py)
+TRUSTPILOT_BASE_URL = "https://fr.trustpilot.com"
+
 # Concurrency and throttling settings
+# Politeness is handled by the scheduler only (AutoThrottle below), never by
+# sleeping in callbacks. CONCURRENT_REQUESTS_PER_DOMAIN is the upper bound the
+# throttle can reach and DOWNLOAD_DELAY the minimum delay it can go down to.
 #CONCURRENT_REQUESTS = 16
 CONCURRENT_REQUESTS_PER_DOMAIN = 1
 DOWNLOAD_DELAY = 1
 
+# Connection handling of the downloader (see supply_chain/download.py): "default" (Scrapy's persistent HTTP/1.1
+# connections) or "http2" (one multiplexed connection, needs h2)
+DOWNLOAD_PROFILE = "default"
+
 # Disable cookies (enabled by default)
 #COOKIES_ENABLED = False
 
@@ -40,48 +53,161 @@ DOWNLOAD_DELAY = 1
 
 # Enable or disable spider middlewares
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-#SPIDER_MIDDLEWARES = {
-#    "supply_chain.middlewares.SupplyChainSpiderMiddleware": 543,
-#}
+SPIDER_MIDDLEWARES = {
+    # Callback CPU time and items per page; next to the spider so other middlewares are not timed
+    "supply_chain.middlewares.SupplyChainSpiderMiddleware": 950,
+}
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
-#    "supply_chain.middlewares.SupplyChainDownloaderMiddleware": 543,
-#}
+DOWNLOADER_MIDDLEWARES = {
+    # HTTP cache with offline replay support, in place of Scrapy's own
+    "scrapy.downloadermiddlewares.httpcache.HttpCacheMiddleware": None,
+    "supply_chain.httpcache.OfflineHttpCacheMiddleware": 900,
+    # Download latency metrics and backoff from throttling responses; after the cache so challenge pages are
+    # never cached, before RetryMiddleware (550) so a 429 waits for the backoff instead of being retried at once
+    "supply_chain.middlewares.ThrottleBackoffMiddleware": 925,
+    # After the cache: only real downloads use the shared budget
+    "supply_chain.middlewares.SharedRateLimitMiddleware": 950,
+}
+
+# Throttling responses (429, 403, 503 with Retry-After, challenge pages) are requeued and the domain backed off:
+# Retry-After, or BACKOFF_BASE_DELAY doubled per throttled response in a row with jitter, up to BACKOFF_MAX_DELAY.
+# The crawl pauses while BACKOFF_PAUSE_RATIO of the last BACKOFF_WINDOW responses of a domain are throttled.
+BACKOFF_ENABLED = True
+BACKOFF_BASE_DELAY = 5
+BACKOFF_MAX_DELAY = 600
+BACKOFF_MAX_TIMES = 5
+BACKOFF_WINDOW = 20
+BACKOFF_PAUSE_RATIO = 0.5
+BACKOFF_CHALLENGE_MARKERS = [
+    "/cdn-cgi/challenge-platform/",
+    "captcha-delivery.com",
+    "<title>Just a moment...</title>",
+]
+
+# Requests per second per domain shared by every process using RATE_BUDGET_PATH (0 disables the limit).
+# The sharding launcher sets it for its shards (see supply_chain/sharding.py).
+RATE_BUDGET_PER_SEC = 0
+RATE_BUDGET_PATH = "ratelimit.sqlite3"
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
-#    "scrapy.extensions.telnet.TelnetConsole": None,
-#}
+EXTENSIONS = {
+    "supply_chain.metrics.MetricsExtension": 500,
+}
+
+# Crawl metrics (see supply_chain/metrics.py): queue sampling and log summary intervals in seconds,
+# and the port of the Prometheus text endpoint (0 disables it; scrapy crawl <spider> -s METRICS_PORT=9410)
+METRICS_ENABLED = True
+METRICS_SAMPLE_INTERVAL = 5
+METRICS_LOG_INTERVAL = 60
+METRICS_PORT = 0
+METRICS_HOST = "127.0.0.1"
+
+# Crawl progress (pagination cursors, finished products and categories), see supply_chain/checkpoints.py
+CHECKPOINT_PATH = "checkpoints.sqlite3"
+# Progress is committed once the item batches holding the items parsed before it are written; batches that are
+# still not full after this many seconds are written early so that progress keeps being committed
+CHECKPOINT_MAX_DELAY = 60
+# Products and categories found so far, read by start() instead of the whole stores (see supply_chain/catalog.py)
+CATALOG_PATH = "catalog.sqlite3"
+
+# Request every listing page of a category once page 1 gives the page count, instead of following the next button
+CATEGORY_FAN_OUT = True
+
+# Sitemaps read by get_products_sitemap: sitemap indexes, sitemaps (plain or gzipped) or robots.txt files
+# declaring them, relative to TRUSTPILOT_BASE_URL or absolute (file:// URLs read local sitemaps).
+# Only the sitemaps of an index matching one of the SITEMAP_FOLLOW regexes are read (all of them when empty),
+# and files decompressing to more than SITEMAP_MAX_BYTES are skipped.
+SITEMAP_URLS = ["/sitemap.xml"]
+SITEMAP_FOLLOW = []
+SITEMAP_MAX_BYTES = 50 * 1024 * 1024
+
+# Requests waiting for a download are kept on disk in FRONTIER_DIR/<spider name> (Scrapy's JOBDIR, see
+# supply_chain/frontier.py): an interrupted crawl resumes from there, a finished one clears it. "" keeps them in memory.
+FRONTIER_DIR = "frontier"
+# The scheduler takes requests from each stage (request callback) in turn, this many per turn.
+# Review pages get the most turns so discovered products are drained while discovery goes on.
+FRONTIER_STAGE_WEIGHTS = {"parse_categories": 1, "get_products": 1, "get_reviews": 4}
+SCHEDULER_PRIORITY_QUEUE = "supply_chain.frontier.StagePriorityQueue"
+SCHEDULER_DISK_QUEUE = "supply_chain.frontier.RequestDiskQueue"
+SCHEDULER_START_DISK_QUEUE = "supply_chain.frontier.RequestDiskQueue"
+SCHEDULER_MEMORY_QUEUE = "scrapy.squeues.FifoMemoryQueue"
+DUPEFILTER_CLASS = "supply_chain.frontier.DiskDupeFilter"
+
+# Review pages requested per run (0 for unlimited) and per product (0 for no cap), shared between products
+# by the recency-weighted number of new reviews their pages yield (see supply_chain/budget.py)
+REVIEWS_BUDGET = 0
+REVIEWS_MAX_PAGES = 5
+REVIEWS_RECENCY_HALF_LIFE_DAYS = 30
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
-#ITEM_PIPELINES = {
-#    "supply_chain.pipelines.SupplyChainPipeline": 300,
-#}
+ITEM_PIPELINES = {
+    "supply_chain.pipelines.DedupePipeline": 200,
+    "supply_chain.pipelines.CategoryLinksPipeline": 290,
+    "supply_chain.pipelines.JsonLinesStoragePipeline": 300,
+    "supply_chain.pipelines.ReviewsCsvPipeline": 310,
+    "supply_chain.pipelines.ParquetReviewsPipeline": 320,
+    "supply_chain.pipelines.ReviewIndexPipeline": 330,
+}
+
+# Persistent index of stored products and reviews, shared by all spiders (see supply_chain/dedupe.py)
+DEDUPE_PATH = "dedupe.sqlite3"
+# Reviews are also appended to this CSV file
+REVIEWS_CSV_PATH = "reviews.csv"
+# and written to Parquet files partitioned by category and crawl date (needs pyarrow)
+PARQUET_DIR = "reviews_parquet"
+PARQUET_BATCH_ITEMS = 5000
+# and added to a full-text and faceted index (python -m supply_chain.search query ...)
+REVIEW_INDEX_PATH = "reviews_index.sqlite3"
+# Normalized reviews, language and rating histograms built from reviews.csv by python -m supply_chain.enrich
+ENRICH_DIR = "enriched"
+
+# Append-only JSON Lines storage (see supply_chain/storage.py)
+STORAGE_DIR = "."
+# Directory of the product_links store read into the catalog ("" for STORAGE_DIR); shards write their
+# reviews to their own STORAGE_DIR and read the products of the main one
+PRODUCTS_DIR = ""
+# Number of items per batch handed to the writer threads
+STORAGE_FLUSH_ITEMS = 200
+# Size at which the active .jsonl segment is rotated
+STORAGE_ROTATE_BYTES = 64 * 1024 * 1024
+# Rewrite the legacy JSON array (e.g. product_links.json) when the spider closes
+STORAGE_EXPORT_JSON = False
+
+# Per-shard outputs of sharded review crawls, merged into the main ones (python -m supply_chain.sharding)
+SHARD_DIR = "shards"
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
-#AUTOTHROTTLE_ENABLED = True
+AUTOTHROTTLE_ENABLED = True
 # The initial download delay
-#AUTOTHROTTLE_START_DELAY = 5
+AUTOTHROTTLE_START_DELAY = 1
 # The maximum download delay to be set in case of high latencies
-#AUTOTHROTTLE_MAX_DELAY = 60
+AUTOTHROTTLE_MAX_DELAY = 60
 # The average number of requests Scrapy should be sending in parallel to
-# each remote server
-#AUTOTHROTTLE_TARGET_CONCURRENCY = 1.0
+# each remote server (override with: scrapy crawl <spider> -s AUTOTHROTTLE_TARGET_CONCURRENCY=2)
+AUTOTHROTTLE_TARGET_CONCURRENCY = 1.0
 # Enable showing throttling stats for every response received:
 #AUTOTHROTTLE_DEBUG = False
 
 # Enable and configure HTTP caching (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
-#HTTPCACHE_ENABLED = True
-#HTTPCACHE_EXPIRATION_SECS = 0
-#HTTPCACHE_DIR = "httpcache"
-#HTTPCACHE_IGNORE_HTTP_CODES = []
-#HTTPCACHE_STORAGE = "scrapy.extensions.httpcache.FilesystemCacheStorage"
+HTTPCACHE_ENABLED = True
+HTTPCACHE_EXPIRATION_SECS = 0
+HTTPCACHE_DIR = "httpcache"
+# Never cache throttling or error pages
+HTTPCACHE_IGNORE_HTTP_CODES = [403, 429, 500, 502, 503, 504]
+HTTPCACHE_STORAGE = "scrapy.extensions.httpcache.FilesystemCacheStorage"
+HTTPCACHE_GZIP = True
+# Per-spider freshness lifetimes with ETag/Last-Modified revalidation (see supply_chain/httpcache.py).
+# Spiders override HTTPCACHE_TTL in their custom_settings.
+HTTPCACHE_POLICY = "supply_chain.httpcache.TtlPolicy"
+HTTPCACHE_TTL = 24 * 3600
+# Replay from the cache only, ignoring pages that are not cached (scrapy crawl <spider> -s HTTPCACHE_OFFLINE=true)
+HTTPCACHE_OFFLINE = False
 
 # Set settings whose default value is deprecated to a future-proof value
 FEED_EXPORT_ENCODING = "utf-8"
@@ -0,0 +1,250 @@
+"""Sharded review crawls: several get_reviews processes over one product list.
+
+Each shard crawls the products whose slug hashes to it (``shard_of``), so the
+partition is stable across runs and machines. Shards read the products of
+the main product_links store (``PRODUCTS_DIR``), share the checkpoint store,
+and write everything else to their own directory (``SHARD_DIR/<shard>``): the
+reviews store, reviews.csv, the Parquet files, a copy of the dedupe index and
+the request frontier. ``merge`` appends the reviews to the main ones, going
+through the main dedupe index, and writes those it keeps to the main Parquet
+directory (when pyarrow is installed). All shards draw from one request budget
+(``RATE_BUDGET_PER_SEC``, see ``RateBudget``), so adding processes adds parse
+CPU, not load on the site.
+
+Usage from the project directory (where scrapy.cfg lives):
+
+    python -m supply_chain.sharding run --shards 4 -- -a max_pages=3
+    python -m supply_chain.sharding merge
+"""
+
+import argparse
+import csv
+import glob
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.project import get_project_settings
+
+from supply_chain.checkpoints import CheckpointStore
+from supply_chain.dedupe import DedupeIndex, review_key
+from supply_chain.items import ReviewItem
+from supply_chain.pipelines import ParquetReviewsPipeline, ReviewsCsvPipeline, join_text
+from supply_chain.storage import JsonLinesStore, active_path, iter_records, segment_paths, store_exists
+
+logger = logging.getLogger(__name__)
+
+
+def shard_of(slug: str, shards: int) -> int:
+    """Return the shard of a product slug; stable across processes, unlike hash()"""
+    digest = hashlib.blake2b(slug.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % shards
+
+
+def shard_dir(directory: str, shard: int) -> str:
+    return os.path.join(directory, f'{shard:03d}')
+
+
+class RateBudget:
+    """Request budget shared by the processes using the same SQLite file
+
+    Every request reserves the next free slot of its key (a domain): slots are
+    ``1 / rate`` seconds apart whatever the number of processes, and the
+    caller waits until its slot. Idle time is not saved up into bursts.
+    """
+
+    def __init__(self, path: str = 'ratelimit.sqlite3', rate: float = 1.0):
+        self.path = path
+        self.interval = 1 / rate
+        self.db = sqlite3.connect(path, isolation_level=None, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS slots (key TEXT PRIMARY KEY, next_at REAL NOT NULL) WITHOUT ROWID')
+
+    def reserve(self, key: str = '') -> float:
+        """Reserve the next slot of ``key``, return the seconds to wait for it"""
+        now = time.time()
+        # IMMEDIATE takes the write lock up front, so two processes never read the same slot
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.db.execute('SELECT next_at FROM slots WHERE key = ?', (key,)).fetchone()
+            slot = max(now, row[0]) if row else now
+            self.db.execute('''
+                INSERT INTO slots (key, next_at) VALUES (?, ?)
+                ON CONFLICT(key) DO UPDATE SET next_at = excluded.next_at
+            ''', (key, slot + self.interval))
+            self.db.execute('COMMIT')
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        return slot - now
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def merge_shard(directory: str, storage_dir: str, reviews_csv_path: str, index,
+                parquet: ParquetReviewsPipeline | None = None) -> tuple[int, int]:
+    """Append the reviews of a shard directory to the main stores, return (merged, duplicates)
+
+    The reviews merged are also written to the Parquet directory of ``parquet``.
+    Their keys are committed to ``index`` only once every output is closed, so
+    a merge interrupted midway is merged again in full rather than losing the
+    reviews written in part (only those may then be stored twice). The shard's
+    files are removed once merged, so merging again is a no-op.
+    """
+    if not store_exists('reviews', directory):
+        return 0, 0
+
+    merged = duplicates = 0
+    batch = []
+    index.hold()
+    store = JsonLinesStore('reviews', storage_dir)
+    try:
+        file_empty = (not os.path.exists(reviews_csv_path)) or (os.path.getsize(reviews_csv_path) == 0)
+        with open(reviews_csv_path, 'a', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=ReviewsCsvPipeline.fieldnames, extrasaction='ignore')
+            if file_empty:
+                writer.writeheader()
+            for record in iter_records('reviews', directory):
+                key = review_key(record.get('product_slug') or '', record.get('datetime'), record.get('title'))
+                if not index.add(key):
+                    duplicates += 1
+                    continue
+                store.append(record)
+                writer.writerow({**record, 'text': join_text(record.get('text'))})
+                merged += 1
+                if parquet is not None:
+                    batch.append(ReviewItem(**record))
+                    if len(batch) >= parquet.batch_items:
+                        parquet.write_batch('reviews', batch)
+                        batch = []
+        if parquet is not None and batch:
+            parquet.write_batch('reviews', batch)
+        store.close()
+    except BaseException:
+        # Not committed by index.close() either: the shard is merged again in full
+        index.drop_held()
+        raise
+    index.commit_held()
+
+    for path in segment_paths('reviews', directory) + [active_path('reviews', directory),
+                                                        os.path.join(directory, 'reviews.csv')]:
+        if os.path.exists(path):
+            os.remove(path)
+    # The shard's Parquet files hold the duplicates too: the merged reviews were written again above
+    shutil.rmtree(os.path.join(directory, 'reviews_parquet'), ignore_errors=True)
+    return merged, duplicates
+
+
+def merge(settings) -> int:
+    """Merge every shard directory, return the number of reviews merged"""
+    index = DedupeIndex(settings.get('DEDUPE_PATH', 'dedupe.sqlite3'))
+    try:
+        parquet = ParquetReviewsPipeline(settings, None)
+    except NotConfigured:
+        parquet = None
+    total = 0
+    try:
+        for directory in sorted(glob.glob(os.path.join(settings.get('SHARD_DIR', 'shards'), '[0-9]*'))):
+            merged, duplicates = merge_shard(directory, settings.get('STORAGE_DIR', '.'),
+                                             settings.get('REVIEWS_CSV_PATH', 'reviews.csv'), index, parquet)
+            if merged or duplicates:
+                logger.info("Merged %s reviews from %s (%s duplicates dropped)", merged, directory, duplicates)
+            total += merged
+    finally:
+        index.close()
+    return total
+
+
+def prepare(settings, shards: int) -> list[str]:
+    """Create the shard directories and seed the state the shards share, return the directories"""
+    # get_reviews imports this module
+    from supply_chain.spiders.get_reviews import GetReviewsSpider
+
+    # One-time imports done here rather than raced by every shard
+    checkpoints = CheckpointStore(settings.get('CHECKPOINT_PATH', 'checkpoints.sqlite3'))
+    checkpoints.import_reviewed_slugs(GetReviewsSpider.reviewed_slugs_path)
+    checkpoints.import_review_marks(settings.get('REVIEWS_CSV_PATH', 'reviews.csv'))
+    checkpoints.close()
+
+    # Every shard starts from a copy of the main index, so it drops what is already stored
+    index = DedupeIndex(settings.get('DEDUPE_PATH', 'dedupe.sqlite3'))
+    if not len(index):
+        index.seed(settings.get('STORAGE_DIR', '.'), settings.get('REVIEWS_CSV_PATH', 'reviews.csv'))
+
+    directories = []
+    for shard in range(shards):
+        directory = shard_dir(settings.get('SHARD_DIR', 'shards'), shard)
+        os.makedirs(directory, exist_ok=True)
+        index.copy_to(os.path.join(directory, 'dedupe.sqlite3'))
+        directories.append(directory)
+    index.close()
+    return directories
+
+
+def run(settings, shards: int, rate: float, scrapy_args: list[str]) -> int:
+    """Crawl the shards in parallel processes, return the number of failed shards"""
+    processes = []
+    for shard, directory in enumerate(prepare(settings, shards)):
+        command = [
+            sys.executable, '-m', 'scrapy', 'crawl', 'get_reviews',
+            '-a', 'mode=all', '-a', f'shard={shard}', '-a', f'shards={shards}',
+            '-s', f'STORAGE_DIR={directory}',
+            '-s', f'PRODUCTS_DIR={settings.get("PRODUCTS_DIR") or settings.get("STORAGE_DIR", ".")}',
+            '-s', f'REVIEWS_CSV_PATH={os.path.join(directory, "reviews.csv")}',
+            '-s', f'DEDUPE_PATH={os.path.join(directory, "dedupe.sqlite3")}',
+            '-s', f'PARQUET_DIR={os.path.join(directory, "reviews_parquet")}',
+            '-s', f'FRONTIER_DIR={os.path.join(directory, "frontier")}',
+            '-s', f'RATE_BUDGET_PER_SEC={rate}',
+            '-s', f'LOG_FILE={os.path.join(directory, "crawl.log")}',
+            *scrapy_args,
+        ]
+        logger.info("Starting shard %s/%s, logging to %s", shard, shards, os.path.join(directory, 'crawl.log'))
+        processes.append(subprocess.Popen(command))
+
+    failed = 0
+    for shard, process in enumerate(processes):
+        if process.wait() != 0:
+            logger.error("Shard %s exited with code %s", shard, process.returncode)
+            failed += 1
+    return failed
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help="crawl the reviews in parallel shards, then merge them")
+    run_parser.add_argument('--shards', type=int, default=os.cpu_count() or 1, help="number of processes")
+    run_parser.add_argument('--rate', type=float, default=None,
+                            help="requests per second shared by all shards (default: RATE_BUDGET_PER_SEC, "
+                                 "or one request per DOWNLOAD_DELAY)")
+    run_parser.add_argument('--no-merge', action='store_true', help="leave the outputs in the shard directories")
+    run_parser.add_argument('scrapy_args', nargs=argparse.REMAINDER,
+                            help="extra arguments for scrapy crawl, after --")
+    commands.add_parser('merge', help="merge the outputs of the shard directories")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(name)s] %(levelname)s: %(message)s')
+    settings = get_project_settings()
+
+    if args.command == 'merge':
+        merge(settings)
+        return 0
+
+    rate = args.rate or settings.getfloat('RATE_BUDGET_PER_SEC') or 1 / (settings.getfloat('DOWNLOAD_DELAY') or 1)
+    scrapy_args = [arg for arg in args.scrapy_args if arg != '--']
+    failed = run(settings, args.shards, rate, scrapy_args)
+    if not args.no_merge:
+        merge(settings)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
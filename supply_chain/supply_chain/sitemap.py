@@ -0,0 +1,115 @@
+"""Incremental parsing of XML sitemaps.
+
+Sitemaps (https://www.sitemaps.org/protocol.html) list up to 50,000 page URLs
+per file, often gzipped (``.xml.gz``), and sitemap indexes list sitemaps. A
+category listing page names about twenty products where a sitemap file names
+thousands, so discovering products from the sitemaps takes a handful of
+requests (see the get_products_sitemap spider).
+
+``iter_sitemap`` decompresses and parses a file chunk by chunk with a pull
+parser, and drops every entry once read: memory does not grow with the number
+of URLs in the file, and a file that decompresses past ``max_bytes`` is
+rejected before it is inflated.
+"""
+
+import re
+import zlib
+from collections.abc import Iterable, Iterator
+from urllib.parse import urlsplit
+from xml.etree.ElementTree import ParseError, XMLPullParser
+
+GZIP_MAGIC = b'\x1f\x8b'
+CHUNK_SIZE = 64 * 1024
+
+# Size limit of an uncompressed sitemap in the protocol
+MAX_SITEMAP_BYTES = 50 * 1024 * 1024
+
+# Root elements of the two kinds of sitemap files, and the tag of their entries
+ENTRY_TAGS = {'sitemapindex': 'sitemap', 'urlset': 'url'}
+
+REVIEW_PATH = re.compile(r'/review/([^/]+)/?')
+
+
+class SitemapError(ValueError):
+    """A file that is not a readable sitemap"""
+
+
+def review_slug(url: str) -> str | None:
+    """Return the product slug of a ``/review/<slug>`` URL, None for any other page"""
+    match = REVIEW_PATH.fullmatch(urlsplit(url).path)
+    return match.group(1) if match else None
+
+
+def _local_name(tag: str) -> str:
+    return tag.rpartition('}')[2]
+
+
+def _chunks(data: bytes) -> Iterator[memoryview]:
+    view = memoryview(data)
+    for start in range(0, len(view), CHUNK_SIZE):
+        yield view[start:start + CHUNK_SIZE]
+
+
+def _inflate(chunks: Iterable[bytes], max_bytes: int) -> Iterator[bytes]:
+    """Yield the XML of a plain or gzipped file, at most ``CHUNK_SIZE`` bytes at a time when gzipped"""
+    decompressor = None
+    size = 0
+    for index, chunk in enumerate(chunks):
+        if index == 0 and bytes(chunk[:2]) == GZIP_MAGIC:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while chunk:
+            if decompressor is None:
+                data, chunk = chunk, b''
+            else:
+                data = decompressor.decompress(chunk, CHUNK_SIZE)
+                chunk = decompressor.unconsumed_tail
+            size += len(data)
+            if size > max_bytes:
+                raise SitemapError(f"sitemap larger than {max_bytes} bytes")
+            yield data
+    if decompressor is not None:
+        yield decompressor.flush()
+
+
+def _feed(parser: XMLPullParser, xml: Iterable[bytes]) -> Iterator[None]:
+    """Feed ``parser`` chunk by chunk, yielding whenever it may have events to read"""
+    for data in xml:
+        parser.feed(data)
+        yield
+    parser.close()
+    yield
+
+
+def iter_sitemap(data: bytes | Iterable[bytes], max_bytes: int = MAX_SITEMAP_BYTES) -> Iterator[tuple[str, str]]:
+    """Yield ``(kind, url)`` for every entry of a sitemap index or urlset, plain or gzipped
+
+    ``kind`` is ``'sitemap'`` for the entries of a sitemap index and ``'url'``
+    for those of a urlset. ``data`` is the file or an iterable of its chunks.
+    Raises ``SitemapError`` when the file is not a sitemap or is malformed.
+    """
+    chunks = _chunks(data) if isinstance(data, (bytes, bytearray)) else data
+    parser = XMLPullParser(events=('start', 'end'))
+    root = None
+    entry_tag = None
+    depth = 0
+    try:
+        for _ in _feed(parser, _inflate(chunks, max_bytes)):
+            for event, element in parser.read_events():
+                if event == 'start':
+                    depth += 1
+                    if root is None:
+                        root = element
+                        entry_tag = ENTRY_TAGS.get(_local_name(element.tag))
+                        if entry_tag is None:
+                            raise SitemapError(f"not a sitemap: <{_local_name(element.tag)}> root element")
+                    continue
+                depth -= 1
+                if depth != 1 or _local_name(element.tag) != entry_tag:
+                    continue
+                loc = next((child.text for child in element if _local_name(child.tag) == 'loc'), None)
+                # Entries are not needed once read
+                root.clear()
+                if loc and loc.strip():
+                    yield 'sitemap' if entry_tag == 'sitemap' else 'url', loc.strip()
+    except (ParseError, zlib.error) as e:
+        raise SitemapError(str(e)) from e
@@ -0,0 +1,131 @@
+from collections import deque
+from dataclasses import asdict
+
+import scrapy
+
+from supply_chain.frontier import mark_seeded, resuming
+from supply_chain.items import ProductItem
+from supply_chain.spiders.get_categories import GetCategorySpider
+from supply_chain.spiders.get_products import GetProductsSpider
+from supply_chain.spiders.get_reviews import GetReviewsSpider
+
+class GetAllSpider(GetReviewsSpider, GetProductsSpider, GetCategorySpider):
+    """Crawl categories, products and reviews in a single run
+
+    Each category found is followed to its listing pages straight away, and
+    each product found to its review pages, so the three stages overlap
+    instead of waiting for each other through category_links.json and the
+    product_links store. Stages share the scheduler, which takes requests
+    from each stage in turn (``FRONTIER_STAGE_WEIGHTS``, see
+    supply_chain/frontier.py). With a frontier directory products are queued
+    on disk as soon as they are found; without one at most ``window``
+    products have their reviews crawled at the same time and the others wait
+    in memory.
+
+    Spider arguments: ``window``, ``refresh``, ``budget`` and ``max_pages``
+    as in get_reviews, ``restart`` as in get_products. Checkpoints are shared
+    with the separate spiders, and products stored by earlier runs whose
+    reviews are not done yet are scheduled as well.
+    """
+
+    name = "get_all"
+    # Reviews settings; categories and listings set their lifetime per request
+    custom_settings = {
+        'HTTPCACHE_TTL': 3600,
+    }
+    stage_ttls = {
+        'categories': GetCategorySpider.custom_settings['HTTPCACHE_TTL'],
+        'products': GetProductsSpider.custom_settings['HTTPCACHE_TTL'],
+    }
+
+    def __init__(self, window: int | None = None, restart: str = 'false', refresh: str = 'false', *args, **kwargs):
+        super().__init__(*args, mode='all', window=window, refresh=refresh, restart=restart, **kwargs)
+        self._category_progress: dict = {}
+        self._category_counts: dict = {}
+        # Without a frontier: products scheduled in this run, and those waiting for a window slot
+        self._scheduled: set[str] = set()
+        self._waiting: deque = deque()
+        self._active = 0
+
+    async def start(self):
+        self._load_review_state()
+        self._check_window()
+        resume = resuming(self)
+        if self.restart and not resume:
+            self.checkpoints.reset('categories')
+        self._category_progress = self.checkpoints.progress('categories')
+        self._category_counts = self.checkpoints.page_counts('categories')
+        if resume:
+            self.logger.info("Resuming the requests queued in the frontier %s", self.settings.get('JOBDIR'))
+            return
+        mark_seeded(self, False)
+
+        yield self._stage(scrapy.Request(self.base_url + '/categories', callback=self.parse_categories), 'categories')
+
+        # Products of earlier runs whose categories may already be done
+        if self._open_catalog():
+            self.catalog.queue(self.checkpoints.path, 'file', self.refresh)
+            for product, _ in self.catalog.queued():
+                for request in self._schedule_product(product):
+                    yield request
+        mark_seeded(self)
+
+    def parse_categories(self, response: scrapy.http.Response):
+        for category in super().parse_categories(response):
+            yield category
+            next_page, done = self._category_progress.get(category.slug, (1, False))
+            if done:
+                self.logger.debug("Category %s already crawled, skipped", category.slug)
+                continue
+            for request in self._category_requests(asdict(category), next_page,
+                                                   self._category_counts.get(category.slug)):
+                yield self._stage(request, 'products')
+
+    def get_products(self, response: scrapy.http.Response, category_name: str, category_slug: str,
+                     paginate: bool = True):
+        for result in super().get_products(response, category_name, category_slug, paginate):
+            if isinstance(result, scrapy.Request):
+                yield self._stage(result, 'products')
+                continue
+            yield result
+            if isinstance(result, ProductItem):
+                yield from self._schedule_product(result.to_record())
+
+    def _stage(self, request: scrapy.Request, stage: str) -> scrapy.Request:
+        """Give a request the cache lifetime of its stage"""
+        if stage in self.stage_ttls:
+            request.meta['httpcache_ttl'] = self.stage_ttls[stage]
+        return request
+
+    def _schedule_product(self, product: dict):
+        """Yield the first review request of a product, or queue it when the window is full"""
+        slug = next(iter(product), None)
+        if slug is None:
+            return
+        next_page, done = self._product_progress(slug)
+        if done:
+            return
+        if self.settings.get('JOBDIR'):
+            # Queued on disk; the duplicate filter drops the pages of products found twice
+            if self.budget.start():
+                yield self._product_request(product, start_page=next_page)
+            return
+        # Requests holding a window slot skip the duplicate filter (see ``windowed``): products found twice stop here
+        if slug in self._scheduled:
+            return
+        self._scheduled.add(slug)
+
+        if self._active < self.window:
+            if self.budget.start():
+                self._active += 1
+                yield self._product_request(product, start_page=next_page)
+        else:
+            self._waiting.append((product, next_page))
+
+    def _next_product_request(self) -> scrapy.Request | None:
+        self._active -= 1
+        if not self._waiting or not self.budget.start():
+            return None
+        product, next_page = self._waiting.popleft()
+        self._active += 1
+        return self._product_request(product, start_page=next_page)
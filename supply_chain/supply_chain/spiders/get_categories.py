@@ -1,12 +1,22 @@
-import json
 import scrapy
 
+from supply_chain.items import CategoryItem
+
 class GetCategorySpider(scrapy.Spider):
     name = "get_categories"
+    # The category list rarely changes
+    custom_settings = {
+        'HTTPCACHE_TTL': 7 * 24 * 3600,
+    }
+
+    @property
+    def base_url(self) -> str:
+        """Site crawled, ``TRUSTPILOT_BASE_URL`` (a local mock site in load tests)"""
+        return self.settings.get('TRUSTPILOT_BASE_URL', 'https://fr.trustpilot.com')
 
     async def start(self):
         urls = [
-            "https://fr.trustpilot.com/categories",
+            self.base_url + "/categories",
         ]
         for url in urls:
             yield scrapy.Request(url=url, callback=self.parse_categories)
@@ -33,20 +43,11 @@ class GetCategorySpider(scrapy.Spider):
             self.logger.error("Could not find any category links")
             return None
 
-        # Extract href and text from category links into JSON structure
-        categories_json = []
-
+        # Extract href and text from category links; CategoryLinksPipeline writes category_links.json
         for link in category_links:
             href = link.attrib.get('href')
             name = link.css('::text').get()
             if href and name:
                 # Extract slug from href by removing /categories/ prefix
                 slug = href.replace('/categories/', '')
-                categories_json.append({
-                    'link': href,
-                    'name': name.strip(),
-                    'slug': slug
-                })
-        # Save categories_json to file
-        with open('category_links.json', 'w', encoding='utf-8') as f:
-            json.dump(categories_json, f, ensure_ascii=False, indent=2)
+                yield CategoryItem(link=href, name=name.strip(), slug=slug)
@@ -1,45 +1,157 @@
 import json
-from time import sleep
-from urllib.parse import urlparse, parse_qs
 
 import scrapy
 
+from urllib.parse import urlsplit
+
+from supply_chain.catalog import ProductCatalog
+from supply_chain.checkpoints import CheckpointStore, get_held_state, page_from_url, page_url
+from supply_chain.extract import last_page
+from supply_chain.frontier import mark_seeded, resuming
+from supply_chain.items import ProductItem
+
 class GetProductsSpider(scrapy.Spider):
+    """Crawl the product listing pages of every category in category_links.json
+
+    Page 1 of a category gives its page count, and the remaining pages are
+    requested at once (``CATEGORY_FAN_OUT``) instead of following the next
+    button page after page; concurrency and throttling settings still apply.
+    Categories without a readable page count are paginated through the next
+    button.
+
+    Pagination progress is recorded in the checkpoint store after every page:
+    finished categories are skipped and interrupted ones resume at their
+    unparsed pages. Use ``-a restart=true`` to crawl every category again.
+    With a frontier directory (supply_chain/frontier.py) the pages waiting
+    for a download are queued on disk, and an interrupted run resumes from
+    them.
+    """
+
     name = "get_products"
+    custom_settings = {
+        'HTTPCACHE_TTL': 24 * 3600,
+    }
+
+    def __init__(self, restart: str = 'false', *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.restart = str(restart).lower() in ('1', 'true', 'yes')
+        self.checkpoints = None
+        self.catalog = None
+
+    @property
+    def base_url(self) -> str:
+        """Site crawled, ``TRUSTPILOT_BASE_URL`` (a local mock site in load tests)"""
+        return self.settings.get('TRUSTPILOT_BASE_URL', 'https://fr.trustpilot.com')
 
     async def start(self):
         """Parse the category page and extract all product information"""
 
-        # Load products from JSON file
+        self.checkpoints = CheckpointStore(self.settings.get('CHECKPOINT_PATH', 'checkpoints.sqlite3'))
+        # Progress is committed once the items parsed before it are stored
+        get_held_state(self.crawler).hold(self.checkpoints)
+        if resuming(self):
+            self.logger.info("Resuming the listing pages queued in the frontier %s", self.settings.get('JOBDIR'))
+            return
+        mark_seeded(self, False)
+        if self.restart:
+            self.checkpoints.reset('categories')
+        progress = self.checkpoints.progress('categories')
+        page_counts = self.checkpoints.page_counts('categories')
+
+        # Load categories from JSON file, through the catalog which only parses it again when it changes
+        self.catalog = ProductCatalog(self.settings.get('CATALOG_PATH', 'catalog.sqlite3'))
         try:
-            with open('category_links.json', 'r', encoding='utf-8') as f:
-                categories = json.load(f)
-            base_url = "https://fr.trustpilot.com"
-
+            self.catalog.sync_categories('category_links.json')
 
-            for category in categories:
-                category_url = base_url + category['link']
-
-                yield scrapy.Request(
-                    url=category_url,
-                    callback=self.get_products,
-                    cb_kwargs={
-                        'category_slug': category['slug'],
-                        'category_name': category['name'],
-                    }
-                )
+            for category in self.catalog.categories():
+                next_page, done = progress.get(category['slug'], (1, False))
+                if done:
+                    self.logger.debug("Category %s already crawled, skipped", category['slug'])
+                    continue
+                for request in self._category_requests(category, next_page, page_counts.get(category['slug'])):
+                    yield request
+            mark_seeded(self)
 
         except FileNotFoundError:
             self.logger.error("Could not find category links json file")
         except json.JSONDecodeError:
             self.logger.error("Invalid JSON in categories.json file") 
 
-
-    def get_products(self, response: scrapy.http.Response, category_name: str, category_slug: str):
+    def _category_requests(self, category: dict, next_page: int = 1,
+                           page_count: tuple[int, set[int]] | None = None) -> list[scrapy.Request]:
+        """Return the requests resuming a category: its unparsed pages when its page count is known
+
+        The last page is paginated, like in a fan-out, to follow the pages added since.
+        """
+        if page_count is None:
+            return [self._category_request(category, next_page)]
+        pages, parsed = page_count
+        missing = [page for page in range(1, pages + 1) if page not in parsed]
+        self.logger.info("Resuming category %s, %s of %s pages left", category['slug'], len(missing), pages)
+        return [self._listing_request(page_url(self.base_url + category['link'], page), category['name'],
+                                      category['slug'], paginate=page == pages) for page in missing]
+
+    def _category_request(self, category: dict, next_page: int = 1, paginate: bool = True) -> scrapy.Request:
+        if next_page > 1 and paginate:
+            self.logger.info("Resuming category %s at page %s", category['slug'], next_page)
+        return self._listing_request(page_url(self.base_url + category['link'], next_page),
+                                     category['name'], category['slug'], paginate)
+
+    def _listing_request(self, url: str, category_name: str, category_slug: str, paginate: bool = True,
+                         priority: int = 0) -> scrapy.Request:
+        return scrapy.Request(
+            url=url,
+            callback=self.get_products,
+            priority=priority,
+            cb_kwargs={
+                'category_slug': category_slug,
+                'category_name': category_name,
+                'paginate': paginate,
+            }
+        )
+
+    def get_products(self, response: scrapy.http.Response, category_name: str, category_slug: str,
+                     paginate: bool = True):
         """Parse the category page and extract all company information"""
-                # Find categories div container
-        sleep(1)
-
+        yield from self._product_items(response, category_name, category_slug)
+
+        page = page_from_url(response.url) or 1
+        if not paginate:
+            # A page requested by a fan-out, the other pages are already requested
+            self._mark_listing_page(category_slug, page)
+            return
+
+        pages = last_page(response) if self.settings.getbool('CATEGORY_FAN_OUT', True) else None
+        if pages and pages > page:
+            self.checkpoints.set_page_count('categories', category_slug, pages)
+            self._mark_listing_page(category_slug, page)
+            self.logger.info("Category %s has %s pages, requesting pages %s to %s", category_slug, pages, page + 1, pages)
+            self.crawler.stats.inc_value('products/fan_out_pages', pages - page, spider=self)
+            listing_url = urlsplit(response.url)._replace(query='', fragment='').geturl()
+            # The last page is paginated: it follows the pages added to the category since page 1 was parsed
+            for next_page in range(page + 1, pages + 1):
+                yield self._listing_request(page_url(listing_url, next_page), category_name, category_slug,
+                                            paginate=next_page == pages, priority=response.request.priority)
+            return
+
+        next_request = self._next_listing_request(response, category_name, category_slug)
+        if pages and page > 1:
+            # The last page of a fan-out: the category is done once every page is parsed, or has grown
+            next_page = (page_from_url(next_request.url) or page + 1) if next_request is not None else page
+            self.checkpoints.set_page_count('categories', category_slug, next_page)
+            self._mark_listing_page(category_slug, page)
+            if next_request is not None:
+                yield next_request
+            return
+        if next_request is not None:
+            self.checkpoints.set_page('categories', category_slug, page_from_url(next_request.url) or 1)
+            yield next_request
+        else:
+            self.checkpoints.finish('categories', category_slug)
+
+    def _product_items(self, response: scrapy.http.Response, category_name: str, category_slug: str):
+        """Yield a ``ProductItem`` for every product linked from a listing page"""
+        # Find products div container
         products_div = response.xpath('//div[starts-with(@class, "categorylayout_leftSection")]')
         if not products_div:
             self.logger.error("Could not find products div container")
@@ -54,63 +166,52 @@ class GetProductsSpider(scrapy.Spider):
         if not products_links:
             self.logger.error("Could not find any product links")
 
-        # Extract product links and create JSON structure
-        products_json = []
-        
+        # Extract product links; products already stored are dropped by the dedupe pipeline
+        page_slugs = set()
+
         for link in products_links:
             href = link.attrib.get('href')
             product_slug = href.split('/')[-1]
             if href and product_slug:
-                if product_slug in products_json:
-                    self.logger.info("Product %s already in products json, operation skipped", product_slug)
+                if product_slug in page_slugs:
+                    self.logger.debug("Product %s already found on this page, operation skipped", product_slug)
                     continue
-                products_json.append({
-                    product_slug : {
-                        'product_link': href,
-                        'category_slug': category_slug,
-                        'category_name': category_name
-                    }
-                })
-
-        # Initialize json_content
-        json_content = []
-        
-        # Try to read existing product links json file
-        try:
-            with open('product_links.json', 'r', encoding='utf-8') as f:
-                json_content = json.load(f)
-        except FileNotFoundError:
-            # File doesn't exist yet, will be created when writing
-            pass
-        except json.JSONDecodeError:
-            self.logger.error("Invalid JSON in products.json file")
-
-        new_content = json_content + products_json
-
-        with open(f'product_links.json', 'w', encoding='utf-8') as f:
-            json.dump(new_content, f, ensure_ascii=False, indent=2)
+                page_slugs.add(product_slug)
+                yield ProductItem(
+                    product_slug=product_slug,
+                    product_link=href,
+                    category_slug=category_slug,
+                    category_name=category_name,
+                )
 
+    def _next_listing_request(self, response: scrapy.http.Response, category_name: str, category_slug: str):
+        """Return the request for the next listing page, or None when the category is done"""
         # Pagination: look for the next page button; only follow if not disabled
         next_button = response.xpath('//a[@name="pagination-button-next"]')
 
-        if next_button.get():
-            aria_disabled = (next_button.xpath('@aria-disabled').get() or '').lower()
-            next_href = next_button.xpath('@href').get()
-            is_disabled = (aria_disabled == 'true') or (not next_href)
+        if not next_button.get():
+            return None
+
+        aria_disabled = (next_button.xpath('@aria-disabled').get() or '').lower()
+        next_href = next_button.xpath('@href').get()
+        is_disabled = (aria_disabled == 'true') or (not next_href)
+
+        if is_disabled:
+            self.logger.info("Next pagination button is disabled; stopping pagination for this category: %s", category_slug)
+            return None
+
+        next_url = response.urljoin(next_href)
 
-            if is_disabled:
-                self.logger.info("Next pagination button is disabled; stopping pagination for this category: %s", category_slug)
-                return
+        self.logger.info("Next pagination button found, following the link: %s", next_url)
 
-            next_url = response.urljoin(next_href)
+        return self._listing_request(next_url, category_name, category_slug, priority=response.request.priority)
 
-            self.logger.info("Next pagination button found, following the link: %s", next_url)
+    def _mark_listing_page(self, category_slug: str, page: int) -> None:
+        if self.checkpoints.mark_page('categories', category_slug, page):
+            self.logger.info("Every page of category %s parsed", category_slug)
 
-            yield scrapy.Request(
-                url=next_url,
-                callback=self.get_products,
-                cb_kwargs={
-                    'category_slug': category_slug,
-                    'category_name': category_name,
-                }
-            )
+    def closed(self, reason):
+        if self.checkpoints is not None:
+            self.checkpoints.close()
+        if self.catalog is not None:
+            self.catalog.close()
@@ -0,0 +1,194 @@
+import json
+import re
+from urllib.parse import urljoin
+
+import scrapy
+from scrapy.utils.sitemap import sitemap_urls_from_robots
+
+from supply_chain.catalog import ProductCatalog
+from supply_chain.items import ProductItem
+from supply_chain.sitemap import SitemapError, iter_sitemap, review_slug
+from supply_chain.spiders.get_products import GetProductsSpider
+
+
+class GetProductsSitemapSpider(GetProductsSpider):
+    """Find products in the site's XML sitemaps instead of paginating every category listing
+
+    The sitemaps (``SITEMAP_URLS``: sitemap indexes, sitemaps, plain or
+    gzipped, or robots.txt files declaring them) name the ``/review/<slug>``
+    page of every product, thousands per file. Products missing from the
+    catalog are yielded as soon as their sitemap is read, without a category,
+    so the whole catalog takes one request per sitemap file and get_reviews
+    can crawl them straight away.
+
+    Their category is then looked for in the category listings, which are
+    paginated (every category at once, each one page after the other) only
+    until every product without a category has turned up in one, and yielded
+    again with it for the catalog to attach: a run that leaves no product
+    without a category requests no listing page at all. Products that no
+    listing shows are recorded as unlisted in the catalog and not looked for
+    again, unless ``-a restart=true``. With ``-a categories=false`` no listing
+    page is requested and the categories are left to a later run.
+
+    Products are yielded like get_products yields them, to the same stores.
+    """
+
+    name = "get_products_sitemap"
+    custom_settings = {
+        'HTTPCACHE_TTL': 24 * 3600,
+        # A short crawl whose progress lives in the spider: nothing to resume from disk
+        'FRONTIER_DIR': '',
+    }
+
+    def __init__(self, categories: str = 'true', *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.attach_categories = str(categories).lower() in ('1', 'true', 'yes')
+        # Products without a category, waiting for a listing page to give it
+        self.pending: set[str] = set()
+        self.sitemaps_seen: set[str] = set()
+        self.sitemaps_left = 0
+        self.categories_left = 0
+        self.listing_failures = 0
+        self.follow: list[re.Pattern] = []
+
+    async def start(self):
+        """Request the sitemaps; the listings are requested once every sitemap is read"""
+        self.catalog = ProductCatalog(self.settings.get('CATALOG_PATH', 'catalog.sqlite3'))
+        try:
+            self.catalog.sync_categories('category_links.json')
+        except FileNotFoundError:
+            self.logger.error("Could not find category links json file")
+            return
+        except json.JSONDecodeError:
+            self.logger.error("Invalid JSON in categories.json file")
+            return
+        count = self.catalog.sync(self.settings.get('PRODUCTS_DIR') or self.settings.get('STORAGE_DIR', '.'))
+        if count:
+            self.logger.info("Added %s products to the catalog %s", count, self.catalog.path)
+        if self.restart:
+            self.catalog.clear_unlisted()
+        if self.attach_categories:
+            # Found by earlier runs whose listings were not all read
+            self.pending = self.catalog.uncategorized()
+
+        self.follow = [re.compile(pattern) for pattern in self.settings.getlist('SITEMAP_FOLLOW')]
+        for url in self.settings.getlist('SITEMAP_URLS', ['/sitemap.xml']):
+            request = self._sitemap_request(urljoin(self.base_url + '/', url))
+            if request is not None:
+                yield request
+
+    def _sitemap_request(self, url: str) -> scrapy.Request | None:
+        """Return the request of a sitemap, None when it was requested already"""
+        if url in self.sitemaps_seen:
+            return None
+        self.sitemaps_seen.add(url)
+        self.sitemaps_left += 1
+        # Counted until their callback or errback runs, so never dropped by the dupefilter
+        return scrapy.Request(url, callback=self.parse_sitemap, errback=self.sitemap_failed, dont_filter=True)
+
+    def parse_sitemap(self, response: scrapy.http.Response):
+        """Read a robots.txt, sitemap index or sitemap: follow the sitemaps and yield the new products"""
+        if response.url.endswith('/robots.txt'):
+            for url in sitemap_urls_from_robots(response.body.decode('utf-8', 'replace'), base_url=response.url):
+                request = self._sitemap_request(url)
+                if request is not None:
+                    yield request
+            yield from self._sitemap_done()
+            return
+
+        stats = self.crawler.stats
+        sitemaps = products = new = 0
+        try:
+            for kind, url in iter_sitemap(response.body, self.settings.getint('SITEMAP_MAX_BYTES', 50 * 1024 * 1024)):
+                if kind == 'sitemap':
+                    sitemaps += 1
+                    if not self.follow or any(pattern.search(url) for pattern in self.follow):
+                        request = self._sitemap_request(response.urljoin(url))
+                        if request is not None:
+                            yield request
+                    continue
+                slug = review_slug(url)
+                if slug is None:
+                    continue
+                products += 1
+                if self.catalog.known(slug):
+                    continue
+                new += 1
+                if self.attach_categories:
+                    self.pending.add(slug)
+                # Products named by several sitemaps are dropped by the dedupe pipeline
+                yield ProductItem(product_slug=slug, product_link=f'/review/{slug}', category_slug='',
+                                  category_name='')
+        except SitemapError as e:
+            self.logger.error("Could not read the sitemap %s: %s", response.url, e)
+            stats.inc_value('sitemap/invalid', spider=self)
+
+        if sitemaps:
+            self.logger.info("Sitemap index %s: %s sitemaps", response.url, sitemaps)
+        else:
+            self.logger.info("Sitemap %s: %s products, %s new", response.url, products, new)
+        stats.inc_value('sitemap/files', spider=self)
+        stats.inc_value('sitemap/products', products, spider=self)
+        stats.inc_value('sitemap/new_products', new, spider=self)
+        yield from self._sitemap_done()
+
+    def sitemap_failed(self, failure):
+        self.logger.error("Could not download the sitemap %s: %s", failure.request.url, failure.value)
+        yield from self._sitemap_done()
+
+    def _sitemap_done(self):
+        """Once the last sitemap is read, request the first listing page of every category"""
+        self.sitemaps_left -= 1
+        if self.sitemaps_left > 0:
+            return
+        if not self.attach_categories:
+            return
+        if not self.pending:
+            self.logger.info("No product without a category, no listing page requested")
+            return
+        self.logger.info("%s products without a category, looking for it in the listings", len(self.pending))
+        for category in self.catalog.categories():
+            self.categories_left += 1
+            yield self._category_request(category)
+
+    def _listing_request(self, url: str, category_name: str, category_slug: str, paginate: bool = True,
+                         priority: int = 0) -> scrapy.Request:
+        request = super()._listing_request(url, category_name, category_slug, paginate, priority)
+        return request.replace(errback=self.listing_failed)
+
+    def get_products(self, response: scrapy.http.Response, category_name: str, category_slug: str,
+                     paginate: bool = True):
+        """Parse a listing page; follow the next one while some products have no category yet"""
+        attached = 0
+        for item in self._product_items(response, category_name, category_slug):
+            if item.product_slug in self.pending:
+                self.pending.discard(item.product_slug)
+                attached += 1
+            yield item
+        self.crawler.stats.inc_value('sitemap/attached', attached, spider=self)
+
+        next_request = self._next_listing_request(response, category_name, category_slug) if self.pending else None
+        if next_request is not None:
+            yield next_request
+        else:
+            self._category_done()
+
+    def listing_failed(self, failure):
+        self.logger.error("Could not download the listing page %s: %s", failure.request.url, failure.value)
+        self.listing_failures += 1
+        self._category_done()
+
+    def _category_done(self) -> None:
+        """Record the products left without a category once every listing is exhausted"""
+        self.categories_left -= 1
+        if self.categories_left > 0 or not self.pending:
+            return
+        if self.listing_failures:
+            # Their category may be on a listing page that failed: looked for again next run
+            self.logger.warning("%s products of the sitemaps not found in the listings, %s listing pages failed",
+                                len(self.pending), self.listing_failures)
+            return
+        self.logger.info("%s products of the sitemaps are in no listing, recorded as unlisted", len(self.pending))
+        self.crawler.stats.set_value('sitemap/unlisted', len(self.pending), spider=self)
+        self.catalog.add_unlisted(self.pending)
+        self.pending.clear()
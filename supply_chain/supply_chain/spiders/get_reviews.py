@@ -1,239 +1,345 @@
-import json
-import csv
-import os
-import random
-from urllib.parse import urlparse, parse_qs
 import scrapy
 
+from supply_chain.budget import PageBudget
+from supply_chain.catalog import ProductCatalog
+from supply_chain.checkpoints import CheckpointStore, get_held_state, page_from_url, page_url
+from supply_chain.extract import extract_reviews
+from supply_chain.frontier import mark_seeded, product_priority, resuming
+from supply_chain.items import ReviewItem
+
 class GetReviewsSpider(scrapy.Spider):
+    """Crawl the reviews of products listed in the product_links store
+
+    Products are picked from the product catalog (supply_chain/catalog.py),
+    which reads only the products stored since the previous run.
+
+    Spider arguments (``scrapy crawl get_reviews -a mode=all -a order=random``):
+
+    - ``mode``: ``random`` crawls one random unreviewed product (default),
+      ``all`` streams every unreviewed product through the scheduler in one run
+    - ``window``: maximum number of products crawled at the same time in ``all`` mode,
+      without a frontier directory (``-s FRONTIER_DIR=``; ignored with a warning otherwise)
+    - ``order``: order in which products are scheduled in ``all`` mode, one of
+      ``category`` (grouped by category, default), ``file`` or ``random``
+    - ``refresh``: also re-crawl products that were already reviewed, fetching
+      only the reviews newer than the latest one collected for each product
+    - ``shard``, ``shards``: only crawl the products of shard ``shard`` out of
+      ``shards`` (see supply_chain/sharding.py, which runs all shards at once)
+    - ``budget``: total number of review pages requested in the run, shared
+      between products by how many recent reviews their pages yield
+      (default ``REVIEWS_BUDGET``, 0 for unlimited, see supply_chain/budget.py)
+    - ``max_pages``: maximum pages per product (default ``REVIEWS_MAX_PAGES``, 0 for no cap)
+
+    Pagination progress is recorded in the checkpoint store after every page,
+    so an interrupted product resumes at its next unparsed page. Pagination
+    stops early on a page holding only reviews older than the product's
+    high-water mark (its latest review datetime from previous crawls).
+
+    With a frontier directory (``FRONTIER_DIR``, see supply_chain/frontier.py)
+    every product is queued on disk at once instead of ``window`` at a time:
+    pages of started products come first, then products never crawled, then
+    refreshes. An interrupted run resumes from that queue.
+    """
+
     name = "get_reviews"
+    # Every review page shifts when new reviews are posted, so none stays fresh for long
+    custom_settings = {
+        'HTTPCACHE_TTL': 3600,
+    }
+    # Legacy list of reviewed products, imported into the checkpoint store once
+    reviewed_slugs_path = 'product_reviewed_slugs.json'
+
+    def __init__(self, mode: str = 'random', window: int | None = None, order: str = 'category', refresh: str = 'false',
+                 shard: int = 0, shards: int = 1, budget: int | None = None, max_pages: int | None = None,
+                 *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if mode not in ('random', 'all'):
+            raise ValueError(f"Unknown mode {mode!r}, expected 'random' or 'all'")
+        if order not in ('category', 'file', 'random'):
+            raise ValueError(f"Unknown order {order!r}, expected 'category', 'file' or 'random'")
+        self.mode = mode
+        self.window = 8 if window is None else max(1, int(window))
+        self.window_given = window is not None
+        self.order = order
+        self.refresh = str(refresh).lower() in ('1', 'true', 'yes')
+        self.shard, self.shards = int(shard), int(shards)
+        if not 0 <= self.shard < self.shards:
+            raise ValueError(f"Invalid shard {self.shard} of {self.shards}")
+        self.budget_pages = None if budget is None else int(budget)
+        self.max_pages = None if max_pages is None else int(max_pages)
+
+        self.checkpoints = None
+        self.catalog = None
+        self.budget = None
+        # Newest review seen in this crawl, per product
+        self._newest: dict[str, str] = {}
+        # Requests for products not scheduled yet (all mode)
+        self._pending = iter(())
+
+    @property
+    def base_url(self) -> str:
+        """Site crawled, ``TRUSTPILOT_BASE_URL`` (a local mock site in load tests)"""
+        return self.settings.get('TRUSTPILOT_BASE_URL', 'https://fr.trustpilot.com')
 
     async def start(self):
         """Parse the products page and extract all review information"""
-
-        # Load products from JSON file
-        try:
-            with open('product_links.json', 'r', encoding='utf-8') as f:
-                products = json.load(f)
-            base_url = "https://fr.trustpilot.com"
-
-            # Load already-reviewed product slugs
-            reviewed_slugs_path = 'product_reviewed_slugs.json'
-            reviewed_slugs: list[str] = []
-            if os.path.exists(reviewed_slugs_path):
-                try:
-                    with open(reviewed_slugs_path, 'r', encoding='utf-8') as f_saved:
-                        data = json.load(f_saved)
-                        if isinstance(data, list):
-                            reviewed_slugs = [str(s) for s in data]
-                        else:
-                            self.logger.warning("Unexpected format in %s; expected a list. Resetting.", reviewed_slugs_path)
-                except json.JSONDecodeError:
-                    self.logger.error("Invalid JSON in %s; starting with empty reviewed list", reviewed_slugs_path)
-
-            reviewed_set = set(reviewed_slugs)
-
-            # Build list of candidate products not yet reviewed
-            candidates = []
-            for product in products:
-                try:
-                    slug = next(iter(product))
-                except StopIteration:
-                    # Skip empty product objects
-                    continue
-                if slug not in reviewed_set:
-                    candidates.append(product)
-
-            if not candidates:
-                self.logger.info("No unreviewed products left to crawl. Consider clearing %s if you want to restart.", reviewed_slugs_path)
-                return
-
-            # Pick one random product among unreviewed candidates
-            product = random.choice(candidates)
-            try:
-                slug = next(iter(product))
-            except StopIteration:
-                self.logger.error("Encountered empty product object after filtering; stopping")
+        self._load_review_state()
+        self._check_window()
+        if resuming(self):
+            self.logger.info("Resuming the products queued in the frontier %s", self.settings.get('JOBDIR'))
+            return
+        mark_seeded(self, False)
+        if not self._open_catalog():
+            self.logger.error("Could not find the product_links store")
+            return
+
+        # Products not reviewed yet, in the requested order (a random one in random mode)
+        count = self.catalog.queue(self.checkpoints.path, 'random' if self.mode == 'random' else self.order,
+                                   self.refresh, self.shard, self.shards)
+        if not count:
+            self.logger.info("No unreviewed products left to crawl. Consider clearing the products table of %s if you want to restart.", self.checkpoints.path)
+            return
+
+        if self.mode == 'random':
+            product, next_page = next(self.catalog.queued(batch=1))
+            self.budget.reserve(1)
+            self.budget.start()
+            yield self._product_request(product, start_page=next_page)
+            mark_seeded(self)
+            return
+
+        self.budget.reserve(count)
+        self._pending = self._product_requests(self.catalog.queued(), count)
+        if self.settings.get('JOBDIR'):
+            # Queued on disk, where the frontier orders them
+            self.logger.info("Queuing %s unreviewed products in the frontier", count)
+            for request in self._pending:
+                yield request
+            mark_seeded(self)
+            return
+
+        self.logger.info("Scheduling %s unreviewed products, %s at a time", count, self.window)
+        for _ in range(self.window):
+            request = next(self._pending, None)
+            if request is None:
+                break
+            yield request
+
+    def _product_requests(self, products, count: int):
+        """Yield the first request of each ``(product, next page)``, while the page budget lasts"""
+        for rank, (product, next_page) in enumerate(products):
+            if not self.budget.start():
+                self.logger.info("Review page budget spent; %s products left for the next run", count - rank)
                 return
-
-            # Persist selection immediately to avoid crawling the same link twice
-            if slug not in reviewed_set:
-                reviewed_slugs.append(slug)
-                try:
-                    with open(reviewed_slugs_path, 'w', encoding='utf-8') as f_saved:
-                        json.dump(reviewed_slugs, f_saved, ensure_ascii=False, indent=2)
-                except Exception as e:
-                    self.logger.error("Failed to write %s: %s", reviewed_slugs_path, e)
-
-            product_url = base_url + product[slug]['product_link']
-            yield scrapy.Request(
-                url=product_url,
-                callback=self.get_reviews,
-                cb_kwargs={
-                    'category_slug': product[slug]['category_slug'],
-                    'category_name': product[slug]['category_name'],
-                    'product_slug': slug
-                }
-            )
-
-        except FileNotFoundError:
-            self.logger.error("Could not find products.json file")
-        except json.JSONDecodeError:
-            self.logger.error("Invalid JSON in products.json file") 
-
-
-    def get_reviews(self, response: scrapy.http.Response, category_name: str, category_slug: str, product_slug: str):
+            yield self._product_request(product, start_page=next_page)
+
+    def _open_catalog(self) -> bool:
+        """Open the product catalog and add the products stored since the last run, False when there are none"""
+        self.catalog = ProductCatalog(self.settings.get('CATALOG_PATH', 'catalog.sqlite3'))
+        count = self.catalog.sync(self.settings.get('PRODUCTS_DIR') or self.settings.get('STORAGE_DIR', '.'))
+        if count:
+            self.logger.info("Added %s products to the catalog %s", count, self.catalog.path)
+        return len(self.catalog) > 0
+
+    def _load_review_state(self) -> None:
+        """Open the checkpoint store, import the legacy state and set up the page budget"""
+        self.checkpoints = CheckpointStore(self.settings.get('CHECKPOINT_PATH', 'checkpoints.sqlite3'))
+        # Progress is committed once the items parsed before it are stored
+        get_held_state(self.crawler).hold(self.checkpoints)
+        count = self.checkpoints.import_reviewed_slugs(self.reviewed_slugs_path)
+        if count:
+            self.logger.info("Imported %s reviewed products from %s", count, self.reviewed_slugs_path)
+        reviews_csv_path = self.settings.get('REVIEWS_CSV_PATH', 'reviews.csv')
+        count = self.checkpoints.import_review_marks(reviews_csv_path)
+        if count:
+            self.logger.info("Imported review high-water marks of %s products from %s", count, reviews_csv_path)
+
+        self.budget = PageBudget(
+            self.settings.getint('REVIEWS_BUDGET', 0) if self.budget_pages is None else self.budget_pages,
+            self.settings.getint('REVIEWS_MAX_PAGES', 5) if self.max_pages is None else self.max_pages,
+            self.settings.getfloat('REVIEWS_RECENCY_HALF_LIFE_DAYS', 30),
+        )
+
+    def _check_window(self) -> None:
+        """Warn when a ``window`` was given that the frontier makes irrelevant"""
+        if self.window_given and self.mode == 'all' and not self.windowed:
+            self.logger.warning("The window argument is ignored: every product is queued in the frontier %s "
+                                "(set FRONTIER_DIR to an empty string to crawl %s products at a time)",
+                                self.settings.get('JOBDIR'), self.window)
+
+    @property
+    def windowed(self) -> bool:
+        """Whether products hold a window slot until their last page (``all`` mode without a frontier)
+
+        Their requests are then never dropped by the duplicate filter: the slot
+        is only released by their callback or errback.
+        """
+        return self.mode == 'all' and not self.settings.get('JOBDIR')
+
+    def _product_progress(self, slug: str) -> tuple[int, bool]:
+        """Return ``(next_page, done)`` of a product, reviewed products counting as not started with ``refresh``"""
+        next_page, done = self.checkpoints.slug_progress('products', slug)
+        if done and self.refresh:
+            # Reviewed products are crawled again from their first page
+            return 1, False
+        return next_page, done
+
+    def _product_request(self, product: dict, start_page: int = 1) -> scrapy.Request:
+        slug = next(iter(product))
+        if start_page > 1:
+            self.logger.info("Resuming product %s at page %s", slug, start_page)
+        since = self.checkpoints.review_mark(slug)
+        return scrapy.Request(
+            url=page_url(self.base_url + product[slug]['product_link'], start_page),
+            callback=self.get_reviews,
+            errback=self.product_failed,
+            priority=product_priority(start_page > 1, since is not None),
+            dont_filter=self.windowed,
+            cb_kwargs={
+                'category_slug': product[slug]['category_slug'],
+                'category_name': product[slug]['category_name'],
+                'product_slug': slug,
+                'since': since,
+            }
+        )
+
+    def _finish_product(self, product_slug: str, reviewed: bool = True):
+        """Mark a product as reviewed once its last page is done and schedule the next one"""
+        newest = self._newest.pop(product_slug, None)
+        if reviewed:
+            self.checkpoints.finish('products', product_slug)
+            if newest:
+                self.checkpoints.set_review_mark(product_slug, newest)
+
+        request = self._next_product_request()
+        if request is not None:
+            yield request
+
+    def _next_product_request(self) -> scrapy.Request | None:
+        """Return the request of the next product waiting for a window slot"""
+        return next(self._pending, None)
+
+    def product_failed(self, failure):
+        """Release the window slot of a product whose page could not be downloaded"""
+        product_slug = failure.request.cb_kwargs['product_slug']
+        self.logger.error("Failed to crawl product %s: %s", product_slug, failure.value)
+        yield from self._finish_product(product_slug, reviewed=False)
+
+    def closed(self, reason):
+        if self.budget is not None:
+            self.crawler.stats.set_value('reviews/budget_pages_spent', self.budget.spent, spider=self)
+        if self.checkpoints is not None:
+            self.checkpoints.close()
+        if self.catalog is not None:
+            self.catalog.close()
+
+    def get_reviews(self, response: scrapy.http.Response, category_name: str, category_slug: str, product_slug: str,
+                    since: str | None = None):
         """Parse the product page and extract all review information"""
-        # Find reviews div container
-
-
-        reviews_div = response.xpath('//section[starts-with(@class, "styles_reviewListContainer")]')
-        if not reviews_div:
+        # Extract reviews with the compiled extractor (HTML first, __NEXT_DATA__ blob as fallback)
+        extracted = extract_reviews(response)
+        if extracted is None:
             self.logger.error("Could not find reviews div container")
+            yield from self._finish_product(product_slug, reviewed=False)
+            return
 
-        # Check if reviews_div selector returns multiple elements
-        if len(reviews_div) > 1:
-            self.logger.error("Found multiple reviews containers - expected only one")
-
-        # Reviews
-        reviews = reviews_div[0].xpath('.//article')
-
-        if not reviews:
+        if not extracted:
             self.logger.error("Could not find reviews div for product %s", product_slug)
 
-        reviews_json = []
-        for review in reviews:
-            # Get review header div
-            review_header = review.xpath('.//div[starts-with(@class, "styles_reviewCardInnerHeader")]')
-            if not review_header:
-                self.logger.error("Could not find review header div")
-            
-            # Extract datetime from time tag
-            review_datetime = review_header.xpath('.//time/@datetime').get()
-            if not review_datetime:
+        reviews = []
+        for review in extracted:
+            if not review['datetime']:
                 self.logger.error("Could not find review datetime")
-
-            review_header = review.xpath('.//div[starts-with(@class, "styles_reviewHeader")]')
-            if not review_header:
-                self.logger.error("Could not find review rating header div")
-            # Extract service rating from data attribute
-            service_rating = review_header.xpath('./@data-service-review-rating').get()
-            if not service_rating:
+            if not review['service_rating']:
                 self.logger.error("Could not find service rating")
-
-            review_content = review.xpath('.//div[starts-with(@class, "styles_reviewContent")]')
-            if not review_content:
-                self.logger.error("Could not find review content div")
-
-            # Extract review title from h2 tag
-            review_title = review_content.xpath('.//h2/text()').get()
-            if not review_title:
+            if not review['title']:
                 self.logger.error("Could not find review title")
-
-            # Extract review text from first p tag
-            review_text = review_content.xpath('.//p/text()').getall()
-            if not review_text:
+            if not review['text']:
                 self.logger.error("Could not find review text")
 
-            # Create review JSON with datetime
-            review_json = {
-                'datetime': review_datetime,
-                'service_rating': service_rating,
-                'title': review_title,
-                'text': review_text,
-                'category_slug': category_slug,
-                'category_name': category_name,
-                'product_slug': product_slug
-            }
-            reviews_json.append(review_json)
-
-        if not reviews_div:
-            self.logger.error("Could not find any reviews")
-
-        # Initialize json_content
-        json_content = []
-        
-        # Try to read existing products.json file
-        try:
-            with open('reviews.json', 'r', encoding='utf-8') as f:
-                json_content = json.load(f)
-        except FileNotFoundError:
-            # File doesn't exist yet, will be created when writing
-            pass
-        except json.JSONDecodeError:
-            self.logger.error("Invalid JSON in reviews.json file")
-
-        new_content = json_content + reviews_json
-
-        with open(f'reviews.json', 'w', encoding='utf-8') as f:
-            json.dump(new_content, f, ensure_ascii=False, indent=2)
-
-        # Also write/append to CSV
-        if reviews_json:
-            csv_filename = 'reviews.csv'
-            # Determine field order from the keys of the first review
-            fieldnames = list(reviews_json[0].keys())
-
-            # Ensure the CSV file exists and check if it's empty to decide header writing
-            file_exists = os.path.exists(csv_filename)
-            file_empty = (not file_exists) or (os.path.getsize(csv_filename) == 0)
-
-            # Prepare rows (convert list fields like 'text' to a single string)
-            prepared_rows = []
-            for r in reviews_json:
-                row = dict(r)
-                # Convert list of paragraphs to a single string
-                if isinstance(row.get('text'), list):
-                    row['text'] = ' '.join([t.strip() for t in row['text'] if t is not None]).strip()
-                prepared_rows.append(row)
-
-            # Append rows to CSV and write header if needed
-            with open(csv_filename, 'a', encoding='utf-8', newline='') as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                if file_empty:
-                    writer.writeheader()
-                for row in prepared_rows:
-                    writer.writerow(row)
-
-            # Pagination: look for the next page button; only follow if not disabled
-
+            reviews.append(ReviewItem(
+                **review,
+                category_slug=category_slug,
+                category_name=category_name,
+                product_slug=product_slug,
+            ))
+
+        dates = [r.datetime for r in reviews if r.datetime]
+        if dates and max(dates) > self._newest.get(product_slug, ''):
+            self._newest[product_slug] = max(dates)
+
+        # Only keep reviews newer than the high-water mark of previous crawls
+        stale_page = False
+        if since:
+            stale_page = bool(dates) and max(dates) <= since
+            reviews = [r for r in reviews if not r.datetime or r.datetime > since]
+
+        # Reviews are deduplicated and written by the item pipelines
+        yield from reviews
+        page_value = self.budget.page_value([r.datetime for r in reviews if r.datetime])
+
+        # Pagination: look for the next page button; only follow if not disabled
+        if stale_page:
+            self.logger.info("Page only holds reviews older than %s; stopping pagination for product: %s",
+                             since, product_slug)
+            self.crawler.stats.inc_value('reviews/pagination_cutoff', spider=self)
+            next_request = None
+        else:
+            next_request = self._next_page_request(response, category_name, category_slug, product_slug, since,
+                                                   page_value)
+
+        if next_request is not None:
+            self.checkpoints.set_page('products', product_slug, page_from_url(next_request.url) or 1)
+            yield next_request
+        else:
+            yield from self._finish_product(product_slug)
+
+    def _next_page_request(self, response: scrapy.http.Response, category_name: str, category_slug: str, product_slug: str,
+                           since: str | None, page_value: float = 0.0):
+        """Return the request for the next review page, or None when the product is done"""
         next_button = response.xpath('//a[@name="pagination-button-next"]')
 
-        if next_button.get():
-            aria_disabled = (next_button.xpath('@aria-disabled').get() or '').lower()
-            next_href = next_button.xpath('@href').get()
-            is_disabled = (aria_disabled == 'true') or (not next_href)
+        if not next_button.get():
+            return None
 
-            if is_disabled:
-                self.logger.info("Next pagination button is disabled; stopping pagination for this category: %s",
-                                 category_slug)
-                return
+        aria_disabled = (next_button.xpath('@aria-disabled').get() or '').lower()
+        next_href = next_button.xpath('@href').get()
+        is_disabled = (aria_disabled == 'true') or (not next_href)
 
-            next_url = response.urljoin(next_href)
-
-            # Parse page param from next_url and stop if > 5
-            try:
-                parsed = urlparse(next_url)
-                page_vals = parse_qs(parsed.query).get('page')
-                page_num = int(page_vals[0]) if page_vals and page_vals[0].isdigit() else None
-            except Exception as e:
-                self.logger.warning("Could not parse page parameter from next URL '%s': %s", next_url, e)
-                page_num = None
-
-            if page_num is not None and page_num > 5:
-                self.logger.info(
-                    "Stopping pagination at page %s (limit=5) for product: %s", page_num, product_slug
-                )
-                return
+        if is_disabled:
+            self.logger.info("Next pagination button is disabled; stopping pagination for this product: %s",
+                             product_slug)
+            return None
+
+        next_url = response.urljoin(next_href)
 
-            self.logger.info("Next pagination button found, following the link: %s", next_url)
+        # The page budget decides whether this page is worth a request
+        page_num = page_from_url(next_url) or 2
+        if page_num <= (page_from_url(response.url) or 1):
+            # Not filtered as a duplicate in a window: never follow a link back
+            self.logger.warning("Next pagination button points back to page %s for product: %s", page_num,
+                                product_slug)
+            return None
 
-            yield scrapy.Request(
-                url=next_url,
-                callback=self.get_reviews,
-                cb_kwargs={
-                    'product_slug': product_slug,
-                    'category_slug': category_slug,
-                    'category_name': category_name,
-                }
+        if not self.budget.next_page(page_num - 1, page_value):
+            self.logger.info(
+                "Stopping pagination at page %s (page budget or max_pages) for product: %s", page_num, product_slug
             )
+            self.crawler.stats.inc_value('reviews/budget_cutoff', spider=self)
+            return None
+
+        self.logger.info("Next pagination button found, following the link: %s", next_url)
+
+        return scrapy.Request(
+            url=next_url,
+            callback=self.get_reviews,
+            errback=self.product_failed,
+            priority=product_priority(True, since is not None),
+            dont_filter=self.windowed,
+            cb_kwargs={
+                'product_slug': product_slug,
+                'category_slug': category_slug,
+                'category_name': category_name,
+                'since': since,
+            }
+        )
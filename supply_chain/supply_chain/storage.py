@@ -0,0 +1,225 @@
+"""Append-only JSON Lines storage shared by the spiders.
+
+Each store is a set of files named after the store:
+
+    product_links.00001.jsonl   rotated (read-only) segments
+    product_links.00002.jsonl
+    product_links.jsonl         active segment, appended to
+
+A legacy JSON array (``product_links.json``) can be imported once into a new
+store and exported again on demand, so downstream tools that expect the old
+format keep working.
+
+Usage from the project directory (where scrapy.cfg lives):
+
+    python -m supply_chain.storage export product_links
+    python -m supply_chain.storage import reviews
+"""
+
+import glob
+import json
+import logging
+import os
+import sys
+
+logger = logging.getLogger(__name__)
+
+
+def active_path(name: str, directory: str = '.') -> str:
+    return os.path.join(directory, f'{name}.jsonl')
+
+
+def legacy_path(name: str, directory: str = '.') -> str:
+    return os.path.join(directory, f'{name}.json')
+
+
+def segment_paths(name: str, directory: str = '.') -> list[str]:
+    """Return rotated segments of a store, oldest first"""
+    pattern = os.path.join(glob.escape(directory), f'{glob.escape(name)}.[0-9][0-9][0-9][0-9][0-9].jsonl')
+    return sorted(glob.glob(pattern))
+
+
+def store_exists(name: str, directory: str = '.') -> bool:
+    return os.path.exists(active_path(name, directory)) or bool(segment_paths(name, directory))
+
+
+def stream_paths(name: str, directory: str = '.') -> list[str]:
+    """Return the files of a store in order; segments are the active file renamed, so they form one stream"""
+    paths = segment_paths(name, directory)
+    if os.path.exists(active_path(name, directory)):
+        paths.append(active_path(name, directory))
+    return paths
+
+
+def stream_size(name: str, directory: str = '.') -> int:
+    """Return the stream offset the next record of a store is appended at"""
+    return sum(os.path.getsize(path) for path in stream_paths(name, directory))
+
+
+def iter_lines(name: str, directory: str = '.', offset: int = 0):
+    """Yield ``(line, stream offset after it)`` for the complete lines of a store past a stream offset"""
+    start = 0
+    for path in stream_paths(name, directory):
+        size = os.path.getsize(path)
+        if start + size > offset:
+            with open(path, 'rb') as f:
+                f.seek(max(offset - start, 0))
+                position = max(offset, start)
+                for line in f:
+                    # A partial last line is still being written
+                    if not line.endswith(b'\n'):
+                        break
+                    position += len(line)
+                    yield line, position
+        start += size
+
+
+def iter_records(name: str, directory: str = '.'):
+    """Yield every record of a store, falling back to the legacy JSON array"""
+    if not store_exists(name, directory):
+        path = legacy_path(name, directory)
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        with open(path, 'r', encoding='utf-8') as f:
+            yield from json.load(f)
+        return
+
+    for path in stream_paths(name, directory):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line_num, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning("Skipping invalid JSON line %s in %s", line_num, path)
+
+
+def export_json(name: str, directory: str = '.') -> int:
+    """Write the legacy JSON array for a store atomically, return the record count"""
+    path = legacy_path(name, directory)
+    tmp_path = path + '.tmp'
+    count = 0
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write('[')
+        for record in iter_records(name, directory):
+            # Same layout as json.dump(records, f, indent=2), one record at a time
+            dumped = json.dumps(record, ensure_ascii=False, indent=2)
+            f.write(',\n  ' if count else '\n  ')
+            f.write(dumped.replace('\n', '\n  '))
+            count += 1
+        f.write('\n]' if count else ']')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return count
+
+
+def import_json(name: str, directory: str = '.') -> int:
+    """Copy the legacy JSON array of a store into a new JSON Lines store"""
+    if store_exists(name, directory):
+        raise FileExistsError(active_path(name, directory))
+    with open(legacy_path(name, directory), 'r', encoding='utf-8') as f:
+        records = json.load(f)
+    store = JsonLinesStore(name, directory)
+    for record in records:
+        store.append(record)
+    store.close()
+    return len(records)
+
+
+class JsonLinesStore:
+    """Buffered appender for one store with size-based atomic rotation"""
+
+    def __init__(self, name: str, directory: str = '.', flush_items: int = 200,
+                 rotate_bytes: int = 64 * 1024 * 1024, fsync: bool = True):
+        self.name = name
+        self.directory = directory
+        self.path = active_path(name, directory)
+        self.flush_items = flush_items
+        self.rotate_bytes = rotate_bytes
+        self.fsync = fsync
+        self.bytes_written = 0
+        self._buffer: list[str] = []
+        self._file = None
+
+    def append(self, record) -> None:
+        self._buffer.append(json.dumps(record, ensure_ascii=False))
+        if len(self._buffer) >= self.flush_items:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._buffer:
+            return
+        data = ('\n'.join(self._buffer) + '\n').encode('utf-8')
+        self._buffer = []
+
+        f = self._open()
+        f.write(data)
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+        self.bytes_written += len(data)
+
+        if self.rotate_bytes and f.tell() >= self.rotate_bytes:
+            self.rotate()
+
+    def rotate(self) -> None:
+        """Move the active segment aside; the next flush starts a new one"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if not os.path.exists(self.path):
+            return
+
+        segments = segment_paths(self.name, self.directory)
+        index = int(segments[-1].rsplit('.', 2)[-2]) + 1 if segments else 1
+        os.replace(self.path, os.path.join(self.directory, f'{self.name}.{index:05d}.jsonl'))
+
+    def close(self) -> None:
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _open(self):
+        if self._file is None:
+            os.makedirs(self.directory or '.', exist_ok=True)
+            self._file = open(self.path, 'ab+')
+            self._repair_tail(self._file)
+        return self._file
+
+    def _repair_tail(self, f) -> None:
+        """Drop a partial last line left behind by a crash mid-write"""
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            return
+
+        # Walk back to the last complete line
+        position = size
+        while position > 0:
+            step = min(position, 64 * 1024)
+            position -= step
+            f.seek(position)
+            chunk = f.read(step)
+            newline = chunk.rfind(b'\n')
+            if newline != -1:
+                position += newline + 1
+                break
+        logger.warning("Truncating partial record at the end of %s", self.path)
+        f.truncate(position)
+        f.seek(0, os.SEEK_END)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] not in ('export', 'import'):
+        sys.exit("usage: python -m supply_chain.storage {export,import} <store name>")
+
+    command, store_name = sys.argv[1:]
+    if command == 'export':
+        print(f"Exported {export_json(store_name)} records to {legacy_path(store_name)}")
+    else:
+        print(f"Imported {import_json(store_name)} records into {active_path(store_name)}")
@@ -0,0 +1,43 @@
+from datetime import datetime, timedelta, timezone
+
+from supply_chain.budget import PageBudget
+
+
+def test_unlimited_budget_only_caps_pages():
+    budget = PageBudget(total=0, max_pages=3)
+    assert all(budget.start() for _ in range(100))
+    assert budget.next_page(1, 0.0)
+    assert budget.next_page(2, 0.0)
+    assert not budget.next_page(3, 10.0)
+
+
+def test_first_pages_are_reserved():
+    budget = PageBudget(total=5)
+    budget.reserve(3)
+    assert budget.free == 2
+    assert budget.next_page(1, 1.0)
+    assert budget.next_page(1, 1.0)
+    # Next pages cannot eat into the first pages of the products scheduled
+    assert not budget.next_page(1, 100.0)
+    assert all(budget.start() for _ in range(3))
+    assert not budget.start()
+    assert budget.spent == 5
+
+
+def test_pages_worth_less_than_average_stop_under_pressure():
+    budget = PageBudget(total=12)
+    budget.reserve(2)
+    assert budget.next_page(1, 10.0)
+    assert budget.next_page(1, 10.0)
+    # A fifth of the free pages spent: a page must be worth a fifth of the average page
+    assert not budget.next_page(1, 1.0)
+    assert budget.next_page(1, 9.0)
+
+
+def test_page_value_halves_with_age():
+    budget = PageBudget(half_life_days=30)
+    now = datetime.now(timezone.utc)
+    assert abs(budget.page_value([now.isoformat()]) - 1) < 0.01
+    assert abs(budget.page_value([(now - timedelta(days=30)).isoformat()]) - 0.5) < 0.01
+    # Unreadable datetimes count as new
+    assert budget.page_value(['not a date', None]) == 2
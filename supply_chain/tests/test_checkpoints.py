@@ -0,0 +1,100 @@
+import csv
+
+from supply_chain.checkpoints import CheckpointStore, page_from_url, page_url
+
+
+def crash(store: CheckpointStore) -> None:
+    """Close the database without committing the held updates, as a killed crawl would"""
+    store.db.close()
+
+
+def test_resume_from_last_committed_page(tmp_path):
+    path = str(tmp_path / 'checkpoints.sqlite3')
+    store = CheckpointStore(path)
+    store.hold()
+    store.set_page('products', 'acme', 2)
+    store.commit_held()
+    store.set_page('products', 'acme', 3)
+    store.finish('products', 'other')
+    assert store.held == 2
+    crash(store)
+
+    store = CheckpointStore(path)
+    assert store.slug_progress('products', 'acme') == (2, False)
+    assert store.slug_progress('products', 'other') == (1, False)
+    store.close()
+
+
+def test_commit_held_applies_the_first_updates(tmp_path):
+    store = CheckpointStore(str(tmp_path / 'checkpoints.sqlite3'))
+    store.hold()
+    store.set_page('products', 'acme', 2)
+    store.set_page('products', 'acme', 3)
+    store.commit_held(1)
+    assert store.slug_progress('products', 'acme') == (2, False)
+    store.drop_held()
+    store.close()
+    assert CheckpointStore(store.path).slug_progress('products', 'acme') == (2, False)
+
+
+def test_pages_parsed_out_of_order(tmp_path):
+    store = CheckpointStore(str(tmp_path / 'checkpoints.sqlite3'))
+    store.set_page('categories', 'shoes', 2)
+    store.set_page_count('categories', 'shoes', 4)
+    assert not store.mark_page('categories', 'shoes', 4)
+    assert store.slug_progress('categories', 'shoes') == (2, False)
+    assert store.page_counts('categories') == {'shoes': (4, {1, 4})}
+    assert not store.mark_page('categories', 'shoes', 2)
+    assert store.slug_progress('categories', 'shoes') == (3, False)
+    assert store.mark_page('categories', 'shoes', 3)
+    assert store.done('categories') == {'shoes'}
+    assert store.page_counts('categories') == {}
+    store.close()
+
+
+def test_held_mark_page_sees_held_updates(tmp_path):
+    store = CheckpointStore(str(tmp_path / 'checkpoints.sqlite3'))
+    store.hold()
+    store.set_page_count('categories', 'shoes', 2)
+    assert not store.mark_page('categories', 'shoes', 1)
+    assert store.mark_page('categories', 'shoes', 2)
+    # Nothing is written until committed
+    assert store.progress('categories') == {}
+    store.commit_held()
+    assert store.done('categories') == {'shoes'}
+    store.close()
+
+
+def test_review_marks_imported_once(tmp_path):
+    reviews_csv = tmp_path / 'reviews.csv'
+    with open(reviews_csv, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['datetime', 'product_slug'])
+        writer.writeheader()
+        writer.writerow({'datetime': '2024-01-02T00:00:00.000Z', 'product_slug': 'acme'})
+        writer.writerow({'datetime': '2024-03-04T00:00:00.000Z', 'product_slug': 'acme'})
+
+    store = CheckpointStore(str(tmp_path / 'checkpoints.sqlite3'))
+    assert store.import_review_marks(str(reviews_csv)) == 1
+    assert store.review_mark('acme') == '2024-03-04T00:00:00.000Z'
+
+    # Rows appended by a crawl that crashed before its commit are not imported later
+    with open(reviews_csv, 'a', encoding='utf-8', newline='') as f:
+        csv.writer(f).writerow(['2024-05-06T00:00:00.000Z', 'other'])
+    assert store.import_review_marks(str(reviews_csv)) == 0
+    assert store.review_mark('other') is None
+    store.close()
+
+
+def test_review_mark_keeps_the_latest(tmp_path):
+    store = CheckpointStore(str(tmp_path / 'checkpoints.sqlite3'))
+    store.set_review_mark('acme', '2024-03-04T00:00:00.000Z')
+    store.set_review_mark('acme', '2024-01-02T00:00:00.000Z')
+    assert store.review_marks() == {'acme': '2024-03-04T00:00:00.000Z'}
+    store.close()
+
+
+def test_page_urls():
+    assert page_url('https://example.com/review/acme', 1) == 'https://example.com/review/acme'
+    assert page_url('https://example.com/review/acme', 3) == 'https://example.com/review/acme?page=3'
+    assert page_from_url('https://example.com/review/acme?page=3') == 3
+    assert page_from_url('https://example.com/review/acme') is None
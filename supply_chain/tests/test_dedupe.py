@@ -0,0 +1,51 @@
+from supply_chain.dedupe import DedupeIndex, product_key, review_key
+
+
+def test_keys():
+    assert review_key('acme', '2024-01-02T00:00:00.000Z', 'Great') == review_key('acme', '2024-01-02T00:00:00.000Z',
+                                                                                  'Great')
+    assert review_key('acme', '2024-01-02T00:00:00.000Z', 'Great') != review_key('acme', '2024-01-02T00:00:00.000Z',
+                                                                                  'Bad')
+    assert len(review_key('acme', None, None)) == 16
+    # A product found without its category is looked for again with it
+    assert product_key('acme', categorized=False) != product_key('acme')
+
+
+def test_added_keys_survive_a_restart(tmp_path):
+    path = str(tmp_path / 'dedupe.sqlite3')
+    index = DedupeIndex(path)
+    assert index.add(b'a' * 16)
+    assert not index.add(b'a' * 16)
+    index.close()
+
+    index = DedupeIndex(path)
+    assert b'a' * 16 in index
+    assert not index.add(b'a' * 16)
+    index.close()
+
+
+def test_held_keys_are_lost_in_a_crash(tmp_path):
+    path = str(tmp_path / 'dedupe.sqlite3')
+    index = DedupeIndex(path)
+    index.hold()
+    assert index.add(b'a' * 16)
+    assert not index.add(b'a' * 16)
+    index.commit_held(marks={'ReviewsCsvPipeline:reviews': 120})
+    assert index.add(b'b' * 16)
+    assert index.held == 1
+    index.db.close()
+
+    index = DedupeIndex(path)
+    assert len(index) == 1
+    assert index.missing([b'a' * 16, b'b' * 16]) == {b'b' * 16}
+    assert index.marks() == {'ReviewsCsvPipeline:reviews': 120}
+    index.close()
+
+
+def test_drop_held(tmp_path):
+    index = DedupeIndex(str(tmp_path / 'dedupe.sqlite3'))
+    index.hold()
+    index.add(b'a' * 16)
+    index.drop_held()
+    index.close()
+    assert len(DedupeIndex(index.path)) == 0
@@ -0,0 +1,47 @@
+import csv
+import io
+
+import pytest
+
+pytest.importorskip('pandas')
+
+from supply_chain.enrich import read_header, row_boundaries  # noqa: E402
+from supply_chain.search import FIELDS  # noqa: E402
+
+
+def write_reviews(path, count: int, tail: bytes = b'') -> bytes:
+    f = io.StringIO(newline='')
+    writer = csv.DictWriter(f, fieldnames=FIELDS)
+    writer.writeheader()
+    for n in range(count):
+        writer.writerow({'datetime': f'2024-05-01T10:{n % 60:02d}:00.000Z', 'service_rating': '4',
+                         'title': f'Line one\r\n"quoted" {n}', 'text': 'a,b\r\nc' * (n % 4), 'category_slug': 'shoes',
+                         'category_name': 'Shoes', 'product_slug': f'product-{n % 3}'})
+    data = f.getvalue().encode('utf-8')
+    path.write_bytes(data + tail)
+    return data
+
+
+def test_row_boundaries_end_outside_quoted_fields(tmp_path):
+    path = tmp_path / 'reviews.csv'
+    data = write_reviews(path, 500, tail=b'2024-06-01T10:00:00.000Z,5,"Still\r\nbeing written')
+    names, start = read_header(str(path))
+    assert names == list(FIELDS)
+
+    boundaries = row_boundaries(str(path), start, 4096)
+    assert boundaries[0] == start
+    assert boundaries[-1] == len(data)
+    assert len(boundaries) > 3
+    rows = 0
+    for chunk_start, chunk_end in zip(boundaries, boundaries[1:]):
+        chunk = data[chunk_start:chunk_end].decode('utf-8')
+        records = list(csv.reader(io.StringIO(chunk, newline='')))
+        assert all(len(record) == len(FIELDS) for record in records)
+        rows += len(records)
+    assert rows == 500
+
+
+def test_row_boundaries_without_new_rows(tmp_path):
+    path = tmp_path / 'reviews.csv'
+    data = write_reviews(path, 3)
+    assert row_boundaries(str(path), len(data), 4096) == [len(data)]
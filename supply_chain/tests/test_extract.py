@@ -0,0 +1,63 @@
+import json
+
+from scrapy.http import HtmlResponse
+
+from supply_chain.extract import extract_reviews, last_page
+
+REVIEW_CARD = '''
+<article>
+  <div class="styles_reviewCardInnerHeader__a"><time datetime="2024-05-01T10:00:00.000Z">1 May</time></div>
+  <div class="styles_reviewHeader__b" data-service-review-rating="4"></div>
+  <div class="styles_reviewContent__c"><h2>Fast delivery</h2><p>First paragraph<br/>second paragraph</p></div>
+</article>
+'''
+
+
+def response(body: str, url: str = 'https://fr.trustpilot.com/review/acme') -> HtmlResponse:
+    return HtmlResponse(url=url, body=f'<html><body>{body}</body></html>', encoding='utf-8')
+
+
+def next_data(page_props: dict) -> str:
+    return f'<script id="__NEXT_DATA__" type="application/json">{json.dumps({"props": {"pageProps": page_props}})}</script>'
+
+
+def test_reviews_from_html():
+    page = response(f'<section class="styles_reviewListContainer__x">{REVIEW_CARD * 2}</section>')
+    assert extract_reviews(page) == [{
+        'datetime': '2024-05-01T10:00:00.000Z',
+        'service_rating': '4',
+        'title': 'Fast delivery',
+        'text': ['First paragraph', 'second paragraph'],
+    }] * 2
+
+
+def test_reviews_from_next_data_without_review_markup():
+    page = response(next_data({'reviews': [
+        {'dates': {'publishedDate': '2024-05-01T10:00:00.000Z'}, 'rating': 4, 'title': 'Fast delivery',
+         'text': 'First paragraph\nsecond paragraph'},
+        {'dates': None, 'rating': None, 'title': None, 'text': None},
+    ]}))
+    assert extract_reviews(page) == [
+        {'datetime': '2024-05-01T10:00:00.000Z', 'service_rating': '4', 'title': 'Fast delivery',
+         'text': ['First paragraph', 'second paragraph']},
+        {'datetime': None, 'service_rating': None, 'title': None, 'text': []},
+    ]
+
+
+def test_no_reviews_found():
+    assert extract_reviews(response('<p>Nothing here</p>')) is None
+    assert extract_reviews(response('<script id="__NEXT_DATA__">{not json</script>')) is None
+    assert extract_reviews(response('<section class="styles_reviewListContainer__x"></section>')) == []
+
+
+def test_last_page_from_pagination_links():
+    links = ''.join(f'<a name="pagination-button-{page}" href="/categories/shoes?page={page}">{page}</a>'
+                    for page in (2, 3, 12))
+    page = response(links + '<a name="pagination-button-next" href="/categories/shoes?page=2">Next</a>',
+                    url='https://fr.trustpilot.com/categories/shoes')
+    assert last_page(page) == 12
+
+
+def test_last_page_from_next_data():
+    assert last_page(response(next_data({'filters': {'pagination': {'totalPages': 7}}}))) == 7
+    assert last_page(response('<p>No pagination</p>')) is None
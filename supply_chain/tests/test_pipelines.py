@@ -0,0 +1,99 @@
+import csv
+import glob
+import os
+
+import pytest
+from scrapy.settings import Settings
+
+from supply_chain.dedupe import DedupeIndex
+from supply_chain.items import ReviewItem
+from supply_chain.pipelines import JsonLinesStoragePipeline, ParquetReviewsPipeline, ReviewsCsvPipeline, item_key
+from supply_chain.storage import iter_records
+
+
+def review(n: int) -> ReviewItem:
+    return ReviewItem(datetime=f'2024-05-{n:02d}T10:00:00.000Z', service_rating='4', title=f'Review {n}',
+                      text=[f'First paragraph {n}', 'second'], category_slug='shoes', category_name='Shoes',
+                      product_slug='acme')
+
+
+@pytest.fixture
+def settings(tmp_path):
+    return Settings({
+        'STORAGE_DIR': str(tmp_path),
+        'REVIEWS_CSV_PATH': str(tmp_path / 'reviews.csv'),
+        'PARQUET_DIR': str(tmp_path / 'reviews_parquet'),
+        'DEDUPE_PATH': str(tmp_path / 'dedupe.sqlite3'),
+    })
+
+
+def jsonl_rows(settings) -> list[str]:
+    return [record['title'] for record in iter_records('reviews', settings['STORAGE_DIR'])]
+
+
+def csv_rows(settings) -> list[str]:
+    with open(settings['REVIEWS_CSV_PATH'], 'r', encoding='utf-8', newline='') as f:
+        return [row['title'] for row in csv.DictReader(f)]
+
+
+def parquet_rows(settings) -> list[str]:
+    pq = pytest.importorskip('pyarrow.parquet')
+    paths = glob.glob(os.path.join(settings['PARQUET_DIR'], '*', '*', 'part-*.parquet'))
+    return [title for path in paths for title in pq.read_table(path, columns=['title']).column('title').to_pylist()]
+
+
+WRITERS = [
+    pytest.param(JsonLinesStoragePipeline, jsonl_rows, id='jsonl'),
+    pytest.param(ReviewsCsvPipeline, csv_rows, id='csv'),
+    pytest.param(ParquetReviewsPipeline, parquet_rows, id='parquet'),
+]
+
+
+@pytest.mark.parametrize('pipeline_class, rows', WRITERS)
+def test_items_written_before_a_crash_are_skipped(settings, pipeline_class, rows):
+    if pipeline_class is ParquetReviewsPipeline:
+        pytest.importorskip('pyarrow')
+    index = DedupeIndex(settings['DEDUPE_PATH'])
+    index.hold()
+    committed, uncommitted = [review(n) for n in (1, 2, 3)], [review(n) for n in (4, 5)]
+
+    first = pipeline_class(settings, None)
+    for item in committed:
+        index.add(item_key(item))
+    first._record_write(first._write('reviews', committed, False), 'reviews', 1)
+    index.commit_held(marks=first.marks())
+    # Written, then the crawl is killed before their keys are committed
+    for item in uncommitted:
+        index.add(item_key(item))
+    first._write('reviews', uncommitted, True)
+    index.db.close()
+
+    # The resumed crawl parses the uncommitted pages again
+    second = pipeline_class(settings, None)
+    second._write('reviews', uncommitted + [review(6)], True)
+    assert second.skipped == 2
+    assert sorted(rows(settings)) == [f'Review {n}' for n in range(1, 7)]
+
+
+@pytest.mark.parametrize('pipeline_class, rows', WRITERS)
+def test_first_run_skips_nothing(settings, pipeline_class, rows):
+    if pipeline_class is ParquetReviewsPipeline:
+        pytest.importorskip('pyarrow')
+    pipeline = pipeline_class(settings, None)
+    pipeline._write('reviews', [review(1), review(2)], True)
+    assert pipeline.skipped == 0
+    assert sorted(rows(settings)) == ['Review 1', 'Review 2']
+
+
+def test_invalid_parquet_ratings_are_nulled(settings):
+    pytest.importorskip('pyarrow')
+    pipeline = ParquetReviewsPipeline(settings, None)
+    assert [pipeline._rating(value) for value in ('5', '', None, 'abc', '9')] == [5, None, None, None, None]
+    assert pipeline.invalid_ratings == 2
+
+
+def test_csv_joins_paragraphs(settings):
+    pipeline = ReviewsCsvPipeline(settings, None)
+    pipeline._write('reviews', [review(1)], True)
+    with open(settings['REVIEWS_CSV_PATH'], 'r', encoding='utf-8', newline='') as f:
+        assert next(csv.DictReader(f))['text'] == 'First paragraph 1 second'
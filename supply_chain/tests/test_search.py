@@ -0,0 +1,59 @@
+import csv
+import io
+
+from supply_chain.search import FIELDS, ReviewIndex, complete_rows, parse_rating
+
+
+def review(n: int, **fields) -> dict:
+    return {'datetime': f'2024-05-{n:02d}T10:00:00.000Z', 'service_rating': '4', 'title': f'Review {n}',
+            'text': f'Delivered on time {n}', 'category_slug': 'shoes', 'category_name': 'Shoes',
+            'product_slug': 'acme', **fields}
+
+
+def csv_bytes(rows: list[dict], header: bool = True) -> bytes:
+    f = io.StringIO(newline='')
+    writer = csv.DictWriter(f, fieldnames=FIELDS)
+    if header:
+        writer.writeheader()
+    writer.writerows(rows)
+    return f.getvalue().encode('utf-8')
+
+
+def test_complete_rows_skips_quoted_row_ends():
+    data = csv_bytes([review(1, title='Two\r\nlines'), review(2, text='Said "fine"\r\nthen left')], header=False)
+    assert complete_rows(data) == len(data)
+    assert complete_rows(data + b'2024-05-03T10:00:00.000Z,4,"Open\r\nquote') == len(data)
+    assert complete_rows(b'2024-05-03T10:00:00.000Z,4,"Open\r\nquote') == 0
+    assert complete_rows(b'') == 0
+
+
+def test_parse_rating():
+    assert [parse_rating(value) for value in ('1', 5, ' 3 ', '0', '6', 'abc', '', None)] == [1, 5, 3, None, None,
+                                                                                           None, None, None]
+
+
+def test_invalid_ratings_are_indexed_as_null(tmp_path):
+    index = ReviewIndex(str(tmp_path / 'index.sqlite3'))
+    assert index.add([review(1, service_rating='5'), review(2, service_rating='n/a'), review(3, service_rating='')]) == 3
+    assert index.invalid_ratings == 1
+    assert sorted(str(result['service_rating']) for result in index.search(product='acme')) == ['5', 'None', 'None']
+    assert [result['title'] for result in index.search(ratings=['5'])] == ['Review 1']
+    assert index.search(ratings=['n/a']) == []
+    index.close()
+
+
+def test_sync_csv_reads_complete_rows_only(tmp_path):
+    path = tmp_path / 'reviews.csv'
+    rows = [review(n, title=f'Review {n}\r\nsecond line' if n % 2 else f'Review {n}') for n in range(1, 30)]
+    partial = b'2024-06-01T10:00:00.000Z,5,"Still\r\nbeing written'
+    path.write_bytes(csv_bytes(rows) + partial)
+
+    index = ReviewIndex(str(tmp_path / 'index.sqlite3'))
+    # Blocks smaller than a row end in the middle of quoted fields
+    assert index.sync_csv(str(path), block_bytes=64) == 29
+    with open(path, 'ab') as f:
+        f.write(b'",,shoes,Shoes,acme\r\n')
+    assert index.sync_csv(str(path), block_bytes=64) == 1
+    assert index.sync_csv(str(path)) == 0
+    assert len(index.search(product='acme', limit=100)) == 30
+    index.close()
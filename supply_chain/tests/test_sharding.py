@@ -0,0 +1,69 @@
+import csv
+
+import pytest
+
+from supply_chain.dedupe import DedupeIndex, review_key
+from supply_chain.sharding import merge_shard, shard_of
+from supply_chain.storage import JsonLinesStore, iter_records, store_exists
+
+
+def review(n: int) -> dict:
+    return {'datetime': f'2024-05-01T10:00:{n % 60:02d}.{n:03d}Z', 'service_rating': '4', 'title': f'Review {n}',
+            'text': [f'Text {n}'], 'category_slug': 'shoes', 'category_name': 'Shoes', 'product_slug': 'acme'}
+
+
+def write_shard(directory, reviews: list[dict]) -> None:
+    store = JsonLinesStore('reviews', str(directory))
+    for record in reviews:
+        store.append(record)
+    store.close()
+
+
+def csv_titles(path) -> list[str]:
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        return [row['title'] for row in csv.DictReader(f)]
+
+
+def test_shard_of_is_stable_and_spread():
+    slugs = [f'shop-{n}.com' for n in range(1000)]
+    shards = [shard_of(slug, 4) for slug in slugs]
+    assert shards == [shard_of(slug, 4) for slug in slugs]
+    assert all(150 < shards.count(shard) < 350 for shard in range(4))
+
+
+def test_merge_shard_drops_duplicates(tmp_path):
+    shard = tmp_path / 'shards' / '000'
+    write_shard(shard, [review(n) for n in range(10)])
+    index = DedupeIndex(str(tmp_path / 'dedupe.sqlite3'))
+    index.add(review_key('acme', review(3)['datetime'], 'Review 3'))
+    index.commit()
+
+    assert merge_shard(str(shard), str(tmp_path), str(tmp_path / 'reviews.csv'), index) == (9, 1)
+    assert not store_exists('reviews', str(shard))
+    # Merging again is a no-op
+    assert merge_shard(str(shard), str(tmp_path), str(tmp_path / 'reviews.csv'), index) == (0, 0)
+    index.close()
+    assert len(list(iter_records('reviews', str(tmp_path)))) == 9
+    assert len(csv_titles(tmp_path / 'reviews.csv')) == 9
+    assert len(DedupeIndex(index.path)) == 10
+
+
+def test_interrupted_merge_loses_no_review(tmp_path):
+    class FailingParquet:
+        batch_items = 4
+
+        def write_batch(self, name, batch):
+            raise OSError("No space left on device")
+
+    shard = tmp_path / 'shards' / '000'
+    write_shard(shard, [review(n) for n in range(10)])
+    index = DedupeIndex(str(tmp_path / 'dedupe.sqlite3'), commit_every=2)
+    with pytest.raises(OSError):
+        merge_shard(str(shard), str(tmp_path), str(tmp_path / 'reviews.csv'), index, FailingParquet())
+    index.close()
+
+    index = DedupeIndex(index.path)
+    assert len(index) == 0
+    assert merge_shard(str(shard), str(tmp_path), str(tmp_path / 'reviews.csv'), index) == (10, 0)
+    index.close()
+    assert set(csv_titles(tmp_path / 'reviews.csv')) == {f'Review {n}' for n in range(10)}
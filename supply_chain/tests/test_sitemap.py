@@ -0,0 +1,47 @@
+import gzip
+
+import pytest
+
+from supply_chain.sitemap import SitemapError, iter_sitemap, review_slug
+
+NAMESPACE = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+
+def urlset(urls: list[str]) -> bytes:
+    entries = ''.join(f'<url><loc> {url} </loc><lastmod>2024-05-01</lastmod></url>' for url in urls)
+    return f'<?xml version="1.0" encoding="UTF-8"?><urlset xmlns="{NAMESPACE}">{entries}</urlset>'.encode('utf-8')
+
+
+def test_urlset():
+    urls = ['https://fr.trustpilot.com/review/acme.com', 'https://fr.trustpilot.com/categories/shoes']
+    assert list(iter_sitemap(urlset(urls))) == [('url', url) for url in urls]
+
+
+def test_sitemap_index():
+    data = (f'<sitemapindex xmlns="{NAMESPACE}"><sitemap><loc>https://fr.trustpilot.com/sitemaps/1.xml.gz</loc>'
+            f'</sitemap><sitemap><loc></loc></sitemap></sitemapindex>').encode('utf-8')
+    assert list(iter_sitemap(data)) == [('sitemap', 'https://fr.trustpilot.com/sitemaps/1.xml.gz')]
+
+
+def test_gzipped_sitemap_read_in_chunks():
+    urls = [f'https://fr.trustpilot.com/review/shop-{n}.com' for n in range(5000)]
+    data = gzip.compress(urlset(urls))
+    chunks = [data[start:start + 1000] for start in range(0, len(data), 1000)]
+    assert [url for _, url in iter_sitemap(chunks)] == urls
+
+
+def test_invalid_sitemaps():
+    with pytest.raises(SitemapError):
+        list(iter_sitemap(b'<html><body>Not found</body></html>'))
+    with pytest.raises(SitemapError):
+        list(iter_sitemap(urlset(['https://fr.trustpilot.com/review/acme.com'])[:-10]))
+    with pytest.raises(SitemapError):
+        list(iter_sitemap(gzip.compress(urlset(['https://fr.trustpilot.com/review/acme.com'] * 100)), max_bytes=1000))
+
+
+def test_review_slug():
+    assert review_slug('https://fr.trustpilot.com/review/acme.com') == 'acme.com'
+    assert review_slug('https://fr.trustpilot.com/review/acme.com/') == 'acme.com'
+    assert review_slug('https://fr.trustpilot.com/review/acme.com?page=2') == 'acme.com'
+    assert review_slug('https://fr.trustpilot.com/review/acme.com/about') is None
+    assert review_slug('https://fr.trustpilot.com/categories/shoes') is None